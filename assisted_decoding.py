@@ -0,0 +1,224 @@
+import copy
+import json
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Optional, Tuple
+
+import torch
+from datasets import load_dataset
+from torch import nn
+from transformers import AutoTokenizer, HfArgumentParser
+from transformers.generation.logits_process import LogitsProcessorList
+from transformers.models.bart.modeling_bart import BartDecoder
+
+from dialogue_data import format_dialogue
+from modeling_bart import BartForConditionalGeneration
+
+
+@dataclass
+class AssistedDecodingArguments:
+    model_path: str = field(metadata={"help": "fine-tuning된 checkpoint (model + tokenizer) 경로"})
+    data_name: str = field(default="samsum")
+    split: str = field(default="test")
+    num_dialogues: Optional[int] = field(default=50)
+    output_file: Optional[str] = field(default=None, metadata={"help": "결과 JSON 저장 경로"})
+    # draft model이 사용하는 decoder layer 수 (앞에서부터)
+    draft_layers: int = field(default=3)
+    # draft model이 한 번에 제안하는 token 수
+    num_draft_tokens: int = field(default=4)
+    max_source_length: int = field(default=1024)
+    max_length: int = field(default=80)
+    no_repeat_ngram_size: int = field(default=3)
+    num_threads: Optional[int] = field(default=None)
+
+
+# 같은 checkpoint의 앞 num_layers개 decoder layer만 쓰는 draft decoder
+# embedding / position embedding / layer는 model과 공유 (추가 weight 없음)
+def build_draft_decoder(model: BartForConditionalGeneration, num_layers: int) -> BartDecoder:
+    decoder = model.get_decoder()
+    config = copy.deepcopy(model.config)
+    config.decoder_layers = 0
+    draft = BartDecoder(config, decoder.embed_tokens)
+    draft.embed_positions = decoder.embed_positions
+    draft.layernorm_embedding = decoder.layernorm_embedding
+    draft.layers = nn.ModuleList(decoder.layers[:num_layers])
+    return draft.eval()
+
+
+# self-attention key, value를 앞 length개 위치만 남김 (cross-attention은 그대로)
+def crop_past(past_key_values: Tuple, length: int) -> Tuple:
+    return tuple(
+        (layer_past[0][:, :, :length], layer_past[1][:, :, :length]) + tuple(layer_past[2:])
+        for layer_past in past_key_values
+    )
+
+
+# shallow-decoder draft가 k개 token을 greedy로 제안하고, 전체 model이 decoder 한 번으로 검증
+# - 검증 위치마다 generate와 같은 logits processor를 적용한 argmax와 비교
+# - 처음 어긋나는 위치까지 accept + 그 위치의 전체 model token을 추가 -> 결과는 greedy decoding과 동일
+# batch 크기 1 (Dialogue 하나)만 지원
+class AssistedGreedyDecoder:
+    def __init__(
+        self, model: BartForConditionalGeneration, draft_layers: int, num_draft_tokens: int
+    ):
+        self.model = model.eval()
+        self.draft_decoder = build_draft_decoder(model, draft_layers)
+        self.num_draft_tokens = num_draft_tokens
+        self.num_proposed = 0
+        self.num_accepted = 0
+        self.num_generated = 0
+        self.num_verify_steps = 0
+
+    # acceptance_rate : 제안한 token 중 accept된 비율
+    # tokens_per_verify_step : 전체 model decoder 1회당 생성한 token 수 (greedy는 1)
+    def stats(self) -> Dict[str, float]:
+        return {
+            "acceptance_rate": self.num_accepted / max(self.num_proposed, 1),
+            "tokens_per_verify_step": self.num_generated / max(self.num_verify_steps, 1),
+        }
+
+    def _logits(self, decoder, tokens, encoder_hidden_states, attention_mask, past_key_values):
+        outputs = decoder(
+            input_ids=tokens,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        logits = self.model.lm_head(outputs.last_hidden_state) + self.model.final_logits_bias
+        return logits[0], outputs.past_key_values
+
+    @torch.inference_mode()
+    def generate(self, input_ids: torch.LongTensor, attention_mask: torch.LongTensor, **kwargs):
+        if input_ids.shape[0] != 1:
+            raise ValueError("AssistedGreedyDecoder only supports batch size 1")
+
+        # model.generate(num_beams=1, do_sample=False)와 같은 generation config / logits processor
+        generation_config = copy.deepcopy(self.model.generation_config)
+        generation_config.update(**kwargs, num_beams=1, do_sample=False)
+        logits_processor = self.model._get_logits_processor(
+            generation_config=generation_config,
+            input_ids_seq_length=input_ids.shape[-1],
+            encoder_input_ids=input_ids,
+            prefix_allowed_tokens_fn=None,
+            logits_processor=LogitsProcessorList(),
+        )
+        max_length = generation_config.max_length
+        eos_token_id = generation_config.eos_token_id
+
+        def next_token(prefix, logits):
+            return int(logits_processor(prefix, logits.unsqueeze(0)).argmax(-1))
+
+        encoder_hidden_states = self.model.get_encoder()(
+            input_ids=input_ids, attention_mask=attention_mask
+        ).last_hidden_state
+
+        tokens = input_ids.new_tensor([[generation_config.decoder_start_token_id]])
+        # past는 tokens[:, :-1] (마지막 token 제외)까지의 key, value
+        target_past, draft_past = None, None
+        while tokens.shape[-1] < max_length:
+            # 1. draft : 마지막 token부터 greedy로 k개 제안
+            num_cached = 0 if draft_past is None else draft_past[0][0].shape[2]
+            draft_input, proposal = tokens[:, num_cached:], tokens
+            num_draft = min(self.num_draft_tokens, max_length - tokens.shape[-1])
+            for _ in range(num_draft):
+                logits, draft_past = self._logits(
+                    self.draft_decoder,
+                    draft_input,
+                    encoder_hidden_states,
+                    attention_mask,
+                    draft_past,
+                )
+                token = next_token(proposal, logits[-1])
+                draft_input = proposal.new_tensor([[token]])
+                proposal = torch.cat([proposal, draft_input], dim=-1)
+                if token == eos_token_id:
+                    break
+            drafted = proposal[0, tokens.shape[-1] :].tolist()
+
+            # 2. 전체 model : 마지막 확정 token + 제안 token들을 decoder 한 번으로 검증
+            num_cached = 0 if target_past is None else target_past[0][0].shape[2]
+            logits, target_past = self._logits(
+                self.model.get_decoder(),
+                proposal[:, num_cached:],
+                encoder_hidden_states,
+                attention_mask,
+                target_past,
+            )
+            logits = logits[-(len(drafted) + 1) :]
+
+            accepted = []
+            for idx in range(len(drafted) + 1):
+                prefix = torch.cat([tokens, tokens.new_tensor([accepted])], dim=-1)
+                token = next_token(prefix, logits[idx])
+                accepted.append(token)
+                if idx == len(drafted) or token != drafted[idx] or token == eos_token_id:
+                    break
+            accepted = accepted[: max_length - tokens.shape[-1]]
+
+            self.num_verify_steps += 1
+            self.num_proposed += len(drafted)
+            self.num_accepted += sum(token == draft for token, draft in zip(accepted, drafted))
+            self.num_generated += len(accepted)
+            tokens = torch.cat([tokens, tokens.new_tensor([accepted])], dim=-1)
+
+            # 3. 두 cache 모두 확정된 tokens[:, :-1]까지만 남김
+            target_past = crop_past(target_past, tokens.shape[-1] - 1)
+            num_cached = min(draft_past[0][0].shape[2], tokens.shape[-1] - 1)
+            draft_past = crop_past(draft_past, num_cached)
+            if eos_token_id is not None and accepted[-1] == eos_token_id:
+                break
+        return tokens
+
+
+def main():
+    parser = HfArgumentParser(AssistedDecodingArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    model = BartForConditionalGeneration.from_pretrained(args.model_path).eval()
+    decoder = AssistedGreedyDecoder(model, args.draft_layers, args.num_draft_tokens)
+    gen_kwargs = {"max_length": args.max_length, "no_repeat_ngram_size": args.no_repeat_ngram_size}
+
+    dataset = load_dataset(args.data_name, split=args.split)
+    if args.num_dialogues is not None:
+        dataset = dataset.select(range(min(args.num_dialogues, len(dataset))))
+
+    num_identical, greedy_time, assisted_time = 0, 0.0, 0.0
+    for dialogue in dataset["dialogue"]:
+        inputs = tokenizer(
+            format_dialogue(dialogue),
+            max_length=args.max_source_length,
+            truncation=True,
+            return_tensors="pt",
+        )
+        start = time.perf_counter()
+        with torch.inference_mode():
+            greedy = model.generate(**inputs, num_beams=1, do_sample=False, **gen_kwargs)
+        greedy_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        assisted = decoder.generate(inputs["input_ids"], inputs["attention_mask"], **gen_kwargs)
+        assisted_time += time.perf_counter() - start
+        num_identical += int(greedy[0].tolist() == assisted[0].tolist())
+
+    report = {
+        "config": asdict(args),
+        "num_dialogues": len(dataset),
+        "num_identical": num_identical,
+        "greedy_sec_per_dialogue": greedy_time / len(dataset),
+        "assisted_sec_per_dialogue": assisted_time / len(dataset),
+        "speedup": greedy_time / max(assisted_time, 1e-9),
+        **decoder.stats(),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output_file:
+        with open(args.output_file, "w") as writer:
+            json.dump(report, writer, indent=2)
+
+
+if __name__ == "__main__":
+    main()
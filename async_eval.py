@@ -0,0 +1,302 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from datasets import load_from_disk
+from transformers import (
+    AutoTokenizer,
+    HfArgumentParser,
+    Seq2SeqTrainer,
+    Seq2SeqTrainingArguments,
+)
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+from dialogue_data import DataCollatorForDialogueSeq2Seq, length_sorted_order
+from dialogue_shards import DialogueShardDataset, example_lengths
+from metrics import RougeMetric
+from modeling_bart import BartForConditionalGeneration
+
+# work_dir 안의 파일
+# requests.jsonl : trainer가 저장한 checkpoint (한 줄에 하나, 마지막 줄은 {"stop": true})
+# results.jsonl : worker가 평가한 checkpoint의 metrics (또는 error)
+REQUESTS_FILE = "requests.jsonl"
+RESULTS_FILE = "results.jsonl"
+EVAL_DATASET_DIR = "eval_dataset"
+# DialogueShardDataset은 복사하지 않고 shard 경로 / index만 저장
+SHARD_POINTER_FILE = "shard.json"
+
+
+def _append_jsonl(path: str, record: Dict[str, Any]) -> None:
+    with open(path, "a", encoding="utf-8") as writer:
+        writer.write(json.dumps(record, ensure_ascii=False) + "\n")
+        writer.flush()
+
+
+# offset 이후에 추가된 완성된 줄("\n"로 끝남)만 읽음 (쓰는 중인 마지막 줄은 다음에 읽음)
+def _read_new_lines(path: str, offset: int) -> Tuple[List[Dict[str, Any]], int]:
+    with open(path, "rb") as reader:
+        reader.seek(offset)
+        data = reader.read()
+    end = data.rfind(b"\n") + 1
+    lines = [json.loads(line) for line in data[:end].decode("utf-8").splitlines() if line]
+    return lines, offset + end
+
+
+def save_eval_dataset(dataset, path: str) -> None:
+    if isinstance(dataset, DialogueShardDataset):
+        os.makedirs(path, exist_ok=True)
+        pointer = {
+            "shard_dir": os.path.abspath(dataset.shard_dir),
+            "indices": None if dataset.indices is None else dataset.indices.tolist(),
+        }
+        with open(os.path.join(path, SHARD_POINTER_FILE), "w") as writer:
+            json.dump(pointer, writer)
+    else:
+        dataset.save_to_disk(path)
+
+
+def load_eval_dataset(path: str):
+    pointer_file = os.path.join(path, SHARD_POINTER_FILE)
+    if not os.path.exists(pointer_file):
+        return load_from_disk(path)
+    with open(pointer_file) as reader:
+        pointer = json.load(reader)
+    indices = pointer["indices"]
+    return DialogueShardDataset(
+        pointer["shard_dir"], indices=None if indices is None else np.asarray(indices)
+    )
+
+
+# 학습 process 쪽 : checkpoint를 저장할 때마다 별도 worker process(이 파일의 main)에 평가를 요청
+# - worker는 학습과 병렬로 generate + ROUGE를 계산하고 결과를 results.jsonl에 씀
+# - poll()은 새로 끝난 결과를 반환 (학습을 멈추지 않음), close()는 남은 평가가 끝날 때까지 기다림
+# - pending : 아직 평가하지 않은 checkpoint (checkpoint rotation에서 지우지 않음)
+class AsyncCheckpointEvaluator:
+    def __init__(
+        self,
+        work_dir: str,
+        eval_dataset,
+        worker_args: Sequence[str] = (),
+        env: Optional[Dict[str, str]] = None,
+    ):
+        self.work_dir = os.path.abspath(work_dir)
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.requests_file = os.path.join(self.work_dir, REQUESTS_FILE)
+        self.results_file = os.path.join(self.work_dir, RESULTS_FILE)
+        for path in (self.requests_file, self.results_file):
+            open(path, "w").close()
+        save_eval_dataset(eval_dataset, os.path.join(self.work_dir, EVAL_DATASET_DIR))
+
+        self.pending: Dict[str, int] = {}
+        self._results_offset = 0
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--work_dir",
+                self.work_dir,
+                "--parent_pid",
+                str(os.getpid()),
+                *worker_args,
+            ],
+            env=env,
+        )
+
+    def submit(self, checkpoint: str, step: int) -> None:
+        checkpoint = os.path.abspath(checkpoint)
+        self.pending[checkpoint] = step
+        _append_jsonl(self.requests_file, {"checkpoint": checkpoint, "step": step})
+
+    def poll(self) -> List[Dict[str, Any]]:
+        results, self._results_offset = _read_new_lines(self.results_file, self._results_offset)
+        for result in results:
+            self.pending.pop(result["checkpoint"], None)
+        if self.pending and self.process.poll() is not None:
+            # worker가 비정상 종료 : 남은 checkpoint는 평가되지 않으므로 rotation 보호 해제
+            print(
+                f"async eval worker exited with code {self.process.returncode}, "
+                f"{len(self.pending)} checkpoints were not evaluated"
+            )
+            self.pending.clear()
+        return results
+
+    def close(self, timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        _append_jsonl(self.requests_file, {"stop": True})
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        return self.poll()
+
+
+# Trainer에 AsyncCheckpointEvaluator를 연결 (class BartTrainer(AsyncEvalTrainerMixin, Seq2SeqTrainer))
+# - checkpoint를 저장할 때마다 평가 요청, log / 저장할 때마다 끝난 결과를 eval_* log와 best checkpoint에 반영
+# - 평가를 기다리는 checkpoint는 save_total_limit rotation에서 지우지 않음
+# - train()은 남은 평가가 끝날 때까지 기다린 뒤 반환
+class AsyncEvalTrainerMixin:
+    async_eval: Optional[AsyncCheckpointEvaluator] = None
+    # best checkpoint 기준 metric (eval_ prefix 제외, 클수록 좋음)
+    async_eval_metric: str = "rougeL"
+
+    def log(self, logs):
+        super().log(logs)
+        if self.async_eval is not None:
+            self._record_async_eval(self.async_eval.poll())
+
+    # worker가 끝낸 checkpoint 평가 결과를 log (eval_* + eval_checkpoint_step)하고 best checkpoint 갱신
+    def _record_async_eval(self, results: List[Dict[str, Any]]) -> None:
+        for result in results:
+            if "metrics" not in result:
+                print(f"async eval failed for {result['checkpoint']} :\n{result.get('error')}")
+                continue
+            metrics = result["metrics"]
+            value = metrics.get(f"eval_{self.async_eval_metric}")
+            if value is not None and (
+                self.state.best_metric is None or value > self.state.best_metric
+            ):
+                self.state.best_metric = value
+                # Trainer._sorted_checkpoints가 output_dir을 glob한 경로와 같은 형식
+                # (worker에 보낸 절대 경로를 그대로 쓰면 rotation의 index 검색이 실패)
+                self.state.best_model_checkpoint = os.path.join(
+                    self._get_output_dir(trial=None), os.path.basename(result["checkpoint"])
+                )
+            super().log({**metrics, "eval_checkpoint_step": result["step"]})
+
+    def _save_checkpoint(self, model, trial, metrics=None):
+        if self.async_eval is not None:
+            # rotation 전에 끝난 평가를 반영 (best checkpoint / 평가가 끝난 checkpoint만 지움)
+            self._record_async_eval(self.async_eval.poll())
+        super()._save_checkpoint(model, trial, metrics=metrics)
+        if self.async_eval is not None:
+            checkpoint = os.path.join(
+                self._get_output_dir(trial=trial),
+                f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}",
+            )
+            self.async_eval.submit(checkpoint, self.state.global_step)
+
+    def _sorted_checkpoints(
+        self, output_dir=None, checkpoint_prefix=PREFIX_CHECKPOINT_DIR, use_mtime=False
+    ):
+        # best_model_checkpoint를 output_dir 기준 경로로 맞춤 (이전 checkpoint의 trainer_state 등)
+        best = self.state.best_model_checkpoint
+        if best is not None and output_dir is not None:
+            self.state.best_model_checkpoint = os.path.join(
+                output_dir, os.path.basename(os.path.normpath(best))
+            )
+        checkpoints = super()._sorted_checkpoints(
+            output_dir=output_dir, checkpoint_prefix=checkpoint_prefix, use_mtime=use_mtime
+        )
+        if self.async_eval is None:
+            return checkpoints
+        pending = {os.path.normpath(os.path.abspath(path)) for path in self.async_eval.pending}
+        return [
+            path
+            for path in checkpoints
+            if os.path.normpath(os.path.abspath(path)) not in pending
+        ]
+
+    def train(self, *args, **kwargs):
+        output = super().train(*args, **kwargs)
+        if self.async_eval is not None:
+            # 마지막 checkpoint들의 평가가 끝날 때까지 기다림
+            self._record_async_eval(self.async_eval.close())
+        return output
+
+
+@dataclass
+class AsyncEvalArguments:
+    work_dir: str = field(metadata={"help": "AsyncCheckpointEvaluator의 work_dir"})
+    # 학습 process가 없어지면 worker도 종료
+    parent_pid: Optional[int] = field(default=None)
+    batch_size: int = field(default=8)
+    # None이면 in-loop evaluate와 같은 값 (model generation config)
+    max_length: Optional[int] = field(default=None)
+    num_beams: Optional[int] = field(default=None)
+    # 기본값은 CPU (GPU를 쓰려면 학습과 다른 GPU를 CUDA_VISIBLE_DEVICES로 지정)
+    no_cuda: bool = field(default=True)
+    num_threads: Optional[int] = field(default=None)
+    rouge_workers: Optional[int] = field(default=None)
+    sort_by_length: bool = field(default=True)
+    # 새 요청이 없을 때 requests.jsonl을 다시 읽는 간격(초)
+    poll_interval: float = field(default=5.0)
+
+
+# checkpoint 하나를 in-loop evaluate와 같은 방식(Seq2SeqTrainer.evaluate + RougeMetric)으로 평가
+# 생성 요약문은 checkpoint 디렉토리의 predictions-0.jsonl에 저장
+# restore_order : eval_dataset을 길이 순으로 정렬했으면 원래 순서로 되돌리는 index (저장 순서)
+def evaluate_checkpoint(
+    checkpoint: str, eval_dataset, args: AsyncEvalArguments, restore_order=None
+) -> Dict[str, float]:
+    tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+    model = BartForConditionalGeneration.from_pretrained(checkpoint)
+    trainer = Seq2SeqTrainer(
+        model=model,
+        args=Seq2SeqTrainingArguments(
+            output_dir=os.path.join(args.work_dir, "trainer"),
+            per_device_eval_batch_size=args.batch_size,
+            predict_with_generate=True,
+            no_cuda=args.no_cuda,
+            report_to=[],
+        ),
+        tokenizer=tokenizer,
+        data_collator=DataCollatorForDialogueSeq2Seq(tokenizer=tokenizer, model=model),
+        compute_metrics=RougeMetric(
+            tokenizer,
+            output_dir=checkpoint,
+            num_workers=args.rouge_workers,
+            restore_order=restore_order,
+        ),
+    )
+    gen_kwargs = {"max_length": args.max_length, "num_beams": args.num_beams}
+    gen_kwargs = {key: value for key, value in gen_kwargs.items() if value is not None}
+    return trainer.evaluate(eval_dataset, metric_key_prefix="eval", **gen_kwargs)
+
+
+# worker process : requests.jsonl의 checkpoint를 순서대로 평가해서 results.jsonl에 추가
+def main():
+    parser = HfArgumentParser(AsyncEvalArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    eval_dataset = load_eval_dataset(os.path.join(args.work_dir, EVAL_DATASET_DIR))
+    restore_order = None
+    if args.sort_by_length:
+        order = length_sorted_order(example_lengths(eval_dataset))
+        eval_dataset, restore_order = eval_dataset.select(order), np.argsort(order)
+    requests_file = os.path.join(args.work_dir, REQUESTS_FILE)
+    results_file = os.path.join(args.work_dir, RESULTS_FILE)
+
+    offset = 0
+    while True:
+        requests, offset = _read_new_lines(requests_file, offset)
+        for request in requests:
+            if request.get("stop"):
+                return
+            result = dict(request)
+            try:
+                result["metrics"] = evaluate_checkpoint(
+                    request["checkpoint"], eval_dataset, args, restore_order
+                )
+            except Exception:
+                # 평가 실패(지워진 checkpoint 등)도 결과로 기록해서 trainer가 기다리지 않게 함
+                result["error"] = traceback.format_exc()
+            _append_jsonl(results_file, result)
+            print(f"async eval : {json.dumps(result, ensure_ascii=False)[:500]}")
+
+        if not requests:
+            if args.parent_pid is not None and os.getppid() != args.parent_pid:
+                return
+            time.sleep(args.poll_interval)
+
+
+if __name__ == "__main__":
+    main()
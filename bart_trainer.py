@@ -1,20 +1,40 @@
-import re
+import os
+from contextlib import nullcontext
 from typing import Optional
 
 import torch
 from datasets import load_dataset
 from dataclasses import dataclass, field
-import evaluate
 import numpy as np
+from torch.utils.data import DataLoader
 from transformers import (
     BartTokenizerFast,
-    DataCollatorForSeq2Seq,
     Seq2SeqTrainingArguments,
     Seq2SeqTrainer,
     HfArgumentParser,
+    set_seed as seed_everything,
 )
-
+from transformers.trainer_pt_utils import IterableDatasetShard
+from transformers.trainer_utils import PredictionOutput
+
+from async_eval import AsyncCheckpointEvaluator, AsyncEvalTrainerMixin
+from contrastive import TopicClusterCache
+from dialogue_shards import example_lengths, load_or_build_shards
+from distributed import global_example_mean
+from kv_cache import StaticKVCache
+from metrics import RougeMetric
 from modeling_bart import BartForConditionalGeneration
+from sparse_attention import TurnSparseSpec, extend_position_embeddings
+from dialogue_data import (
+    DIALOGUE_SPECIAL_TOKENS,
+    DataCollatorForDialogueSeq2Seq,
+    DialogueSpec,
+    StreamingDialogueDataset,
+    TokenBudgetBatchSampler,
+    expand_data_files,
+    length_sorted_order,
+    tokenize_dialogues,
+)
 
 
 @dataclass
@@ -25,6 +45,70 @@ class RunArguments:
     lamda: Optional[float] = field(default=0.08)
     batch_size: int = field(default=8)
     set_seed: int = field(default=100)
+    # True : Batch 안 모든 Dialogue에 Contrastive Learning, False : 첫 번째 Dialogue만
+    ctr_batch: bool = field(default=False)
+    # 설정하면 batch_size 대신 (max_len x batch_size) <= max_tokens가 되도록 길이 별로 batch 구성
+    max_tokens: Optional[int] = field(default=None)
+    # evaluate / predict 시 Dialogue를 길이 순으로 정렬해서 generate (predict 결과는 원래 순서로 복원)
+    sort_by_length: bool = field(default=True)
+    # Topic-Aware k-means 결과를 cache할 Dialogue 수 (0이면 cache 사용 안 함)
+    topic_cache_size: int = field(default=0)
+    # cache된 Dialogue를 k-means++부터 다시 clustering하는 주기(step)
+    topic_refresh_steps: int = field(default=100)
+    # utterance representation 평균의 상대 변화량이 이 값보다 크면 다시 clustering
+    topic_drift_threshold: float = field(default=0.1)
+    # ROUGE 계산 process 수 (기본값 : min(CPU 수, 8))
+    rouge_workers: Optional[int] = field(default=None)
+    # forward 구간(encoder, span, speaker / topic, decoder, lm_head) 별 시간을 training log에 추가
+    profile_phases: bool = field(default=False)
+    # 설정하면 training loss(label smoothing 포함)를 decoder 위치 loss_chunk_size개 단위로 계산
+    # (full logits를 만들지 않아 activation memory 감소, 값은 label_smoother와 동일)
+    loss_chunk_size: Optional[int] = field(default=None)
+    # True : ctr_batch와 같은 Contrastive loss를 고정 shape 연산으로 계산 (torch.compile에서 graph break 없음)
+    ctr_static: bool = field(default=False)
+    # input_ids / span table의 길이, turn 수를 배수로 padding (static shape bucket, 재compile 횟수 감소)
+    pad_to_multiple_of: Optional[int] = field(default=None)
+    turn_pad_to_multiple_of: Optional[int] = field(default=None)
+    # Trainer가 model을 torch.compile (torch>=2.0 필요)
+    torch_compile: bool = field(default=False)
+    # predict(beam search) 시 decoder self-attention key / value를 미리 할당한 buffer에 in-place로 저장
+    static_kv_cache: bool = field(default=False)
+    # predict(beam search) 시 encoder output / cross-attention key, value를 beam 수만큼 복사하지 않고 공유
+    share_encoder_outputs: bool = field(default=False)
+    # Dialogue 최대 token 수 (position embedding 수보다 크면 position embedding을 늘림)
+    max_source_length: int = field(default=1024)
+    # 설정하면 encoder를 Speaker-turn block-sparse attention으로 (앞 / 뒤 이웃 turn 수)
+    turn_sparse_window: Optional[int] = field(default=None)
+    # block-sparse attention에서 긴 turn을 나누는 block 길이
+    turn_block_size: int = field(default=128)
+    # block-sparse attention에서 전체 token에 attention하는 global token(turn 당 1개) 수의 상한
+    turn_max_global_tokens: int = field(default=64)
+    # CUDA 없이 CPU에서 학습 (torchrun --nproc_per_node N으로 실행하면 gloo backend 분산 학습)
+    no_cuda: bool = field(default=False)
+    # bfloat16 autocast로 학습 / generate (CPU 또는 bf16 지원 GPU, fp16 대신 사용)
+    # Contrastive loss와 cross entropy는 float32로 계산
+    bf16_autocast: bool = field(default=False)
+    # 설정하면 tokenize한 dataset을 이 디렉토리의 memory-mapped shard로 저장 / 재사용
+    shard_dir: Optional[str] = field(default=None)
+    # 설정하면 train data를 로컬 JSONL / Parquet 파일(콤마 구분, glob 가능)에서 streaming으로 읽고 tokenize
+    train_files: Optional[str] = field(default=None)
+    # 로컬 validation / test 파일 (설정하지 않으면 data_name의 validation / test split)
+    validation_file: Optional[str] = field(default=None)
+    test_file: Optional[str] = field(default=None)
+    # streaming train data의 bounded shuffle buffer 크기 (example 수, 0이면 파일 순서)
+    shuffle_buffer_size: int = field(default=10000)
+    # streaming train data를 읽고 tokenize하는 record 단위 (DataLoader worker마다 다른 chunk)
+    stream_chunk_size: int = field(default=256)
+    # True : 학습을 멈추고 evaluate하지 않고, 저장한 checkpoint를 별도 worker process가 학습과 병렬로
+    #        generate + ROUGE로 평가 (결과는 training log와 best checkpoint에 반영)
+    async_eval: bool = field(default=False)
+    # best checkpoint 기준 metric (eval_ prefix 제외, 클수록 좋음)
+    async_eval_metric: str = field(default="rougeL")
+    # worker가 쓸 GPU (CUDA_VISIBLE_DEVICES 값, 설정하지 않으면 CPU)
+    async_eval_gpu: Optional[str] = field(default=None)
+    async_eval_threads: Optional[int] = field(default=None)
+    # 0보다 크면 training loop 안의 evaluate는 validation 앞 proxy_eval_size개를 greedy decoding (proxy_ log)
+    proxy_eval_size: int = field(default=0)
 
 
 parser = HfArgumentParser((Seq2SeqTrainingArguments, RunArguments))
@@ -42,70 +126,212 @@ lamda = run_args.lamda
 model_name = run_args.model_name
 batch_size = run_args.batch_size
 set_seed = run_args.set_seed
+ctr_batch = run_args.ctr_batch
+ctr_static = run_args.ctr_static
+if run_args.train_files is not None and run_args.max_tokens is not None:
+    raise ValueError("--max_tokens needs example lengths and cannot be used with --train_files")
+if run_args.torch_compile and not hasattr(torch, "compile"):
+    raise ValueError(f"--torch_compile requires torch>=2.0, found torch=={torch.__version__}")
 cluster_mode = 0
 
-device = torch.device("cuda")
+# fp16은 CUDA에서만 사용 (bf16_autocast이면 CPU / CUDA 모두 bf16)
+use_cuda = torch.cuda.is_available() and not run_args.no_cuda
+device = torch.device("cuda" if use_cuda else "cpu")
 print(f"trainer device : {device}")
 
-
-# Define the preprocessing function
-def preprocess_function(examples):
-    dialogue = ["<sep>" + re.sub("\r\n", "<sep>", i) for i in examples["dialogue"]]
-    model_inputs = tokenizer(dialogue, max_length=1024, truncation=True)
-    labels = tokenizer(text_target=examples["summary"], max_length=128, truncation=True)
-    model_inputs["labels"] = labels["input_ids"]
-    return model_inputs
+# seed fix (random, NumPy, PyTorch)
+seed_everything(set_seed)
 
 
-def compute_metrics(eval_pred):
-    # metric with ROUGE Scores
-    predictions, labels = eval_pred
-    decoded_preds = tokenizer.batch_decode(predictions, skip_special_tokens=True)
-    labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
-    decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
-
-    # Check Generated Summary
-    cnt = 0
-    for preds, labels in zip(decoded_preds, decoded_labels):
-        print(f"=======================<decoded_preds {cnt}>=================")
-        print(f"decoded_preds : {preds}")
-        print(f"=======================<decoded_labels {cnt}>================")
-        print(f"decoded_labels : {labels}")
-        cnt += 1
-
-    # rouge score compute
-    result = rouge.compute(
-        predictions=decoded_preds,
-        references=decoded_labels,
-        tokenizer=lambda x: tokenizer.tokenize(x),
-        use_stemmer=True,
+# Define the preprocessing function
+def preprocess_function(examples, indices):
+    # Speaker / Utterance span을 미리 계산 -> model forward에서 token ids를 scan하지 않음
+    model_inputs = tokenize_dialogues(
+        tokenizer,
+        examples["dialogue"],
+        examples["summary"],
+        dialogue_spec,
+        max_source_length=run_args.max_source_length,
+        max_target_length=128,
     )
-    print(f"rouge : {result}")
-    prediction_lens = [np.count_nonzero(pred != tokenizer.pad_token_id) for pred in predictions]
-    result["gen_len"] = np.mean(prediction_lens)
 
-    return {k: round(v, 4) for k, v in result.items()}
+    # Topic-Aware cluster cache의 key
+    model_inputs["example_index"] = indices
+    return model_inputs
 
 
 # Custom BartTrainer
-class BartTrainer(Seq2SeqTrainer):
-    def __init__(self, all_special_ids, raw_data, *args, **kwargs):
+# (async_eval : AsyncEvalTrainerMixin이 checkpoint 저장 / rotation / log에 out-of-band 평가를 연결)
+class BartTrainer(AsyncEvalTrainerMixin, Seq2SeqTrainer):
+    def __init__(
+        self,
+        all_special_ids,
+        raw_data,
+        *args,
+        max_tokens=None,
+        sort_by_length=False,
+        topic_cache=None,
+        loss_chunk_size=None,
+        async_eval=None,
+        async_eval_metric="rougeL",
+        proxy_eval_dataset=None,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
         self.all_special_ids = all_special_ids
         self.raw_data = raw_data
+        self.max_tokens = max_tokens
+        self.sort_by_length = sort_by_length
+        self.topic_cache = topic_cache
+        self.loss_chunk_size = loss_chunk_size
+        self.async_eval = async_eval
+        self.async_eval_metric = async_eval_metric
+        self.proxy_eval_dataset = proxy_eval_dataset
+
+    def log(self, logs):
+        # training log에 Topic-Aware cluster cache hit / miss 추가
+        if self.topic_cache is not None and "loss" in logs:
+            logs.update(self.topic_cache.stats())
+        # 직전 log 이후 누적된 forward 구간 별 시간 / 메모리
+        if self.model.profiler.enabled and "loss" in logs:
+            logs.update(self.model.profiler.stats())
+            self.model.profiler.reset()
+        super().log(logs)
+
+    def get_train_dataloader(self):
+        if isinstance(self.train_dataset, StreamingDialogueDataset):
+            # Seq2SeqTrainer는 분산 학습에서만 IterableDatasetShard로 감싸서 set_epoch를 호출하므로
+            # 항상 감싸서 epoch마다 shuffle 순서가 바뀌도록 함 (rank 별 batch 분할도 IterableDatasetShard)
+            train_dataset = IterableDatasetShard(
+                self.train_dataset,
+                batch_size=self._train_batch_size,
+                drop_last=self.args.dataloader_drop_last,
+                num_processes=self.args.world_size,
+                process_index=self.args.process_index,
+            )
+            return DataLoader(
+                train_dataset,
+                batch_size=self._train_batch_size,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+            )
+        if self.max_tokens is None:
+            return super().get_train_dataloader()
+
+        # token budget 기반 length-bucketed batch
+        train_dataset = self._remove_unused_columns(self.train_dataset, description="training")
+        batch_sampler = TokenBudgetBatchSampler(
+            lengths=example_lengths(train_dataset),
+            max_tokens=self.max_tokens,
+            seed=self.args.seed,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+        )
+        print(
+            f"token budget batches : {len(batch_sampler)}, "
+            f"padding ratio : {batch_sampler.padding_ratio():.4f}"
+        )
+        return DataLoader(
+            train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+    def prediction_step(self, *args, **kwargs):
+        # Seq2SeqTrainer는 loss 계산만 autocast하므로 bf16이면 generate도 autocast 안에서 실행
+        if not self.args.bf16:
+            return super().prediction_step(*args, **kwargs)
+        with self.autocast_smart_context_manager():
+            return super().prediction_step(*args, **kwargs)
+
+    # 길이 순으로 정렬한 dataset과 원래 순서로 되돌리는 index
+    def _length_sorted(self, dataset):
+        order = length_sorted_order(example_lengths(dataset))
+        return dataset.select(order), np.argsort(order)
+
+    # compute_metrics가 RougeMetric이면 predictions-{n}.jsonl을 원래 dataset 순서로 저장
+    def _original_order(self, restore_order):
+        if isinstance(self.compute_metrics, RougeMetric):
+            return self.compute_metrics.original_order(restore_order)
+        return nullcontext()
+
+    def evaluate(self, eval_dataset=None, ignore_keys=None, metric_key_prefix="eval", **gen_kwargs):
+        if eval_dataset is None and self.proxy_eval_dataset is not None:
+            # training loop 안의 evaluate : 고정된 작은 subset을 greedy decoding (빠른 중간 신호)
+            eval_dataset, metric_key_prefix = self.proxy_eval_dataset, "proxy"
+            gen_kwargs["num_beams"] = 1
+        eval_dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
+        if not self.sort_by_length:
+            return super().evaluate(
+                eval_dataset,
+                ignore_keys=ignore_keys,
+                metric_key_prefix=metric_key_prefix,
+                **gen_kwargs,
+            )
+
+        eval_dataset, restore_order = self._length_sorted(eval_dataset)
+        with self._original_order(restore_order):
+            return super().evaluate(
+                eval_dataset,
+                ignore_keys=ignore_keys,
+                metric_key_prefix=metric_key_prefix,
+                **gen_kwargs,
+            )
+
+    def predict(self, test_dataset, ignore_keys=None, metric_key_prefix="test", **gen_kwargs):
+        if not self.sort_by_length:
+            return super().predict(
+                test_dataset,
+                ignore_keys=ignore_keys,
+                metric_key_prefix=metric_key_prefix,
+                **gen_kwargs,
+            )
+
+        sorted_dataset, restore_order = self._length_sorted(test_dataset)
+        with self._original_order(restore_order):
+            output = super().predict(
+                sorted_dataset,
+                ignore_keys=ignore_keys,
+                metric_key_prefix=metric_key_prefix,
+                **gen_kwargs,
+            )
+        return PredictionOutput(
+            predictions=output.predictions[restore_order],
+            label_ids=output.label_ids[restore_order] if output.label_ids is not None else None,
+            metrics=output.metrics,
+        )
 
     def compute_loss(self, model, inputs, return_outputs=False):
         # implement custom logic here
-        if self.label_smoother is not None and "labels" in inputs:
+        # chunked loss : model이 label smoothing까지 포함한 loss를 한 번에 계산 (outputs.loss 사용)
+        chunked_loss = self.loss_chunk_size is not None and model.training and "labels" in inputs
+        # 분산 학습에서 cross entropy를 전체 rank의 label token 평균으로 바꿀 때 사용
+        num_label_tokens = (inputs["labels"] != -100).sum() if "labels" in inputs else None
+        if self.label_smoother is not None and "labels" in inputs and not chunked_loss:
             labels = inputs.pop("labels")
         else:
             labels = None
+        if self.topic_cache is not None:
+            self.topic_cache.global_step = self.state.global_step
+        loss_kwargs = {}
+        if chunked_loss:
+            loss_kwargs = {
+                "loss_chunk_size": self.loss_chunk_size,
+                "label_smoothing": self.args.label_smoothing_factor,
+            }
         outputs = model(
             **inputs,
             all_special_ids=self.all_special_ids,
             raw_data=self.raw_data,
             ctr_mode=ctr_mode,
             cluster_mode=cluster_mode,
+            ctr_batch=ctr_batch,
+            ctr_static=ctr_static,
+            topic_cache=self.topic_cache,
+            **loss_kwargs,
         )
 
         # Save past state if it exists
@@ -124,28 +350,106 @@ class BartTrainer(Seq2SeqTrainer):
             # We don't use .loss here since the model may return tuples instead of ModelOutput.
             loss = outputs["loss"] if isinstance(outputs, dict) else outputs[0]
 
+        # 분산 학습 : rank 별 평균이 아니라 전체 rank의 평균
+        # (cross entropy는 label token 평균, Contrastive loss는 loss를 계산한 Dialogue 평균)
+        ctr_loss = outputs.ctr_loss
+        if model.training and self.args.world_size > 1:
+            if num_label_tokens is not None:
+                loss = global_example_mean(loss, num_label_tokens)
+            ctr_loss = global_example_mean(ctr_loss, outputs.ctr_num_examples)
+
         # final_loss : generation loss + contrastive loss
-        final_loss = loss + lamda * outputs.ctr_loss
+        final_loss = loss + lamda * ctr_loss
         return (final_loss, outputs) if return_outputs else final_loss
 
 
-# dataset is SAMSum
-datasets = load_dataset(run_args.data_name)  # "samsum")
-
 tokenizer = BartTokenizerFast.from_pretrained(model_name)
 model = BartForConditionalGeneration.from_pretrained(model_name)
 
 print(f"before tokenizer.vocab_size : {tokenizer.vocab_size}")
-num_add_token = tokenizer.add_special_tokens({"additional_special_tokens": ["<sep>", ":"]})
+num_add_token = tokenizer.add_special_tokens(
+    {"additional_special_tokens": DIALOGUE_SPECIAL_TOKENS}
+)
+# <sep> / ":" token id를 model config에 저장 (English / Korean tokenizer 모두 동일하게 동작)
+dialogue_spec = DialogueSpec.from_tokenizer(tokenizer)
+model.set_dialogue_spec(dialogue_spec)
+model.enable_profiling(run_args.profile_phases)
+if run_args.turn_sparse_window is not None:
+    model.set_turn_sparse_attention(
+        TurnSparseSpec(
+            window_turns=run_args.turn_sparse_window,
+            max_block_size=run_args.turn_block_size,
+            max_global_tokens=run_args.turn_max_global_tokens,
+        )
+    )
+if run_args.max_source_length > model.config.max_position_embeddings:
+    extend_position_embeddings(model, model.config, run_args.max_source_length)
+
+
+# validation / test (train_files를 쓰면 train split은 읽지 않음)
+def load_raw_datasets():
+    if run_args.validation_file is not None:
+        data_files = {
+            "validation": run_args.validation_file,
+            "test": run_args.test_file or run_args.validation_file,
+        }
+        builder = "parquet" if run_args.validation_file.endswith(".parquet") else "json"
+        raw_datasets = load_dataset(builder, data_files=data_files)
+    else:
+        # dataset is SAMSum
+        raw_datasets = load_dataset(run_args.data_name)  # "samsum")
+    if run_args.train_files is not None:
+        raw_datasets.pop("train", None)
+    return raw_datasets
+
+
+data_source = run_args.data_name
+if run_args.validation_file is not None:
+    data_source = f"{run_args.validation_file},{run_args.test_file}"
+if run_args.train_files is not None:
+    data_source += " (without train)"
 
 # Preprocessing data
-tokenized_data = datasets.map(preprocess_function, batched=True)
+if run_args.shard_dir is None:
+    tokenized_data = load_raw_datasets().map(
+        preprocess_function, batched=True, with_indices=True
+    )
+else:
+    # 같은 tokenizer / 설정으로 만든 memory-mapped shard가 있으면 열기만 함 (없으면 한 번 만듦)
+    tokenized_data = load_or_build_shards(
+        run_args.shard_dir,
+        load_raw_datasets,
+        tokenizer,
+        dialogue_spec,
+        source=data_source,
+        max_source_length=run_args.max_source_length,
+        max_target_length=128,
+    )
+
+if run_args.train_files is not None:
+    # 로컬 corpus를 읽으면서 DataLoader worker에서 tokenize (corpus 크기와 무관한 memory)
+    train_dataset = StreamingDialogueDataset(
+        expand_data_files(run_args.train_files),
+        tokenizer,
+        dialogue_spec,
+        max_source_length=run_args.max_source_length,
+        max_target_length=128,
+        shuffle_buffer_size=run_args.shuffle_buffer_size,
+        chunk_size=run_args.stream_chunk_size,
+        seed=set_seed,
+    )
+else:
+    train_dataset = tokenized_data["train"]
 
 print(f"tokenized_data : {tokenized_data}")
 # Resize model's token embedding numbers because of special tokens
 model.resize_token_embeddings(tokenizer.vocab_size + num_add_token)
-data_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, model=model)
-rouge = evaluate.load("rouge")
+data_collator = DataCollatorForDialogueSeq2Seq(
+    tokenizer=tokenizer,
+    model=model,
+    pad_to_multiple_of=run_args.pad_to_multiple_of,
+    span_pad_to_multiple_of=run_args.turn_pad_to_multiple_of,
+)
 
 
 # Arguments for Trainer
@@ -154,7 +458,8 @@ training_args = Seq2SeqTrainingArguments(
     per_device_train_batch_size=batch_size,
     per_device_eval_batch_size=batch_size,
     save_total_limit=3,
-    evaluation_strategy="steps",
+    # async_eval만 쓰면 training loop 안에서는 evaluate하지 않음 (proxy_eval_size가 있으면 proxy만)
+    evaluation_strategy="no" if run_args.async_eval and run_args.proxy_eval_size == 0 else "steps",
     gradient_accumulation_steps=1,
     gradient_checkpointing=True,
     learning_rate=2e-5,
@@ -164,24 +469,75 @@ training_args = Seq2SeqTrainingArguments(
     weight_decay=0.1,
     label_smoothing_factor=0.1,
     predict_with_generate=True,
-    fp16=True,
+    fp16=use_cuda and not run_args.bf16_autocast,
+    # CPU에서는 torch.cpu.amp.autocast(bfloat16)
+    bf16=run_args.bf16_autocast,
+    no_cuda=not use_cuda,
+    # CPU 분산 학습 backend (torchrun으로 실행했을 때만 사용)
+    xpu_backend="gloo",
+    # streaming train data를 tokenize하는 process 수 (command line 값 사용)
+    dataloader_num_workers=training_args.dataloader_num_workers,
     seed=1,
+    torch_compile=run_args.torch_compile,
 )
 
 # Check the current device
 print(f"training_args.device : {training_args.device}")
 
+# 저장한 checkpoint를 학습과 병렬로 평가하는 worker (checkpoint를 저장하는 main process에서만)
+async_eval = None
+if run_args.async_eval and training_args.should_save:
+    worker_args, worker_env = ["--batch_size", str(batch_size)], dict(os.environ)
+    if run_args.async_eval_gpu is not None:
+        worker_args += ["--no_cuda", "False"]
+        worker_env["CUDA_VISIBLE_DEVICES"] = run_args.async_eval_gpu
+    if run_args.async_eval_threads is not None:
+        worker_args += ["--num_threads", str(run_args.async_eval_threads)]
+    if run_args.rouge_workers is not None:
+        worker_args += ["--rouge_workers", str(run_args.rouge_workers)]
+    async_eval = AsyncCheckpointEvaluator(
+        os.path.join(training_args.output_dir, "async_eval"),
+        tokenized_data["validation"],
+        worker_args=worker_args,
+        env=worker_env,
+    )
+proxy_eval_dataset = None
+if run_args.proxy_eval_size > 0:
+    proxy_eval_dataset = tokenized_data["validation"].select(
+        range(min(run_args.proxy_eval_size, len(tokenized_data["validation"])))
+    )
+
+# ROUGE metric (생성 요약문은 output_dir/predictions-{n}.jsonl에 저장)
+compute_metrics = RougeMetric(
+    tokenizer, output_dir=training_args.output_dir, num_workers=run_args.rouge_workers
+)
+
 # Custom BartTrainer(with Speaker-Aware and Topic-Aware)
 trainer = BartTrainer(
     model=model,
     args=training_args,
-    train_dataset=tokenized_data["train"],
+    train_dataset=train_dataset,
     eval_dataset=tokenized_data["validation"],
     tokenizer=tokenizer,
     data_collator=data_collator,
     compute_metrics=compute_metrics,
     all_special_ids=tokenizer.all_special_ids,
-    raw_data=tokenized_data["train"],
+    raw_data=train_dataset,
+    max_tokens=run_args.max_tokens,
+    sort_by_length=run_args.sort_by_length,
+    loss_chunk_size=run_args.loss_chunk_size,
+    async_eval=async_eval,
+    async_eval_metric=run_args.async_eval_metric,
+    proxy_eval_dataset=proxy_eval_dataset,
+    topic_cache=(
+        TopicClusterCache(
+            max_entries=run_args.topic_cache_size,
+            refresh_steps=run_args.topic_refresh_steps,
+            drift_threshold=run_args.topic_drift_threshold,
+        )
+        if run_args.topic_cache_size > 0
+        else None
+    ),
 )
 trainer.train()
 
@@ -193,6 +549,8 @@ predict_results = trainer.predict(
     num_beams=6,
     length_penalty=1.0,
     no_repeat_ngram_size=3,
+    decoder_kv_cache=StaticKVCache(max_length=80) if run_args.static_kv_cache else None,
+    decoder_share_encoder_outputs=run_args.share_encoder_outputs,
 )
 
 # Check the metric scores of predict
@@ -0,0 +1,376 @@
+import json
+import random
+import resource
+import sys
+import time
+from dataclasses import dataclass, field, replace
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+from transformers import BartConfig, HfArgumentParser
+
+from contrastive import (
+    segment_mean_pool_padded,
+    span_first_token_ids,
+    speaker_aware_loss,
+    topic_aware_loss,
+)
+from dialogue_data import DialogueSpec, extract_dialogue_spans, pad_spans
+from kv_cache import StaticKVCache
+from modeling_bart import BartForConditionalGeneration
+from sparse_attention import TurnSparseSpec
+
+
+@dataclass
+class BenchmarkArguments:
+    output_file: Optional[str] = field(default=None, metadata={"help": "결과 JSON 저장 경로"})
+    baseline_file: Optional[str] = field(
+        default=None, metadata={"help": "설정하면 baseline JSON과 p50 latency를 비교"}
+    )
+    # baseline 대비 p50이 (1 + regression_threshold)배보다 느리면 regression
+    regression_threshold: float = field(default=0.1)
+    only: Optional[str] = field(
+        default=None, metadata={"help": "실행할 benchmark 이름 (콤마 구분)"}
+    )
+    repeats: int = field(default=20)
+    warmup: int = field(default=3)
+    batch_size: int = field(default=4)
+    num_turns: int = field(default=16)
+    num_speakers: int = field(default=3)
+    utterance_length: int = field(default=12)
+    summary_length: int = field(default=24)
+    d_model: int = field(default=64)
+    num_layers: int = field(default=2)
+    vocab_size: int = field(default=1000)
+    num_beams: int = field(default=4)
+    seed: int = field(default=0)
+    num_threads: Optional[int] = field(default=None)
+    # static shape (ctr_static) benchmark의 span table turn 수 bucket
+    turn_bucket: int = field(default=8)
+    # torch.compile한 static train step 추가 (torch>=2.0)
+    compile: bool = field(default=False)
+    # static forward를 torch._dynamo.explain으로 확인해서 graph break가 있으면 exit code 1 (torch>=2.1)
+    check_graph_breaks: bool = field(default=False)
+    # 긴 Dialogue encoder benchmark(full / block-sparse attention)의 turn 수 (batch 크기 1)
+    long_num_turns: int = field(default=256)
+    # benchmark마다 한 번 더 실행해서 할당한 CPU memory 총량(alloc_mb)을 torch.profiler로 측정
+    profile_memory: bool = field(default=False)
+
+
+# 작은 random BartConfig (마지막 두 token id를 <sep>, ":"로 사용)
+def tiny_config(args: BenchmarkArguments) -> BartConfig:
+    config = BartConfig(
+        vocab_size=args.vocab_size,
+        d_model=args.d_model,
+        encoder_layers=args.num_layers,
+        decoder_layers=args.num_layers,
+        encoder_attention_heads=4,
+        decoder_attention_heads=4,
+        encoder_ffn_dim=args.d_model * 2,
+        decoder_ffn_dim=args.d_model * 2,
+        max_position_embeddings=1024,
+        forced_bos_token_id=None,
+        forced_eos_token_id=None,
+    )
+    DialogueSpec(
+        sep_token_id=args.vocab_size - 2, speaker_end_token_id=args.vocab_size - 1
+    ).save_to_config(config)
+    return config
+
+
+# <s> (<sep> Speaker : utterance ...) </s> 형식의 random Dialogue
+def synthetic_dialogue(
+    args: BenchmarkArguments, config: BartConfig, rng: random.Random
+) -> List[int]:
+    spec = DialogueSpec.from_config(config)
+    speaker_ids = [10 + speaker for speaker in range(args.num_speakers)]
+    input_ids = [config.bos_token_id]
+    for _ in range(args.num_turns):
+        input_ids += [spec.sep_token_id, rng.choice(speaker_ids), spec.speaker_end_token_id]
+        num_tokens = rng.randint(max(1, args.utterance_length // 2), args.utterance_length * 3 // 2)
+        input_ids += [rng.randrange(100, args.vocab_size - 2) for _ in range(num_tokens)]
+    return input_ids + [config.eos_token_id]
+
+
+def synthetic_batch(
+    args: BenchmarkArguments, config: BartConfig, span_pad_to_multiple_of: Optional[int] = None
+) -> Dict[str, torch.Tensor]:
+    rng = random.Random(args.seed)
+    spec = DialogueSpec.from_config(config)
+    dialogues = [synthetic_dialogue(args, config, rng) for _ in range(args.batch_size)]
+    max_len = max(len(dialogue) for dialogue in dialogues)
+
+    input_ids = torch.full((args.batch_size, max_len), config.pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    for i, dialogue in enumerate(dialogues):
+        input_ids[i, : len(dialogue)] = torch.tensor(dialogue)
+        attention_mask[i, : len(dialogue)] = 1
+
+    spans = [
+        extract_dialogue_spans(dialogue, spec.sep_token_id, spec.speaker_end_token_id)
+        for dialogue in dialogues
+    ]
+    labels = torch.randint(100, args.vocab_size - 2, (args.batch_size, args.summary_length))
+    return {
+        "input_ids": input_ids,
+        "attention_mask": attention_mask,
+        "labels": labels,
+        "speaker_spans": pad_spans([span[0] for span in spans], span_pad_to_multiple_of),
+        "utterance_spans": pad_spans([span[1] for span in spans], span_pad_to_multiple_of),
+    }
+
+
+# process 전체의 최대 RSS (누적 최댓값이라 benchmark 별 값이 아님 -> 결과 JSON의 suite 단위로만 기록)
+# benchmark 별 memory는 --profile_memory의 alloc_mb 사용
+def peak_rss_mb() -> float:
+    # Linux : KB, macOS : byte
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def time_function(fn: Callable[[], None], repeats: int, warmup: int) -> Dict[str, float]:
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        "mean_ms": float(np.mean(latencies)),
+        "min_ms": float(np.min(latencies)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p90_ms": float(np.percentile(latencies, 90)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+# fn 한 번 실행 중 operator들이 할당한 CPU memory 총량 (MB, 해제량은 빼지 않음)
+def allocated_mb(fn: Callable[[], None]) -> float:
+    with torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True
+    ) as prof:
+        fn()
+    total = sum(max(event.self_cpu_memory_usage, 0) for event in prof.events())
+    return total / 2**20
+
+
+# fn을 CPU bfloat16 autocast 안에서 실행
+def bf16_autocast(fn: Callable[[], None]) -> Callable[[], None]:
+    def run():
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            fn()
+
+    return run
+
+
+# benchmark 이름 -> 실행 함수
+def build_benchmarks(args: BenchmarkArguments) -> Dict[str, Callable[[], None]]:
+    config = tiny_config(args)
+    spec = DialogueSpec.from_config(config)
+    model = BartForConditionalGeneration(config)
+    batch = synthetic_batch(args, config)
+    input_id_lists = [
+        ids[mask.bool()].tolist() for ids, mask in zip(batch["input_ids"], batch["attention_mask"])
+    ]
+
+    with torch.no_grad():
+        enc_hidden = model.get_encoder()(
+            input_ids=batch["input_ids"], attention_mask=batch["attention_mask"]
+        ).last_hidden_state
+    enc_speaker, _ = segment_mean_pool_padded(enc_hidden, batch["speaker_spans"])
+    speaker_ids = span_first_token_ids(batch["input_ids"], batch["speaker_spans"])
+    enc_utterance, utterance_mask = segment_mean_pool_padded(enc_hidden, batch["utterance_spans"])
+
+    def span_extraction():
+        spans = [
+            extract_dialogue_spans(ids, spec.sep_token_id, spec.speaker_end_token_id)
+            for ids in input_id_lists
+        ]
+        pad_spans([span[0] for span in spans])
+        pad_spans([span[1] for span in spans])
+
+    def segment_pooling():
+        segment_mean_pool_padded(enc_hidden, batch["speaker_spans"])
+        segment_mean_pool_padded(enc_hidden, batch["utterance_spans"])
+
+    def train_step(ctr_mode, step_model=model, step_batch=batch, **loss_kwargs):
+        def step():
+            step_model.train()
+            step_model.zero_grad(set_to_none=True)
+            outputs = step_model(**step_batch, ctr_mode=ctr_mode, ctr_batch=True, **loss_kwargs)
+            (outputs.loss + 0.08 * outputs.ctr_loss).backward()
+
+        return step
+
+    def generate(**gen_kwargs):
+        model.eval()
+        with torch.no_grad():
+            model.generate(
+                input_ids=batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                max_length=args.summary_length,
+                num_beams=args.num_beams,
+                no_repeat_ngram_size=3,
+                **gen_kwargs,
+            )
+
+    benchmarks = {
+        "span_extraction": span_extraction,
+        "segment_pooling": segment_pooling,
+        "speaker_aware": lambda: speaker_aware_loss(enc_speaker, speaker_ids, 1),
+        "topic_aware_kmeans": lambda: topic_aware_loss(enc_utterance, utterance_mask, 1, 0),
+        "topic_aware_sequential": lambda: topic_aware_loss(enc_utterance, utterance_mask, 1, 1),
+    }
+    for ctr_mode, name in enumerate(["baseline", "speaker", "topic", "multi"]):
+        benchmarks[f"train_step_{name}"] = train_step(ctr_mode)
+    # label-smoothed loss를 chunk 단위로 계산 (full logits 없음)
+    benchmarks["train_step_chunked_loss"] = train_step(0, loss_chunk_size=8, label_smoothing=0.1)
+    # 고정 shape Contrastive loss (eager / torch.compile)
+    static_batch = synthetic_batch(args, config, span_pad_to_multiple_of=args.turn_bucket)
+    benchmarks["train_step_static_eager"] = train_step(3, step_batch=static_batch, ctr_static=True)
+    if args.compile and hasattr(torch, "compile"):
+        benchmarks["train_step_static_compiled"] = train_step(
+            3, step_model=torch.compile(model), step_batch=static_batch, ctr_static=True
+        )
+    benchmarks["generate"] = generate
+    kv_cache = StaticKVCache(args.summary_length)
+    benchmarks["generate_static_kv_cache"] = lambda: generate(decoder_kv_cache=kv_cache)
+    benchmarks["generate_shared_encoder"] = lambda: generate(decoder_share_encoder_outputs=True)
+    # bf16 autocast (같은 이름의 float32 benchmark와 비교)
+    benchmarks["train_step_multi_bf16"] = bf16_autocast(benchmarks["train_step_multi"])
+    benchmarks["generate_bf16"] = bf16_autocast(generate)
+
+    # Speaker-turn block-sparse encoder attention
+    # Contrastive loss 포함 train step, 긴 Dialogue encoder (dense attention과 비교)
+    sparse_config = tiny_config(args)
+    TurnSparseSpec(window_turns=1, max_block_size=32).save_to_config(sparse_config)
+    sparse_model = BartForConditionalGeneration(sparse_config)
+    benchmarks["train_step_multi_turn_sparse"] = train_step(3, step_model=sparse_model)
+
+    long_batch = synthetic_batch(replace(args, batch_size=1, num_turns=args.long_num_turns), config)
+    long_model = BartForConditionalGeneration(tiny_config(args)).eval()
+    long_model.set_turn_sparse_attention(None, max_positions=long_batch["input_ids"].shape[1])
+
+    def long_encoder(spec):
+        def run():
+            long_model.set_turn_sparse_attention(spec)
+            with torch.no_grad():
+                long_model.get_encoder()(
+                    input_ids=long_batch["input_ids"], attention_mask=long_batch["attention_mask"]
+                )
+
+        return run
+
+    benchmarks["encoder_long_dense"] = long_encoder(None)
+    benchmarks["encoder_long_turn_sparse"] = long_encoder(TurnSparseSpec())
+    return benchmarks
+
+
+# torch._dynamo.explain(fn)(*inputs) -> ExplainOutput 형식은 torch>=2.1
+def supports_dynamo_explain() -> bool:
+    major, minor = (int(v) for v in torch.__version__.split("+")[0].split(".")[:2])
+    return (major, minor) >= (2, 1)
+
+
+# ctr_static forward(ctr_mode=3)의 graph break 수와 이유
+def explain_graph_breaks(args: BenchmarkArguments) -> Dict:
+    import torch._dynamo
+
+    config = tiny_config(args)
+    # transformers 4.27의 layerdrop 검사(random.uniform(0, 1) < layerdrop)는 train mode에서
+    # graph break -> eval mode로 trace (dropout 외에는 train mode와 같은 graph)
+    model = BartForConditionalGeneration(config).eval()
+    static_batch = synthetic_batch(args, config, span_pad_to_multiple_of=args.turn_bucket)
+
+    def forward(**inputs):
+        return model(**inputs, ctr_mode=3, ctr_batch=True, ctr_static=True).loss
+
+    explanation = torch._dynamo.explain(forward)(**static_batch)
+    return {
+        "graph_count": explanation.graph_count,
+        "graph_break_count": explanation.graph_break_count,
+        "break_reasons": [str(reason.reason) for reason in explanation.break_reasons],
+    }
+
+
+# *_bf16 benchmark와 float32 benchmark의 p50 latency / 할당량 비율 (bf16 / float32)
+def bf16_comparison(results: Dict) -> Dict[str, Dict[str, float]]:
+    comparison = {}
+    for name, result in results["benchmarks"].items():
+        if not name.endswith("_bf16") or name[: -len("_bf16")] not in results["benchmarks"]:
+            continue
+        fp32_result = results["benchmarks"][name[: -len("_bf16")]]
+        comparison[name] = {"p50_ratio": result["p50_ms"] / max(fp32_result["p50_ms"], 1e-9)}
+        if "alloc_mb" in result:
+            comparison[name]["alloc_ratio"] = result["alloc_mb"] / max(
+                fp32_result["alloc_mb"], 1e-9
+            )
+        print(f"{name:<28} bf16 / fp32 : {comparison[name]}")
+    return comparison
+
+
+# baseline 대비 p50 latency가 threshold 이상 느려진 benchmark 목록
+def compare_results(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        ratio = result["p50_ms"] / max(baseline["benchmarks"][name]["p50_ms"], 1e-9)
+        status = "REGRESSION" if ratio > 1 + threshold else "ok"
+        print(f"{name:<28} {ratio:6.2f}x  {status}")
+        if status == "REGRESSION":
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = HfArgumentParser(BenchmarkArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+
+    torch.manual_seed(args.seed)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    benchmarks = build_benchmarks(args)
+    if args.only:
+        benchmarks = {name: benchmarks[name] for name in args.only.split(",")}
+
+    results = {"config": vars(args), "torch_version": torch.__version__, "benchmarks": {}}
+    for name, fn in benchmarks.items():
+        results["benchmarks"][name] = time_function(fn, args.repeats, args.warmup)
+        if args.profile_memory:
+            results["benchmarks"][name]["alloc_mb"] = allocated_mb(fn)
+        print(f"{name:<28} p50 {results['benchmarks'][name]['p50_ms']:9.2f} ms")
+    results["peak_rss_mb"] = peak_rss_mb()
+    results["bf16_vs_fp32"] = bf16_comparison(results)
+
+    graph_breaks = None
+    if args.check_graph_breaks:
+        if not supports_dynamo_explain():
+            raise ValueError(f"--check_graph_breaks requires torch>=2.1, found {torch.__version__}")
+        graph_breaks = explain_graph_breaks(args)
+        results["graph_breaks"] = graph_breaks
+        print(f"graph breaks : {graph_breaks['graph_break_count']}")
+
+    if args.output_file:
+        with open(args.output_file, "w") as writer:
+            json.dump(results, writer, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline_file:
+        with open(args.baseline_file) as reader:
+            baseline = json.load(reader)
+        regressions = compare_results(results, baseline, args.regression_threshold)
+        if regressions:
+            print(f"regressions : {', '.join(regressions)}")
+            sys.exit(1)
+    if graph_breaks is not None and graph_breaks["graph_break_count"] > 0:
+        print("\n".join(graph_breaks["break_reasons"]))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
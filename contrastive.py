@@ -0,0 +1,365 @@
+import functools
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from torch import nn
+
+from dialogue_data import SPAN_PAD
+
+
+# bf16 / fp16 autocast 중에도 Contrastive loss는 float32로 계산
+# (bf16은 유효 자릿수가 8bit라서 거리 차이 / margin / 중복 횟수 cumsum이 뭉개짐)
+# 16bit 실수 tensor 인자를 float32로 올리고 그 device의 autocast를 끈 채로 fn 실행
+# (float32 / float64 입력은 그대로)
+def float32_math(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        args = [_to_float32(value) for value in args]
+        kwargs = {key: _to_float32(value) for key, value in kwargs.items()}
+        # generator / next()는 torch.compile(dynamo)의 graph break -> for loop로 첫 tensor의 device
+        device_type = "cpu"
+        for value in (*args, *kwargs.values()):
+            if torch.is_tensor(value):
+                device_type = value.device.type
+                break
+        with torch.autocast(device_type, enabled=False):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def _to_float32(value):
+    if torch.is_tensor(value) and value.dtype in (torch.float16, torch.bfloat16):
+        return value.float()
+    return value
+
+
+# Batch 전체의 span을 한 번의 bmm(segment-reduce)으로 Mean Pooling
+# hidden_states : [batch, seq_len, d_model], spans : [batch, turns, 2] (SPAN_PAD로 padding)
+# return : pooled [batch, turns, d_model], segment_mask [batch, turns]
+def segment_mean_pool_padded(
+    hidden_states: torch.Tensor, spans: torch.LongTensor
+) -> Tuple[torch.Tensor, torch.BoolTensor]:
+    positions = torch.arange(hidden_states.shape[1], device=hidden_states.device)
+    segment_mask = spans[..., 0] != SPAN_PAD
+    token_mask = (
+        (positions >= spans[..., 0:1]) & (positions < spans[..., 1:2]) & segment_mask.unsqueeze(-1)
+    )
+
+    weights = token_mask.to(hidden_states.dtype)
+    pooled = torch.bmm(weights, hidden_states) / weights.sum(-1, keepdim=True).clamp(min=1)
+    return pooled, segment_mask
+
+
+# 각 span 첫 token의 id (Speaker 구분용), padding 자리는 SPAN_PAD
+def span_first_token_ids(input_ids: torch.LongTensor, spans: torch.LongTensor) -> torch.LongTensor:
+    first_token_ids = input_ids.gather(1, spans[..., 0].clamp(min=0, max=input_ids.shape[1] - 1))
+    return first_token_ids.masked_fill(spans[..., 0] == SPAN_PAD, SPAN_PAD)
+
+
+# positive / negative L2 거리 pair의 margin loss
+# softmax([1 - positive, 1 - negative]) 의 (positive - negative) = tanh((negative - positive) / 2)
+def pairwise_margin_loss(
+    positive_l2: torch.Tensor, negative_l2: torch.Tensor, ctr_margin: float
+) -> torch.Tensor:
+    return torch.relu(ctr_margin - torch.tanh((negative_l2 - positive_l2) / 2))
+
+
+# BartModel.speaker_aware의 Batch / 행렬 연산 버전
+# enc_speaker : [batch, turns, d_model], speaker_ids : [batch, turns] (Speaker 첫 token id, SPAN_PAD padding)
+# return : anchor_loss [batch, turns], anchor_mask [batch, turns]
+#   anchor_loss[b][anchor_mask[b]] == BartModel.speaker_aware의 결과 (anchor_mask[b]가 모두 False면 zeros(1))
+@float32_math
+def speaker_aware_loss(
+    enc_speaker: torch.Tensor, speaker_ids: torch.LongTensor, ctr_margin: float
+) -> Tuple[torch.Tensor, torch.BoolTensor]:
+    batch_size, num_turn, _ = enc_speaker.shape
+    turn_mask = speaker_ids != SPAN_PAD
+    if num_turn < 2:
+        return enc_speaker.new_zeros(batch_size, num_turn), torch.zeros_like(turn_mask)
+
+    turn_idx = torch.arange(num_turn, device=enc_speaker.device)
+    same_speaker = (
+        (speaker_ids.unsqueeze(2) == speaker_ids.unsqueeze(1))
+        & turn_mask.unsqueeze(2)
+        & turn_mask.unsqueeze(1)
+    )
+
+    # anchor(bench_speaker) : 1 ~ (unique speaker 수 - 1) 번째 turn
+    seen_before = torch.tril(same_speaker, diagonal=-1).any(-1)
+    num_speaker_unique = (turn_mask & ~seen_before).sum(-1)
+    anchor_mask = (turn_idx >= 1) & (turn_idx.unsqueeze(0) < num_speaker_unique.unsqueeze(1))
+    candidate = (turn_mask & (turn_idx >= 1)).unsqueeze(1).to(enc_speaker.dtype)
+
+    # 기존 구현에서는 positive / negative list가 anchor마다 누적되므로
+    # anchor a의 grid에서 turn i의 중복 횟수 = 1 ~ a 번째 anchor 중 같은(다른) speaker인 anchor 수
+    is_anchor = (turn_idx >= 1).view(1, num_turn, 1)
+    positive_count = torch.cumsum((same_speaker & is_anchor).to(enc_speaker.dtype), dim=1)
+    positive_count = positive_count * candidate
+    num_anchor = turn_idx.to(enc_speaker.dtype).view(1, num_turn, 1)
+    negative_count = num_anchor * candidate - positive_count
+
+    # l2[b, a, i] = || enc_speaker[b, i] - enc_speaker[b, a] ||
+    l2 = torch.cdist(enc_speaker, enc_speaker, compute_mode="donot_use_mm_for_euclid_dist")
+    pair_loss = pairwise_margin_loss(l2.unsqueeze(-1), l2.unsqueeze(-2), ctr_margin)
+    pair_weight = positive_count.unsqueeze(-1) * negative_count.unsqueeze(-2)
+    num_pair = positive_count.sum(-1) * negative_count.sum(-1)
+    anchor_loss = (pair_loss * pair_weight).sum((-1, -2)) / num_pair.clamp(min=1)
+
+    # 첫 anchor에서 negative가 없으면 기존 구현은 zeros(1)을 반환
+    anchor_mask = anchor_mask & (negative_count[:, 1].sum(-1) > 0).unsqueeze(-1)
+    return anchor_loss, anchor_mask
+
+
+# k-means++ 초기화 (Dialogue 별로 독립)
+# points : [batch, turns, d], mask : [batch, turns] -> centroids : [batch, num_cluster, d]
+def kmeans_plusplus_init(
+    points: torch.Tensor, mask: torch.BoolTensor, num_cluster: int
+) -> torch.Tensor:
+    batch_size, _, d_model = points.shape
+    # utterance가 없는 Dialogue는 (결과를 쓰지 않으므로) 아무 점이나 선택
+    uniform = mask.to(points.dtype) + (~mask.any(-1, keepdim=True)).to(points.dtype)
+
+    chosen = torch.multinomial(uniform, 1)
+    centroids = [points.gather(1, chosen.unsqueeze(-1).expand(batch_size, 1, d_model))]
+    min_sq_dist = (points - centroids[0]).pow(2).sum(-1)
+    for _ in range(1, num_cluster):
+        # 가장 가까운 centroid까지의 거리^2에 비례하는 확률로 다음 centroid 선택
+        prob = min_sq_dist * mask
+        prob = torch.where(prob.sum(-1, keepdim=True) > 0, prob, uniform)
+        chosen = torch.multinomial(prob, 1)
+        centroid = points.gather(1, chosen.unsqueeze(-1).expand(batch_size, 1, d_model))
+        centroids.append(centroid)
+        min_sq_dist = torch.minimum(min_sq_dist, (points - centroid).pow(2).sum(-1))
+    return torch.cat(centroids, dim=1)
+
+
+# 여러 Dialogue의 utterance representation을 한 번에 k-means (k-means++ 초기화 + Lloyd)
+# points : [batch, turns, d], mask : [batch, turns]
+# return : centroids [batch, num_cluster, d], labels [batch, turns] (padding 자리는 -1)
+# early_stop=False : label 수렴 여부를 확인하지 않고 max_iter번 반복 (torch.compile용, 수렴 후에는 결과 동일)
+@torch.no_grad()
+def batched_kmeans(
+    points: torch.Tensor,
+    mask: torch.BoolTensor,
+    num_cluster: int = 2,
+    max_iter: int = 100,
+    init_centroids: Optional[torch.Tensor] = None,
+    early_stop: bool = True,
+) -> Tuple[torch.Tensor, torch.LongTensor]:
+    points = points.detach().float()
+    if init_centroids is None:
+        centroids = kmeans_plusplus_init(points, mask, num_cluster)
+    else:
+        centroids = init_centroids.detach().float()
+
+    labels = torch.cdist(points, centroids).argmin(-1)
+    for _ in range(max_iter):
+        one_hot = nn.functional.one_hot(labels, num_cluster).to(points.dtype) * mask.unsqueeze(-1)
+        counts = one_hot.sum(1).unsqueeze(-1)
+        # 빈 cluster는 이전 centroid 유지
+        centroids = torch.where(
+            counts > 0, torch.bmm(one_hot.transpose(1, 2), points) / counts.clamp(min=1), centroids
+        )
+        new_labels = torch.cdist(points, centroids).argmin(-1)
+        if early_stop and torch.equal(
+            new_labels.masked_fill(~mask, 0), labels.masked_fill(~mask, 0)
+        ):
+            break
+        labels = new_labels
+    return centroids, labels.masked_fill(~mask, -1)
+
+
+# cluster 기준 Topic-Aware margin loss
+# positive : 같은 cluster의 utterance (cluster의 첫 번째 utterance 제외), negative : 다른 cluster의 utterance
+# enc_utterance : [batch, turns, d], labels : [batch, turns], centroids : [batch, num_cluster, d]
+# return : bench_loss [batch, num_cluster], bench_mask [batch, num_cluster] (positive / negative가 모두 있는 cluster)
+def cluster_margin_loss(
+    enc_utterance: torch.Tensor,
+    turn_mask: torch.BoolTensor,
+    labels: torch.LongTensor,
+    centroids: torch.Tensor,
+    ctr_margin: float,
+) -> Tuple[torch.Tensor, torch.BoolTensor]:
+    num_cluster = centroids.shape[1]
+    cluster_idx = torch.arange(num_cluster, device=labels.device).view(1, num_cluster, 1)
+    in_cluster = (labels.unsqueeze(1) == cluster_idx) & turn_mask.unsqueeze(1)
+    positive = in_cluster & (in_cluster.cumsum(-1) > 1)
+    negative = turn_mask.unsqueeze(1) & ~in_cluster
+
+    # l2[b, c, i] = || enc_utterance[b, i] - centroids[b, c] ||
+    l2 = torch.cdist(
+        centroids.to(enc_utterance.dtype),
+        enc_utterance,
+        compute_mode="donot_use_mm_for_euclid_dist",
+    )
+    pair_loss = pairwise_margin_loss(l2.unsqueeze(-1), l2.unsqueeze(-2), ctr_margin)
+    pair_weight = (positive.unsqueeze(-1) & negative.unsqueeze(-2)).to(pair_loss.dtype)
+    num_pair = positive.sum(-1) * negative.sum(-1)
+    bench_loss = (pair_loss * pair_weight).sum((-1, -2)) / num_pair.clamp(min=1)
+    return bench_loss, num_pair > 0
+
+
+# BartModel.topic_aware의 Batch 버전
+# enc_utterance : [batch, turns, d], turn_mask : [batch, turns]
+# cluster_mode 0 : k-means (2 cluster), 1 : Dialogue 앞 / 뒤 절반 (Sequential)
+# return : bench_loss [batch, 2], bench_mask [batch, 2]
+#   bench_loss[b][bench_mask[b]] == BartModel.topic_aware의 결과 (bench_mask[b]가 모두 False면 zeros(1))
+# cluster_cache / example_index가 있으면 k-means 결과를 Dialogue 별로 cache해서 재사용
+@float32_math
+def topic_aware_loss(
+    enc_utterance: torch.Tensor,
+    turn_mask: torch.BoolTensor,
+    ctr_margin: float,
+    cluster_mode: int = 0,
+    example_index: Optional[torch.LongTensor] = None,
+    cluster_cache: Optional["TopicClusterCache"] = None,
+    kmeans_max_iter: int = 100,
+    kmeans_early_stop: bool = True,
+) -> Tuple[torch.Tensor, torch.BoolTensor]:
+    batch_size, num_turn, _ = enc_utterance.shape
+    num_cluster = 2
+    num_valid_turn = turn_mask.sum(-1)
+    if num_turn < 3:
+        bench_loss = enc_utterance.new_zeros(batch_size, num_cluster)
+        return bench_loss, torch.zeros_like(bench_loss, dtype=torch.bool)
+
+    if cluster_mode == 0 and cluster_cache is not None and example_index is not None:
+        centroids, labels = cluster_cache.cluster(
+            example_index.tolist(), enc_utterance, turn_mask, num_cluster=num_cluster
+        )
+    elif cluster_mode == 0:
+        centroids, labels = batched_kmeans(
+            enc_utterance,
+            turn_mask,
+            num_cluster=num_cluster,
+            max_iter=kmeans_max_iter,
+            early_stop=kmeans_early_stop,
+        )
+    elif cluster_mode == 1:
+        turn_idx = torch.arange(num_turn, device=enc_utterance.device)
+        labels = (turn_idx.unsqueeze(0) >= (num_valid_turn // 2).unsqueeze(1)).long()
+        centroid_idx = torch.stack(
+            [num_valid_turn // 4, num_valid_turn // 2 + num_valid_turn // 4], dim=1
+        ).clamp(max=num_turn - 1)
+        centroids = enc_utterance.gather(
+            1, centroid_idx.unsqueeze(-1).expand(-1, -1, enc_utterance.shape[-1])
+        )
+    else:
+        raise ValueError(f"Unknown cluster_mode : {cluster_mode}")
+
+    bench_loss, bench_mask = cluster_margin_loss(
+        enc_utterance, turn_mask, labels, centroids, ctr_margin
+    )
+    if cluster_mode == 0:
+        # k-means는 한 cluster라도 positive / negative가 없으면 zeros(1)
+        bench_mask = bench_mask & bench_mask.all(-1, keepdim=True)
+    bench_mask = bench_mask & (num_valid_turn >= 3).unsqueeze(-1)
+    return bench_loss, bench_mask
+
+
+@dataclass
+class _ClusterCacheEntry:
+    centroids: torch.Tensor
+    mean: torch.Tensor
+    num_turn: int
+    step: int
+
+
+# Dialogue(dataset example index) 별 k-means 결과 cache
+# - 처음 보는 Dialogue, refresh_steps가 지난 Dialogue, representation 평균이 drift_threshold보다 많이
+#   변한 Dialogue는 k-means++부터 다시 clustering
+# - 나머지는 cache된 centroid에서 Lloyd iteration만 이어서 진행 (warm-start)
+# - max_entries를 넘으면 가장 오래 사용하지 않은 Dialogue부터 제거 (LRU)
+# global_step은 Trainer가 매 step 갱신
+class TopicClusterCache:
+    def __init__(
+        self, max_entries: int = 4096, refresh_steps: int = 100, drift_threshold: float = 0.1
+    ):
+        self.max_entries = max_entries
+        self.refresh_steps = refresh_steps
+        self.drift_threshold = drift_threshold
+        self.global_step = 0
+        self.entries = OrderedDict()
+        self.hits, self.misses, self.refreshes, self.evictions = 0, 0, 0, 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses + self.refreshes
+        return {
+            "topic_cache_hits": self.hits,
+            "topic_cache_misses": self.misses,
+            "topic_cache_refreshes": self.refreshes,
+            "topic_cache_evictions": self.evictions,
+            "topic_cache_size": len(self.entries),
+            "topic_cache_hit_rate": self.hits / max(lookups, 1),
+        }
+
+    # batched_kmeans와 같은 입출력, example_index : Dialogue 별 dataset index (list of int)
+    @torch.no_grad()
+    def cluster(
+        self,
+        example_index: List[int],
+        points: torch.Tensor,
+        mask: torch.BoolTensor,
+        num_cluster: int = 2,
+    ) -> Tuple[torch.Tensor, torch.LongTensor]:
+        points = points.detach().float()
+        num_turn = mask.sum(-1)
+        mean = (points * mask.unsqueeze(-1)).sum(1) / num_turn.clamp(min=1).unsqueeze(-1)
+        init_centroids = points.new_zeros(points.shape[0], num_cluster, points.shape[-1])
+
+        num_turn = num_turn.tolist()
+        cached_rows = [
+            row
+            for row, idx in enumerate(example_index)
+            if idx in self.entries
+            and self.entries[idx].num_turn == num_turn[row]
+            and self.entries[idx].centroids.shape == init_centroids[row].shape
+        ]
+        warm_rows = []
+        if cached_rows:
+            entries = [self.entries[example_index[row]] for row in cached_rows]
+            cached_mean = torch.stack([entry.mean for entry in entries])
+            drift = (mean[cached_rows] - cached_mean).norm(dim=-1)
+            drift = drift / cached_mean.norm(dim=-1).clamp(min=1e-6)
+            for row, entry, row_drift in zip(cached_rows, entries, drift.tolist()):
+                fresh = self.global_step - entry.step < self.refresh_steps
+                if fresh and row_drift <= self.drift_threshold:
+                    warm_rows.append(row)
+                    init_centroids[row] = entry.centroids
+
+        # k-means++ 초기화는 warm-start하지 않는 Dialogue(처음 / refresh)만
+        warm = set(warm_rows)
+        cold_rows = [row for row in range(len(example_index)) if row not in warm]
+        if cold_rows:
+            init_centroids[cold_rows] = kmeans_plusplus_init(
+                points[cold_rows], mask[cold_rows], num_cluster
+            )
+
+        self.hits += len(warm_rows)
+        self.refreshes += len(cached_rows) - len(warm_rows)
+        self.misses += len(example_index) - len(cached_rows)
+
+        centroids, labels = batched_kmeans(
+            points, mask, num_cluster=num_cluster, init_centroids=init_centroids
+        )
+
+        for row, idx in enumerate(example_index):
+            # warm-start한 Dialogue는 마지막으로 k-means++부터 clustering한 step과 기준 평균을 유지
+            previous = self.entries.pop(idx, None)
+            reuse = row in warm and previous is not None
+            self.entries[idx] = _ClusterCacheEntry(
+                centroids=centroids[row].clone(),
+                mean=previous.mean if reuse else mean[row].clone(),
+                num_turn=num_turn[row],
+                step=previous.step if reuse else self.global_step,
+            )
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return centroids, labels
@@ -0,0 +1,382 @@
+import glob
+import json
+import random
+import re
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, Sampler, get_worker_info
+from transformers import DataCollatorForSeq2Seq
+
+# padded span table의 빈 자리 값 (start, end 모두 SPAN_PAD)
+SPAN_PAD = -1
+SPAN_KEYS = ("speaker_spans", "utterance_spans")
+
+# Turn 구분 token, Speaker 끝 token (tokenizer에 additional_special_tokens로 추가)
+DIALOGUE_SPECIAL_TOKENS = ["<sep>", ":"]
+
+# 기존 English(BART) tokenizer의 all_special_ids에서 <sep>의 위치
+DEFAULT_LANG_SEP = 5
+
+
+# Dialogue 구조(<sep> / ":") token id
+# BartConfig.dialogue_spec에 저장되어 checkpoint와 함께 저장 / 복원됨
+@dataclass
+class DialogueSpec:
+    sep_token_id: int
+    speaker_end_token_id: int
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer) -> "DialogueSpec":
+        sep_token_id, speaker_end_token_id = tokenizer.convert_tokens_to_ids(
+            DIALOGUE_SPECIAL_TOKENS
+        )
+        if tokenizer.unk_token_id in (sep_token_id, speaker_end_token_id):
+            raise ValueError(
+                f"Tokenizer has no {DIALOGUE_SPECIAL_TOKENS} tokens. "
+                "Add them with `tokenizer.add_special_tokens` first."
+            )
+        return cls(sep_token_id=sep_token_id, speaker_end_token_id=speaker_end_token_id)
+
+    @classmethod
+    def from_special_ids(cls, all_special_ids: List[int], lang_sep: int = DEFAULT_LANG_SEP):
+        return cls(
+            sep_token_id=all_special_ids[lang_sep],
+            speaker_end_token_id=all_special_ids[lang_sep + 1],
+        )
+
+    @classmethod
+    def from_config(cls, config) -> Optional["DialogueSpec"]:
+        spec = getattr(config, "dialogue_spec", None)
+        return cls(**spec) if spec is not None else None
+
+    def save_to_config(self, config) -> None:
+        config.dialogue_spec = asdict(self)
+
+
+# "Speaker: Utterance\r\nSpeaker: Utterance" -> "<sep>Speaker: Utterance<sep>Speaker: Utterance"
+def format_dialogue(dialogue: str) -> str:
+    return "<sep>" + re.sub("\r\n", "<sep>", dialogue)
+
+
+# bart_trainer.preprocess_function의 tokenization (<sep> 형식 Dialogue -> input_ids, summary -> labels)
+# + Speaker / Utterance span (summaries가 None이면 labels 없음)
+def tokenize_dialogues(
+    tokenizer,
+    dialogues: List[str],
+    summaries: Optional[List[str]],
+    dialogue_spec: DialogueSpec,
+    max_source_length: int = 1024,
+    max_target_length: int = 128,
+) -> Dict[str, List]:
+    model_inputs = tokenizer(
+        [format_dialogue(dialogue) for dialogue in dialogues],
+        max_length=max_source_length,
+        truncation=True,
+    )
+    if summaries is not None:
+        labels = tokenizer(text_target=summaries, max_length=max_target_length, truncation=True)
+        model_inputs["labels"] = labels["input_ids"]
+
+    spans = [
+        extract_dialogue_spans(
+            input_ids, dialogue_spec.sep_token_id, dialogue_spec.speaker_end_token_id
+        )
+        for input_ids in model_inputs["input_ids"]
+    ]
+    model_inputs["speaker_spans"] = [speaker_spans for speaker_spans, _ in spans]
+    model_inputs["utterance_spans"] = [utterance_spans for _, utterance_spans in spans]
+    return model_inputs
+
+
+# JSONL / Parquet 파일을 chunk_size개의 record(dict) list 단위로 읽음 (파일 전체를 올리지 않음)
+def iter_dialogue_records(
+    path: str, chunk_size: int, columns: Optional[List[str]] = None
+) -> Iterator[List[Dict[str, Any]]]:
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        if columns:
+            columns = [column for column in columns if column in parquet_file.schema_arrow.names]
+        for record_batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield record_batch.to_pylist()
+        return
+
+    chunk = []
+    with open(path, encoding="utf-8") as reader:
+        for line in reader:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            chunk.append({key: record.get(key) for key in columns} if columns else record)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+# Dialogue의 token ids에서 Speaker / Utterance span을 한 번에 계산
+# speaker span : <sep> 다음 token ~ 첫 ":" 직전
+# utterance span : <sep> + 3 ~ 다음 <sep> 직전 (마지막 utterance는 제외)
+def extract_dialogue_spans(
+    input_ids: List[int], sep_token_id: int, speaker_end_token_id: int
+) -> Tuple[List[List[int]], List[List[int]]]:
+    num_tokens = len(input_ids)
+
+    # next_speaker_end[i] : i 이후(포함) 처음 나오는 ":"의 위치, 없으면 num_tokens
+    next_speaker_end = [num_tokens] * (num_tokens + 1)
+    for idx in range(num_tokens - 1, -1, -1):
+        if input_ids[idx] == speaker_end_token_id:
+            next_speaker_end[idx] = idx
+        else:
+            next_speaker_end[idx] = next_speaker_end[idx + 1]
+
+    sep_idx = [idx for idx, ids in enumerate(input_ids) if ids == sep_token_id]
+    speaker_spans = [[idx + 1, next_speaker_end[idx]] for idx in sep_idx]
+    utterance_spans = [
+        [start + 3, end] for start, end in zip(sep_idx[:-1], sep_idx[1:]) if (start + 3) < end
+    ]
+    return speaker_spans, utterance_spans
+
+
+# list of span lists -> [batch, max_turns, 2] LongTensor (빈 자리는 SPAN_PAD)
+# pad_to_multiple_of : max_turns를 배수로 올림 (torch.compile에서 turn 수 bucket 별로만 다시 compile)
+def pad_spans(
+    spans: List[List[List[int]]], pad_to_multiple_of: Optional[int] = None
+) -> torch.LongTensor:
+    max_turns = max([len(span) for span in spans] + [1])
+    if pad_to_multiple_of is not None:
+        max_turns = -(-max_turns // pad_to_multiple_of) * pad_to_multiple_of
+    padded = torch.full((len(spans), max_turns, 2), SPAN_PAD, dtype=torch.long)
+    for i, span in enumerate(spans):
+        if len(span) > 0:
+            padded[i, : len(span)] = torch.tensor(span, dtype=torch.long)
+    return padded
+
+
+# DataCollatorForSeq2Seq + speaker_spans / utterance_spans padding, example_index
+# span_pad_to_multiple_of : span table의 turn 수를 배수로 padding (pad_to_multiple_of와 함께 static shape용)
+@dataclass
+class DataCollatorForDialogueSeq2Seq(DataCollatorForSeq2Seq):
+    span_pad_to_multiple_of: Optional[int] = None
+
+    def __call__(self, features: List[Dict[str, Any]], return_tensors: Optional[str] = None):
+        extra_keys = SPAN_KEYS + ("example_index",)
+        extra = {
+            key: [feature[key] for feature in features] for key in extra_keys if key in features[0]
+        }
+        features = [
+            {key: value for key, value in feature.items() if key not in extra_keys}
+            for feature in features
+        ]
+
+        batch = super().__call__(features, return_tensors=return_tensors)
+        for key in SPAN_KEYS:
+            if key in extra:
+                batch[key] = pad_spans(extra[key], self.span_pad_to_multiple_of)
+        if "example_index" in extra:
+            batch["example_index"] = torch.tensor(extra["example_index"], dtype=torch.long)
+        return batch
+
+
+# 길이가 긴 순서로 정렬한 index (길이가 같으면 원래 순서 유지)
+def length_sorted_order(lengths: List[int]) -> List[int]:
+    return sorted(range(len(lengths)), key=lambda idx: -lengths[idx])
+
+
+# 비슷한 길이의 Dialogue끼리 묶어서 (max_len x batch_size) <= max_tokens가 되도록 batch 구성
+# - 전체 index를 shuffle -> bucket_size 단위로 나눠 bucket 안에서 길이 순 정렬 -> token budget으로 batch 분할
+# - 완성된 batch의 순서를 다시 shuffle (bucket 간 shuffle)
+# - num_replicas / rank : 분산 학습에서 rank 별로 batch를 나눔 (DistributedSampler 역할)
+# Trainer가 set_epoch를 호출하지 않으므로 __iter__가 끝날 때마다 epoch를 1 증가
+class TokenBudgetBatchSampler(Sampler):
+    def __init__(
+        self,
+        lengths: List[int],
+        max_tokens: int,
+        max_batch_size: Optional[int] = None,
+        bucket_size: int = 1024,
+        shuffle: bool = True,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ):
+        if max_tokens < max(lengths):
+            raise ValueError(
+                f"max_tokens({max_tokens}) must be >= the longest example ({max(lengths)} tokens)"
+            )
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+        self._batches = None
+
+    def _build_batches(self) -> List[List[int]]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        num_examples = len(self.lengths)
+        indices = rng.permutation(num_examples) if self.shuffle else np.arange(num_examples)
+
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start : start + self.bucket_size]
+            bucket = [int(bucket[idx]) for idx in length_sorted_order(self.lengths[bucket])]
+
+            batch, batch_max_len = [], 0
+            for idx in bucket:
+                max_len = max(batch_max_len, self.lengths[idx])
+                full = max_len * (len(batch) + 1) > self.max_tokens or (
+                    self.max_batch_size is not None and len(batch) >= self.max_batch_size
+                )
+                if full:
+                    batches.append(batch)
+                    batch, max_len = [], self.lengths[idx]
+                batch.append(idx)
+                batch_max_len = max_len
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[idx] for idx in rng.permutation(len(batches))]
+        # 분산 학습 : 모든 rank가 같은 seed로 같은 batch 목록을 만들고 rank 번째 batch들만 사용
+        # (rank마다 step 수가 같도록 나머지 batch는 버림)
+        if self.num_replicas > 1:
+            num_batches = len(batches) // self.num_replicas * self.num_replicas
+            batches = batches[self.rank : num_batches : self.num_replicas]
+        return batches
+
+    @property
+    def batches(self) -> List[List[int]]:
+        if self._batches is None:
+            self._batches = self._build_batches()
+        return self._batches
+
+    # padding token 수 / (padding 포함) 전체 token 수
+    def padding_ratio(self) -> float:
+        total, real = 0, 0
+        for batch in self.batches:
+            batch_lengths = [self.lengths[idx] for idx in batch]
+            total += max(batch_lengths) * len(batch)
+            real += sum(batch_lengths)
+        return float(1 - real / max(total, 1))
+
+    def __iter__(self):
+        batches = self.batches
+        self.set_epoch(self.epoch + 1)
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+
+# 콤마로 구분한 파일 경로 / glob pattern -> 정렬된 파일 목록
+def expand_data_files(patterns: str) -> List[str]:
+    files = []
+    for pattern in patterns.split(","):
+        matched = sorted(glob.glob(pattern.strip()))
+        if not matched:
+            raise FileNotFoundError(f"No files match {pattern!r}")
+        files += matched
+    return files
+
+
+# 로컬 JSONL / Parquet Dialogue 파일을 읽으면서 tokenize하는 IterableDataset (corpus 크기와 무관한 memory)
+# - 파일을 chunk_size개 record 단위로 읽고, DataLoader worker마다 다른 chunk를 tokenize (worker 수만큼 병렬)
+# - tokenization은 preprocess_function과 동일 (tokenize_dialogues : <sep> 형식, Speaker / Utterance span)
+# - shuffle_buffer_size개 example을 담은 buffer에서 random하게 꺼내는 bounded shuffle (0이면 파일 순서)
+# - example_index : (self.files 안의 파일 번호, 파일 안의 행 번호)로 정해지는 값 (Topic-Aware cluster cache key)
+#   파일 번호 x STREAM_FILE_STRIDE + 행 번호이므로 epoch마다 파일 순서를 섞어도 같은 Dialogue는 같은 key
+# BartTrainer가 IterableDatasetShard로 감싸서 epoch마다 set_epoch 호출, 분산 학습에서는 rank 별로 batch를 나눔
+class StreamingDialogueDataset(IterableDataset):
+    # 파일 하나의 최대 행 수 (2^40, int64 example_index에 파일 2^23개까지)
+    STREAM_FILE_STRIDE = 1 << 40
+
+    def __init__(
+        self,
+        files: List[str],
+        tokenizer,
+        dialogue_spec: DialogueSpec,
+        max_source_length: int = 1024,
+        max_target_length: int = 128,
+        shuffle_buffer_size: int = 10000,
+        chunk_size: int = 256,
+        dialogue_field: str = "dialogue",
+        summary_field: str = "summary",
+        seed: int = 0,
+    ):
+        self.files = files
+        self.tokenizer = tokenizer
+        self.dialogue_spec = dialogue_spec
+        self.max_source_length = max_source_length
+        self.max_target_length = max_target_length
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.chunk_size = chunk_size
+        self.dialogue_field = dialogue_field
+        self.summary_field = summary_field
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    # worker에 할당된 chunk만 tokenize (파일 순서는 모든 worker / rank가 같음)
+    def _examples(self, worker_id: int, num_workers: int):
+        file_order = list(range(len(self.files)))
+        if self.shuffle_buffer_size > 0:
+            random.Random(f"{self.seed}/{self.epoch}").shuffle(file_order)
+        columns = [self.dialogue_field, self.summary_field]
+        chunk_idx = 0
+        for file_idx in file_order:
+            example_index = file_idx * self.STREAM_FILE_STRIDE
+            for chunk in iter_dialogue_records(self.files[file_idx], self.chunk_size, columns):
+                if chunk_idx % num_workers == worker_id:
+                    model_inputs = tokenize_dialogues(
+                        self.tokenizer,
+                        [record[self.dialogue_field] for record in chunk],
+                        [record[self.summary_field] for record in chunk],
+                        self.dialogue_spec,
+                        max_source_length=self.max_source_length,
+                        max_target_length=self.max_target_length,
+                    )
+                    for idx in range(len(chunk)):
+                        example = {key: value[idx] for key, value in model_inputs.items()}
+                        example["example_index"] = example_index + idx
+                        yield example
+                chunk_idx += 1
+                example_index += len(chunk)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        # seed / epoch / worker만으로 순서가 정해짐 (rank마다 같은 stream, IterableDatasetShard가 batch를 나눔)
+        rng = random.Random(f"{self.seed}/{self.epoch}/{worker_id}")
+
+        examples = self._examples(worker_id, num_workers)
+        if self.shuffle_buffer_size <= 1:
+            yield from examples
+            return
+
+        buffer = []
+        for example in examples:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(example)
+                continue
+            idx = rng.randrange(self.shuffle_buffer_size)
+            yield buffer[idx]
+            buffer[idx] = example
+        rng.shuffle(buffer)
+        yield from buffer
@@ -0,0 +1,280 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+from datasets import load_dataset
+from torch.utils.data import Dataset
+from transformers import AutoTokenizer, HfArgumentParser
+
+from dialogue_data import DIALOGUE_SPECIAL_TOKENS, DialogueSpec, tokenize_dialogues
+
+# shard 파일 형식이 바뀌면 올려서 이전 shard를 다시 만들도록 함
+SHARD_FORMAT_VERSION = 1
+TOKEN_DTYPE = np.int32
+INDEX_DTYPE = np.int64
+
+# flat token / span 배열 (example 별 위치는 index.bin의 offset)
+SHARD_FIELDS = ("input_ids", "labels", "speaker_spans", "utterance_spans")
+# span은 (start, end) 2개 값이 한 항목
+FIELD_WIDTH = {"input_ids": 1, "labels": 1, "speaker_spans": 2, "utterance_spans": 2}
+
+
+# tokenizer(vocab / special token) + tokenization 설정 + data 이름의 hash
+# 하나라도 바뀌면 다른 디렉토리에 shard를 새로 만듦
+def shard_fingerprint(
+    tokenizer,
+    dialogue_spec: DialogueSpec,
+    source: str,
+    max_source_length: int,
+    max_target_length: int,
+) -> str:
+    vocab = json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False)
+    key = {
+        "format_version": SHARD_FORMAT_VERSION,
+        "source": source,
+        "tokenizer_class": type(tokenizer).__name__,
+        "name_or_path": tokenizer.name_or_path,
+        "vocab": hashlib.sha256(vocab.encode("utf-8")).hexdigest(),
+        "special_tokens": tokenizer.all_special_tokens,
+        "dialogue_spec": asdict(dialogue_spec),
+        "max_source_length": max_source_length,
+        "max_target_length": max_target_length,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+# split 하나를 shard 디렉토리에 씀
+# {field}.bin : 모든 Dialogue의 값을 이어 붙인 int32 배열
+# index.bin : [num_examples + 1, 4] int64, field 별 시작 offset (다음 행과의 차이가 길이)
+# meta.json : fingerprint, example 수, field 별 전체 길이
+def write_shard(
+    shard_dir: str,
+    records: Iterable[List[Dict[str, Any]]],
+    tokenizer,
+    dialogue_spec: DialogueSpec,
+    fingerprint: str,
+    max_source_length: int = 1024,
+    max_target_length: int = 128,
+    dialogue_field: str = "dialogue",
+    summary_field: str = "summary",
+) -> int:
+    os.makedirs(shard_dir, exist_ok=True)
+    writers = {name: open(os.path.join(shard_dir, f"{name}.bin"), "wb") for name in SHARD_FIELDS}
+    offsets = [[0] * len(SHARD_FIELDS)]
+    try:
+        for chunk in records:
+            summaries = [record.get(summary_field) for record in chunk]
+            model_inputs = tokenize_dialogues(
+                tokenizer,
+                [record[dialogue_field] for record in chunk],
+                summaries if all(summary is not None for summary in summaries) else None,
+                dialogue_spec,
+                max_source_length=max_source_length,
+                max_target_length=max_target_length,
+            )
+            for idx in range(len(chunk)):
+                row = []
+                for name, offset in zip(SHARD_FIELDS, offsets[-1]):
+                    values = model_inputs[name][idx] if name in model_inputs else []
+                    values = np.asarray(values, dtype=TOKEN_DTYPE).reshape(-1)
+                    writers[name].write(values.tobytes())
+                    row.append(offset + len(values) // FIELD_WIDTH[name])
+                offsets.append(row)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    index = np.asarray(offsets, dtype=INDEX_DTYPE)
+    index.tofile(os.path.join(shard_dir, "index.bin"))
+    meta = {
+        "fingerprint": fingerprint,
+        "num_examples": len(index) - 1,
+        "sizes": {name: int(size) for name, size in zip(SHARD_FIELDS, index[-1])},
+    }
+    with open(os.path.join(shard_dir, "meta.json"), "w") as writer:
+        json.dump(meta, writer, indent=2)
+    return meta["num_examples"]
+
+
+# shard 하나를 memory-map으로 읽는 Dataset (token을 memory로 복사하지 않음)
+# - 여러 DataLoader worker가 같은 page cache를 공유
+# - memmap은 pickle하지 않고 각 process에서 처음 접근할 때 다시 open
+# - __getitem__ : input_ids / labels는 memmap view(int32), span은 [turns, 2] view
+class DialogueShardDataset(Dataset):
+    def __init__(
+        self,
+        shard_dir: str,
+        fingerprint: Optional[str] = None,
+        indices: Optional[np.ndarray] = None,
+    ):
+        with open(os.path.join(shard_dir, "meta.json")) as reader:
+            self.meta = json.load(reader)
+        if fingerprint is not None and self.meta["fingerprint"] != fingerprint:
+            raise ValueError(
+                f"Shard {shard_dir} was built with fingerprint {self.meta['fingerprint']}, "
+                f"expected {fingerprint}. Rebuild it with dialogue_shards.py."
+            )
+        self.shard_dir = shard_dir
+        self.fingerprint = self.meta["fingerprint"]
+        self.indices = indices
+        self._arrays = None
+
+    def _open(self) -> Dict[str, np.ndarray]:
+        if self._arrays is None:
+            arrays = {
+                "index": np.memmap(
+                    os.path.join(self.shard_dir, "index.bin"),
+                    dtype=INDEX_DTYPE,
+                    mode="r",
+                    shape=(self.meta["num_examples"] + 1, len(SHARD_FIELDS)),
+                )
+            }
+            for name in SHARD_FIELDS:
+                size = self.meta["sizes"][name]
+                if size == 0:
+                    arrays[name] = np.zeros((0, FIELD_WIDTH[name]), dtype=TOKEN_DTYPE)
+                    continue
+                arrays[name] = np.memmap(
+                    os.path.join(self.shard_dir, f"{name}.bin"),
+                    dtype=TOKEN_DTYPE,
+                    mode="r",
+                    shape=(size, FIELD_WIDTH[name]),
+                )
+            self._arrays = arrays
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __len__(self) -> int:
+        return self.meta["num_examples"] if self.indices is None else len(self.indices)
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        example_index = int(idx if self.indices is None else self.indices[idx])
+        arrays = self._open()
+        begin, end = arrays["index"][example_index], arrays["index"][example_index + 1]
+        example = {}
+        for column, name in enumerate(SHARD_FIELDS):
+            # summary 없이 만든 shard에는 labels가 없음
+            if name == "labels" and self.meta["sizes"]["labels"] == 0:
+                continue
+            values = arrays[name][begin[column] : end[column]]
+            example[name] = values.reshape(-1) if FIELD_WIDTH[name] == 1 else values
+        # Topic-Aware cluster cache의 key (dataset.map의 with_indices와 같은 값)
+        example["example_index"] = example_index
+        return example
+
+    # input_ids 길이 (token budget batch / 길이 순 정렬용, token을 읽지 않음)
+    @property
+    def lengths(self) -> np.ndarray:
+        index = self._open()["index"]
+        lengths = np.diff(index[:, 0])
+        return lengths if self.indices is None else lengths[self.indices]
+
+    # datasets.Dataset.select와 같은 용도 (memmap 공유, 순서만 바꿈)
+    def select(self, indices: Iterable[int]) -> "DialogueShardDataset":
+        indices = np.asarray(list(indices), dtype=INDEX_DTYPE)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        return DialogueShardDataset(self.shard_dir, indices=indices)
+
+    def __repr__(self) -> str:
+        return (
+            f"DialogueShardDataset(shard_dir={self.shard_dir!r}, "
+            f"num_rows={len(self)}, fingerprint={self.fingerprint!r})"
+        )
+
+
+# dataset["input_ids"]를 읽지 않고 길이를 얻음 (shard dataset이면 index만 읽음)
+def example_lengths(dataset) -> List[int]:
+    if isinstance(dataset, DialogueShardDataset):
+        return dataset.lengths.tolist()
+    return [len(input_ids) for input_ids in dataset["input_ids"]]
+
+
+# shard_dir/{fingerprint}/{split}에 shard가 있으면 열고, 없으면 load_fn()의 DatasetDict로 만든 뒤 열기
+# 만드는 중인 shard는 임시 디렉토리에 쓰고 완성되면 rename (중단된 build를 읽지 않음)
+def load_or_build_shards(
+    shard_dir: str,
+    load_fn: Callable[[], Any],
+    tokenizer,
+    dialogue_spec: DialogueSpec,
+    source: str,
+    max_source_length: int = 1024,
+    max_target_length: int = 128,
+    chunk_size: int = 1000,
+) -> Dict[str, DialogueShardDataset]:
+    fingerprint = shard_fingerprint(
+        tokenizer, dialogue_spec, source, max_source_length, max_target_length
+    )
+    root = os.path.join(shard_dir, fingerprint)
+    if not os.path.exists(root):
+        os.makedirs(shard_dir, exist_ok=True)
+        tmp_root = tempfile.mkdtemp(prefix=f".{fingerprint}-", dir=shard_dir)
+        try:
+            for split, dataset in load_fn().items():
+                records = (
+                    dataset.select(range(start, min(start + chunk_size, len(dataset)))).to_list()
+                    for start in range(0, len(dataset), chunk_size)
+                )
+                num_examples = write_shard(
+                    os.path.join(tmp_root, split),
+                    records,
+                    tokenizer,
+                    dialogue_spec,
+                    fingerprint,
+                    max_source_length=max_source_length,
+                    max_target_length=max_target_length,
+                )
+                print(f"shard {split} : {num_examples} dialogues")
+            if not os.path.exists(root):
+                os.rename(tmp_root, root)
+        finally:
+            shutil.rmtree(tmp_root, ignore_errors=True)
+
+    return {
+        split: DialogueShardDataset(os.path.join(root, split), fingerprint=fingerprint)
+        for split in sorted(os.listdir(root))
+    }
+
+
+@dataclass
+class ShardBuildArguments:
+    model_name: str = field(default="facebook/bart-large", metadata={"help": "tokenizer 이름 / 경로"})
+    data_name: str = field(default="samsum")
+    shard_dir: str = field(default="shards")
+    max_source_length: int = field(default=1024)
+    max_target_length: int = field(default=128)
+    chunk_size: int = field(default=1000)
+
+
+# bart_trainer.py --shard_dir와 같은 tokenizer 설정(<sep> / ":" 추가)으로 shard를 미리 만듦
+def main():
+    parser = HfArgumentParser(ShardBuildArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    tokenizer.add_special_tokens({"additional_special_tokens": DIALOGUE_SPECIAL_TOKENS})
+    shards = load_or_build_shards(
+        args.shard_dir,
+        lambda: load_dataset(args.data_name),
+        tokenizer,
+        DialogueSpec.from_tokenizer(tokenizer),
+        source=args.data_name,
+        max_source_length=args.max_source_length,
+        max_target_length=args.max_target_length,
+        chunk_size=args.chunk_size,
+    )
+    for split, dataset in shards.items():
+        print(f"{split} : {dataset}")
+
+
+if __name__ == "__main__":
+    main()
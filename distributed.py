@@ -0,0 +1,160 @@
+import json
+import os
+import socket
+import sys
+import tempfile
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Optional, Union
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from transformers import HfArgumentParser
+
+from benchmark import BenchmarkArguments, synthetic_batch, tiny_config
+from dialogue_data import SPAN_PAD
+from modeling_bart import BartForConditionalGeneration
+
+
+def world_size() -> int:
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size()
+    return 1
+
+
+# rank 별 평균(local_mean, 항목 local_count개) -> 전체 rank의 항목 평균
+# DDP는 gradient를 rank 수로 나누므로 local 합 x world_size / 전체 항목 수를 반환
+# (Contrastive loss는 Dialogue 수, cross entropy는 label token 수가 rank마다 달라도
+#  1-process 학습과 같은 gradient)
+def global_example_mean(
+    local_mean: torch.Tensor, local_count: Union[int, torch.Tensor]
+) -> torch.Tensor:
+    num_replicas = world_size()
+    if num_replicas == 1:
+        return local_mean
+    count = torch.as_tensor(local_count, dtype=torch.float, device=local_mean.device)
+    global_count = count.detach().clone()
+    dist.all_reduce(global_count)
+    return local_mean * count * num_replicas / global_count.clamp(min=1)
+
+
+@dataclass
+class DistributedCheckArguments:
+    world_size: int = field(default=2, metadata={"help": "비교할 process 수 (batch_size의 약수)"})
+    batch_size: int = field(default=4)
+    ctr_mode: int = field(default=3)
+    # Sequential clustering (k-means++ 초기화는 rank마다 random 값이 달라서 제외)
+    cluster_mode: int = field(default=1)
+    lamda: float = field(default=0.08)
+    seed: int = field(default=0)
+    # 1-process / world_size-process gradient의 최대 절대 오차 허용값
+    atol: float = field(default=1e-5)
+    output_file: Optional[str] = field(default=None, metadata={"help": "결과 JSON 저장 경로"})
+
+
+# i 번째 Dialogue의 label을 (i + 1) / batch 비율 길이만 남기고 -100으로 padding (in-place)
+def variable_length_labels(labels: torch.LongTensor) -> torch.LongTensor:
+    batch_size, max_length = labels.shape
+    for idx in range(batch_size):
+        labels[idx, max(1, (idx + 1) * max_length // batch_size) :] = -100
+    return labels
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# rank 하나 : 같은 seed의 작은 model을 DDP(gloo)로 감싸고 batch의 rank 번째 shard로 backward
+# rank 0이 (DDP가 평균한) gradient를 result_file에 저장
+def _gradient_worker(
+    rank: int,
+    args: DistributedCheckArguments,
+    num_replicas: int,
+    port: int,
+    aggregate: bool,
+    result_file: str,
+) -> None:
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=num_replicas)
+    torch.manual_seed(args.seed)
+
+    bench_args = BenchmarkArguments(batch_size=args.batch_size, seed=args.seed)
+    config = tiny_config(bench_args)
+    # dropout 없이 비교 (eval mode에서도 Contrastive loss는 계산됨)
+    model = BartForConditionalGeneration(config).eval()
+    batch = synthetic_batch(bench_args, config)
+    # 첫 Dialogue는 Speaker span 1개 -> rank마다 Contrastive loss를 계산하는 Dialogue 수가 다름
+    batch["speaker_spans"][0, 1:] = SPAN_PAD
+    # 요약문 길이가 Dialogue마다 다름 -> rank마다 cross entropy의 label token 수가 다름
+    variable_length_labels(batch["labels"])
+
+    shard_size = args.batch_size // num_replicas
+    shard = {
+        key: value[rank * shard_size : (rank + 1) * shard_size] for key, value in batch.items()
+    }
+    ddp_model = DistributedDataParallel(model)
+    outputs = ddp_model(
+        **shard, ctr_mode=args.ctr_mode, cluster_mode=args.cluster_mode, ctr_batch=True
+    )
+    loss, ctr_loss = outputs.loss, outputs.ctr_loss
+    if aggregate:
+        loss = global_example_mean(loss, (shard["labels"] != -100).sum())
+        ctr_loss = global_example_mean(ctr_loss, outputs.ctr_num_examples)
+    (loss + args.lamda * ctr_loss).backward()
+
+    if rank == 0:
+        gradients = {
+            name: param.grad for name, param in model.named_parameters() if param.grad is not None
+        }
+        torch.save(gradients, result_file)
+    dist.destroy_process_group()
+
+
+def _gradients(
+    args: DistributedCheckArguments, num_replicas: int, aggregate: bool = True
+) -> Dict[str, torch.Tensor]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_file = os.path.join(tmp_dir, "gradients.pt")
+        mp.spawn(
+            _gradient_worker,
+            args=(args, num_replicas, _free_port(), aggregate, result_file),
+            nprocs=num_replicas,
+        )
+        return torch.load(result_file)
+
+
+def _max_abs_diff(expected: Dict[str, torch.Tensor], actual: Dict[str, torch.Tensor]) -> float:
+    return max(float((expected[name] - actual[name]).abs().max()) for name in expected)
+
+
+# 1-process와 world_size-process(gloo, CPU) 학습의 gradient 비교 (tests/test_distributed.py와 같음)
+# global_example_mean을 쓰면 같아야 하고, rank 별 평균(loss / ctr_loss 그대로)은 달라짐
+def main():
+    parser = HfArgumentParser(DistributedCheckArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+    if args.batch_size % args.world_size != 0:
+        raise ValueError(f"batch_size({args.batch_size}) must be divisible by world_size")
+
+    single = _gradients(args, 1)
+    report = {
+        "config": asdict(args),
+        "max_abs_diff": _max_abs_diff(single, _gradients(args, args.world_size)),
+        "max_abs_diff_rank_mean": _max_abs_diff(
+            single, _gradients(args, args.world_size, aggregate=False)
+        ),
+    }
+    report["passed"] = report["max_abs_diff"] <= args.atol
+    print(json.dumps(report, indent=2))
+    if args.output_file:
+        with open(args.output_file, "w") as writer:
+            json.dump(report, writer, indent=2)
+    if not report["passed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+import torch
+from torch import nn
+from transformers.models.bart.modeling_bart import BartAttention
+
+
+# beam search용 decoder self-attention key / value cache
+# - layer 별 [batch x beams, heads, max_length, head_dim] buffer를 미리 할당하고 새 token의 key / value를
+#   write cursor(= 지금까지의 길이) 위치에 in-place로 씀 (torch.cat으로 매 step 재할당하지 않음)
+# - past_key_values는 buffer의 [:, :, :cursor] view, cross-attention key / value는 그대로 유지
+# - beam 순서 변경은 지금까지 쓴 [:cursor] 구간만 두 번째 buffer로 index_select(out=) 후 buffer를 교체
+#   (double buffer, step 당 복사량은 max_length가 아니라 cursor에 비례)
+# 사용법 : model.generate(..., decoder_kv_cache=StaticKVCache(max_length))
+class StaticKVCache:
+    def __init__(self, max_length: int):
+        self.max_length = max_length
+        self.buffers: List[Optional[torch.Tensor]] = []
+        self.spare_buffers: List[Optional[torch.Tensor]] = []
+
+    # buffer : [2 (key, value), batch x beams, heads, max_length, head_dim]
+    def _buffer(self, layer_idx: int, key_states: torch.Tensor) -> torch.Tensor:
+        while len(self.buffers) <= layer_idx:
+            self.buffers.append(None)
+            self.spare_buffers.append(None)
+        bsz, num_heads, _, head_dim = key_states.shape
+        shape = (2, bsz, num_heads, self.max_length, head_dim)
+        buffer = self.buffers[layer_idx]
+        if buffer is None or buffer.shape != shape or buffer.dtype != key_states.dtype:
+            buffer = key_states.new_empty(shape)
+            self.buffers[layer_idx] = buffer
+            self.spare_buffers[layer_idx] = torch.empty_like(buffer)
+        return buffer
+
+    # 새 key / value를 position부터 쓰고 [:, :, :position + 새 token 수] view 반환
+    def write(
+        self, layer_idx: int, position: int, key_states: torch.Tensor, value_states: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        end = position + key_states.shape[2]
+        if end > self.max_length:
+            raise ValueError(f"StaticKVCache is full (max_length={self.max_length}, needed {end})")
+        buffer = self._buffer(layer_idx, key_states)
+        buffer[0, :, :, position:end] = key_states
+        buffer[1, :, :, position:end] = value_states
+        return buffer[0, :, :, :end], buffer[1, :, :, :end]
+
+    # BartForConditionalGeneration._reorder_cache와 같은 결과
+    # self-attention : 쓴 구간([:length])만 beam_idx 순서로 spare buffer에 gather 후 교체
+    # cross-attention : 그대로
+    def reorder(self, past_key_values: Tuple, beam_idx: torch.LongTensor) -> Tuple:
+        length = past_key_values[0][0].shape[2]
+        reordered_past = ()
+        for layer_idx, layer_past in enumerate(past_key_values):
+            buffer, spare = self.buffers[layer_idx], self.spare_buffers[layer_idx]
+            torch.index_select(
+                buffer[:, :, :, :length], 1, beam_idx, out=spare[:, :, :, :length]
+            )
+            self.buffers[layer_idx], self.spare_buffers[layer_idx] = spare, buffer
+            reordered_past += ((spare[0, :, :, :length], spare[1, :, :, :length]) + layer_past[2:],)
+        return reordered_past
+
+    # forward 동안만 decoder self-attention이 이 cache에 쓰도록 연결
+    @contextmanager
+    def attached(self, decoder: nn.Module):
+        layers = [layer.self_attn for layer in decoder.layers]
+        for layer_idx, self_attn in enumerate(layers):
+            self_attn.kv_cache, self_attn.layer_idx = self, layer_idx
+        try:
+            yield self
+        finally:
+            for self_attn in layers:
+                self_attn.kv_cache = None
+
+
+# kv_cache가 연결되어 있으면 past key / value에 torch.cat 대신 StaticKVCache.write를 사용하는 BartAttention
+# (연결되어 있지 않거나 cross-attention이면 BartAttention과 동일)
+class StaticCacheBartAttention(BartAttention):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.kv_cache: Optional[StaticKVCache] = None
+        self.layer_idx = 0
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        key_value_states: Optional[torch.Tensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        layer_head_mask: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+    ):
+        if self.kv_cache is None or key_value_states is not None:
+            return super().forward(
+                hidden_states,
+                key_value_states=key_value_states,
+                past_key_value=past_key_value,
+                attention_mask=attention_mask,
+                layer_head_mask=layer_head_mask,
+                output_attentions=output_attentions,
+            )
+
+        bsz, tgt_len, _ = hidden_states.size()
+        position = 0 if past_key_value is None else past_key_value[0].shape[2]
+        key_states, value_states = self.kv_cache.write(
+            self.layer_idx,
+            position,
+            self._shape(self.k_proj(hidden_states), -1, bsz),
+            self._shape(self.v_proj(hidden_states), -1, bsz),
+        )
+        past_key_value = (key_states, value_states)
+
+        # 이하 BartAttention.forward와 동일 (buffer view는 batch / head 차원만 합치므로 view 가능)
+        proj_shape = (bsz * self.num_heads, -1, self.head_dim)
+        query_states = self._shape(self.q_proj(hidden_states) * self.scaling, tgt_len, bsz)
+        query_states = query_states.view(*proj_shape)
+        key_states = key_states.view(*proj_shape)
+        value_states = value_states.view(*proj_shape)
+        src_len = key_states.size(1)
+
+        attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
+        if attention_mask is not None:
+            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len) + attention_mask
+            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+        attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+
+        if layer_head_mask is not None:
+            attn_weights = layer_head_mask.view(1, -1, 1, 1) * attn_weights.view(
+                bsz, self.num_heads, tgt_len, src_len
+            )
+            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+
+        attn_weights_reshaped = None
+        if output_attentions:
+            attn_weights_reshaped = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+
+        attn_probs = nn.functional.dropout(attn_weights, p=self.dropout, training=self.training)
+        attn_output = torch.bmm(attn_probs, value_states)
+        attn_output = attn_output.view(bsz, self.num_heads, tgt_len, self.head_dim)
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, self.embed_dim)
+        return self.out_proj(attn_output), attn_weights_reshaped, past_key_value
+
+
+# Dialogue 하나의 encoder output / cross-attention key, value를 여러 beam이 공유하는 cross-attention
+# hidden_states가 [batch x beams, tgt_len, d]이고 key_value_states가 [batch, src_len, d]이면
+# query를 [batch, beams x tgt_len, d]로 묶어서 BartAttention으로 계산한 뒤 원래 shape로 되돌림
+# (query 위치마다 독립적인 attention이므로 encoder output을 beam 수만큼 복사한 결과와 같음)
+class BeamSharedCrossAttention(BartAttention):
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        key_value_states: Optional[torch.Tensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        layer_head_mask: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+    ):
+        bsz, tgt_len, embed_dim = hidden_states.size()
+        if key_value_states is None or key_value_states.shape[0] == bsz:
+            return super().forward(
+                hidden_states,
+                key_value_states=key_value_states,
+                past_key_value=past_key_value,
+                attention_mask=attention_mask,
+                layer_head_mask=layer_head_mask,
+                output_attentions=output_attentions,
+            )
+
+        num_dialogue = key_value_states.shape[0]
+        num_beams = bsz // num_dialogue
+        hidden_states = hidden_states.reshape(num_dialogue, num_beams * tgt_len, embed_dim)
+        if attention_mask is not None:
+            # encoder padding mask는 query 위치와 무관
+            attention_mask = attention_mask[:, :, :1].expand(-1, -1, num_beams * tgt_len, -1)
+        attn_output, attn_weights, past_key_value = super().forward(
+            hidden_states,
+            key_value_states=key_value_states,
+            past_key_value=past_key_value,
+            attention_mask=attention_mask,
+            layer_head_mask=layer_head_mask,
+            output_attentions=output_attentions,
+        )
+
+        attn_output = attn_output.reshape(bsz, tgt_len, embed_dim)
+        if attn_weights is not None:
+            attn_weights = attn_weights.view(
+                num_dialogue, self.num_heads, num_beams, tgt_len, -1
+            ).transpose(1, 2)
+            attn_weights = attn_weights.reshape(bsz, self.num_heads, tgt_len, -1)
+        return attn_output, attn_weights, past_key_value
@@ -0,0 +1,99 @@
+import itertools
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+from transformers import HfArgumentParser
+
+from dialogue_data import iter_dialogue_records
+
+
+@dataclass
+class LoadGeneratorArguments:
+    input_file: str = field(metadata={"help": "요청으로 보낼 Dialogue JSONL 또는 Parquet 파일"})
+    url: str = field(default="http://127.0.0.1:8000", metadata={"help": "serve.py 주소"})
+    # 설정하면 같은 부하를 이 주소에도 보내서 비교 (예 : --max_batch_size 1로 띄운 serve.py)
+    compare_url: Optional[str] = field(default=None)
+    dialogue_field: str = field(default="dialogue")
+    # 보낼 요청 수 (Dialogue가 모자라면 처음부터 반복)
+    num_requests: int = field(default=256)
+    # 동시에 요청을 보내는 client 수
+    concurrency: int = field(default=32)
+    timeout: float = field(default=600.0)
+    output_file: Optional[str] = field(default=None, metadata={"help": "결과 JSON 저장 경로"})
+
+
+def _request(url: str, payload: Optional[Dict] = None, timeout: float = 600.0) -> Dict:
+    data = None if payload is None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+# concurrency개 client가 Dialogue 하나씩 POST /summarize를 보내고 client 쪽 latency / 처리량 측정
+# 끝난 뒤 serve.py의 /metrics (batch 크기 histogram, server 쪽 latency)를 같이 반환
+def run_load(url: str, dialogues: List[str], args: LoadGeneratorArguments) -> Dict:
+    def send(dialogue: str) -> float:
+        start = time.perf_counter()
+        _request(f"{url}/summarize", {"dialogue": dialogue}, timeout=args.timeout)
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = list(executor.map(send, dialogues))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "url": url,
+        "num_requests": len(dialogues),
+        "elapsed_sec": round(elapsed, 3),
+        "dialogues_per_sec": round(len(dialogues) / elapsed, 3),
+        "latency_ms": {
+            "p50": round(float(np.percentile(latencies, 50)), 3),
+            "p99": round(float(np.percentile(latencies, 99)), 3),
+        },
+        "server_metrics": _request(f"{url}/metrics", timeout=args.timeout),
+    }
+
+
+def main():
+    parser = HfArgumentParser(LoadGeneratorArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+
+    records = itertools.chain.from_iterable(
+        iter_dialogue_records(args.input_file, 1024, columns=[args.dialogue_field])
+    )
+    dialogues = [record[args.dialogue_field] for record in records]
+    if not dialogues:
+        raise ValueError(f"No dialogues in {args.input_file}")
+    dialogues = list(itertools.islice(itertools.cycle(dialogues), args.num_requests))
+
+    report = {"config": asdict(args), "results": [run_load(args.url, dialogues, args)]}
+    if args.compare_url:
+        report["results"].append(run_load(args.compare_url, dialogues, args))
+        # url / compare_url 처리량 비율 (compare_url이 요청마다 generate하는 server이면 batching 효과)
+        report["speedup"] = round(
+            report["results"][0]["dialogues_per_sec"] / report["results"][1]["dialogues_per_sec"],
+            3,
+        )
+    for result in report["results"]:
+        print(
+            f"{result['url']} : {result['dialogues_per_sec']:.2f} dialogues/sec, "
+            f"p50 {result['latency_ms']['p50']:.1f} ms, p99 {result['latency_ms']['p99']:.1f} ms"
+        )
+    if "speedup" in report:
+        print(f"speedup : {report['speedup']:.2f}x")
+
+    if args.output_file:
+        with open(args.output_file, "w") as writer:
+            json.dump(report, writer, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
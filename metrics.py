@@ -0,0 +1,126 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from rouge_score import rouge_scorer
+
+ROUGE_TYPES = ["rouge1", "rouge2", "rougeL", "rougeLsum"]
+
+
+# pretokenize()로 만든 "token token\ntoken" 문자열을 다시 token list로 나누는 tokenizer
+# (rougeLsum은 rouge_score가 "\n" 기준으로 문장을 나눈 뒤 문장마다 tokenize)
+class _PretokenizedTokenizer:
+    def tokenize(self, text: str) -> List[str]:
+        return text.split()
+
+
+# pair : (prediction, reference), 각각 pretokenize()의 (전체 문자열 token, 줄 단위 token)
+def _score_pairs(pairs: List[Tuple[Tuple[str, str], Tuple[str, str]]]) -> List[Dict[str, float]]:
+    tokenizer = _PretokenizedTokenizer()
+    scorer = rouge_scorer.RougeScorer(ROUGE_TYPES[:3], tokenizer=tokenizer)
+    lsum_scorer = rouge_scorer.RougeScorer(["rougeLsum"], tokenizer=tokenizer)
+    scores = []
+    for (prediction, prediction_lines), (reference, reference_lines) in pairs:
+        score = scorer.score(reference, prediction)
+        score.update(lsum_scorer.score(reference_lines, prediction_lines))
+        scores.append({key: score[key].fmeasure for key in ROUGE_TYPES})
+    return scores
+
+
+# fast tokenizer의 batch API로 한 번에 tokenize (tokenizer.tokenize(text)와 같은 token)
+# rouge_score에 tokenizer.tokenize를 넘긴 것과 같은 입력이 되도록 두 가지로 tokenize
+# - rouge1/2/L : 전체 문자열 (줄바꿈 token "Ċ" 등 포함), token은 " "으로 이어 붙임
+# - rougeLsum : 줄 단위 (rouge_score가 "\n"으로 나눈 문장마다 tokenize), 줄은 "\n"으로 이어 붙임
+def pretokenize(tokenizer, texts: List[str]) -> List[Tuple[str, str]]:
+    if not texts:
+        return []
+    lines = [text.split("\n") for text in texts]
+    flat_lines = [line for text_lines in lines for line in text_lines]
+
+    encodings = tokenizer(texts + flat_lines, add_special_tokens=False).encodings
+    tokens = [" ".join(encoding.tokens) for encoding in encodings]
+    line_tokens = iter(tokens[len(texts) :])
+    return [
+        (text_tokens, "\n".join(next(line_tokens) for _ in text_lines))
+        for text_tokens, text_lines in zip(tokens, lines)
+    ]
+
+
+# Seq2SeqTrainer의 compute_metrics
+# - predictions / labels를 한 번씩 batch_decode, batch tokenize
+# - ROUGE-1/2/L/Lsum을 process pool에서 Dialogue 단위로 계산해서 평균
+# - 생성 요약문과 Dialogue 별 점수는 stdout 대신 output_dir/predictions-{n}.jsonl에 저장
+# - restore_order : 길이 순으로 정렬한 dataset을 평가할 때 원래 순서로 되돌리는 index
+#   (설정하면 predictions-{n}.jsonl을 원래 dataset 순서로 저장)
+class RougeMetric:
+    def __init__(
+        self,
+        tokenizer,
+        output_dir: Optional[str] = None,
+        num_workers: Optional[int] = None,
+        chunk_size: int = 64,
+        restore_order: Optional[np.ndarray] = None,
+    ):
+        self.tokenizer = tokenizer
+        self.output_dir = output_dir
+        self.num_workers = num_workers if num_workers is not None else min(os.cpu_count() or 1, 8)
+        self.chunk_size = chunk_size
+        self.restore_order = restore_order
+        self.num_calls = 0
+
+    # with 안에서만 restore_order를 설정 (길이 순으로 정렬한 dataset의 evaluate / predict)
+    @contextmanager
+    def original_order(self, restore_order: np.ndarray):
+        self.restore_order = restore_order
+        try:
+            yield self
+        finally:
+            self.restore_order = None
+
+    def score(self, predictions: List[str], references: List[str]) -> List[Dict[str, float]]:
+        pairs = list(
+            zip(pretokenize(self.tokenizer, predictions), pretokenize(self.tokenizer, references))
+        )
+        chunks = [pairs[i : i + self.chunk_size] for i in range(0, len(pairs), self.chunk_size)]
+
+        # bart_trainer.py는 script이므로 worker는 spawn이 아닌 fork로 생성
+        if self.num_workers <= 1 or len(chunks) <= 1 or not hasattr(os, "fork"):
+            return [score for chunk in chunks for score in _score_pairs(chunk)]
+        with ProcessPoolExecutor(
+            max_workers=min(self.num_workers, len(chunks)),
+            mp_context=multiprocessing.get_context("fork"),
+        ) as executor:
+            return [score for scores in executor.map(_score_pairs, chunks) for score in scores]
+
+    def write_predictions(self, predictions, references, scores) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"predictions-{self.num_calls}.jsonl")
+        with open(path, "w", encoding="utf-8") as writer:
+            for prediction, reference, score in zip(predictions, references, scores):
+                record = {"prediction": prediction, "reference": reference, **score}
+                writer.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def __call__(self, eval_pred) -> Dict[str, float]:
+        predictions, labels = eval_pred
+        pad_token_id = self.tokenizer.pad_token_id
+        predictions = np.where(predictions != -100, predictions, pad_token_id)
+        labels = np.where(labels != -100, labels, pad_token_id)
+        decoded_preds = self.tokenizer.batch_decode(predictions, skip_special_tokens=True)
+        decoded_labels = self.tokenizer.batch_decode(labels, skip_special_tokens=True)
+
+        scores = self.score(decoded_preds, decoded_labels)
+        if self.output_dir is not None:
+            if self.restore_order is not None:
+                decoded_preds = [decoded_preds[idx] for idx in self.restore_order]
+                decoded_labels = [decoded_labels[idx] for idx in self.restore_order]
+                scores = [scores[idx] for idx in self.restore_order]
+            self.write_predictions(decoded_preds, decoded_labels, scores)
+        self.num_calls += 1
+
+        result = {key: np.mean([score[key] for score in scores]) for key in ROUGE_TYPES}
+        result["gen_len"] = np.mean(np.count_nonzero(predictions != pad_token_id, axis=-1))
+        return {k: round(float(v), 4) for k, v in result.items()}
@@ -1,26 +1,21 @@
-from typing import List, Optional, Tuple, Union
-import random
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
 import torch
 from torch import nn
 from torch.nn import CrossEntropyLoss
-from sklearn.cluster import KMeans
-import numpy as np
-import pandas as pd
-import datasets
+from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from transformers.utils import logging
 from transformers.utils import (
     add_end_docstrings,
     replace_return_docstrings,
 )
-from transformers import AutoTokenizer
 from transformers.models.bart.modeling_bart import (
     BartPretrainedModel,
     BaseModelOutput,
     Seq2SeqModelOutput,
     Seq2SeqLMOutput,
     BartConfig,
-    BartEncoder,
     BartDecoder,
     BART_INPUTS_DOCSTRING,
     _CHECKPOINT_FOR_DOC,
@@ -31,54 +26,68 @@ from transformers.models.bart.modeling_bart import (
     add_code_sample_docstrings,
     add_start_docstrings_to_model_forward,
 )
-from dataclasses import dataclass, field
-from transformers import Seq2SeqTrainingArguments, HfArgumentParser
+from dataclasses import dataclass
+
+from contrastive import (
+    segment_mean_pool_padded,
+    span_first_token_ids,
+    speaker_aware_loss,
+    TopicClusterCache,
+    topic_aware_loss,
+)
+from dialogue_data import SPAN_PAD, DialogueSpec, extract_dialogue_spans, pad_spans
+from kv_cache import BeamSharedCrossAttention, StaticCacheBartAttention, StaticKVCache
+from profiling import PhaseProfiler
+from sparse_attention import TurnSparseBartEncoder, TurnSparseSpec, extend_position_embeddings
 
+if TYPE_CHECKING:
+    import datasets
 
-@dataclass
-class RunArguments:
-    model_name: str = field(default="facebook/bart-large")
-    data_name: str = field(default="samsum")
-    ctr_mode: str = field(default="baseline")
-    lamda: Optional[float] = field(default=0.08)
-    batch_size: int = field(default=8)
-    set_seed: int = field(default=100)
-
-
-# arguements parser from shell
-parser = HfArgumentParser((Seq2SeqTrainingArguments, RunArguments))
-training_args, run_args = parser.parse_args_into_dataclasses()
-
-# arguments from shell
-if run_args.ctr_mode == "baseline":
-    ctr_mode = 0
-elif run_args.ctr_mode == "speaker":
-    ctr_mode = 1
-elif run_args.ctr_mode == "topic":
-    ctr_mode = 2
-elif run_args.ctr_mode == "multi":
-    ctr_mode = 3
-lamda = run_args.lamda
-model_name = run_args.model_name
-batch_size = run_args.batch_size
-set_seed = run_args.set_seed
-cluster_mode = 0
-
-device = torch.device("cuda")
-print(f"device : {device}")
-print("Current cuda device:", torch.cuda.current_device())
-print("Count of using GPUs:", torch.cuda.device_count())
 logger = logging.get_logger(__name__)
 
-# seed fix
-seed = set_seed
-random.seed(seed)
 
-# PyTorch seed fix
-torch.manual_seed(seed)
+# chunk 하나의 (nll 합, -log_prob vocab 합), padding(-100) 자리는 0
+def _label_smoothed_chunk_sums(hidden_states, weight, bias, labels):
+    log_probs = F.log_softmax(F.linear(hidden_states, weight).float() + bias.float(), dim=-1)
+    padding_mask = labels.eq(-100)
+    nll_loss = -log_probs.gather(-1, labels.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+    smoothed_loss = -log_probs.sum(-1)
+    return torch.stack(
+        [
+            nll_loss.masked_fill(padding_mask, 0.0).sum(),
+            smoothed_loss.masked_fill(padding_mask, 0.0).sum(),
+        ]
+    )
+
+
+# lm_head + final_logits_bias + label-smoothed cross entropy를 sequence 방향 chunk 단위로 계산
+# transformers LabelSmoother와 같은 값 : (1 - eps) * nll 평균 + eps * (-log_prob 합) / (token 수 * vocab)
+# chunk의 logits는 checkpoint로 backward 때 다시 계산하므로 [batch, seq_len, vocab] logits를 저장하지 않음
+def chunked_label_smoothed_loss(
+    hidden_states: torch.Tensor,
+    weight: torch.Tensor,
+    bias: torch.Tensor,
+    labels: torch.LongTensor,
+    epsilon: float = 0.0,
+    chunk_size: int = 16,
+) -> torch.Tensor:
+    sums = hidden_states.new_zeros(2, dtype=torch.float32)
+    for start in range(0, labels.shape[1], chunk_size):
+        chunk = (
+            hidden_states[:, start : start + chunk_size],
+            weight,
+            bias,
+            labels[:, start : start + chunk_size],
+        )
+        if torch.is_grad_enabled():
+            sums = sums + checkpoint(_label_smoothed_chunk_sums, *chunk, use_reentrant=False)
+        else:
+            sums = sums + _label_smoothed_chunk_sums(*chunk)
 
-# NumPy seed fix
-np.random.seed(seed)
+    num_active_elements = labels.ne(-100).sum()
+    nll_loss = sums[0] / num_active_elements
+    smoothed_loss = sums[1] / (num_active_elements * weight.shape[0])
+    return (1 - epsilon) * nll_loss + epsilon * smoothed_loss
 
 
 # add ctr_loss(Type : torch.FloatTensor, Default : None) = Contrastive Learning Loss(Speaker + Topic)
@@ -94,10 +103,12 @@ class CustomSeq2SeqLMOutput(Seq2SeqLMOutput):
     encoder_hidden_states: Optional[Tuple[torch.FloatTensor]] = None
     encoder_attentions: Optional[Tuple[torch.FloatTensor]] = None
     ctr_loss: torch.FloatTensor = None
+    ctr_num_examples: torch.LongTensor = None
 
 
 # add ctr_speaker_loss(Type : torch.FloatTensor, Default : None) = Speaker-Aware Contrastive Learning Loss
 # add ctr_topic_loss(Type : torch.FloatTensor, Default : None) = Topic-Aware Contrastive Learning Loss
+# add ctr_num_examples(Type : torch.LongTensor, Default : None) = Contrastive loss를 계산한 Dialogue 수
 @dataclass
 class CustomSeq2SeqModelOutput(Seq2SeqModelOutput):
     last_hidden_state: torch.FloatTensor = None
@@ -110,6 +121,7 @@ class CustomSeq2SeqModelOutput(Seq2SeqModelOutput):
     encoder_attentions: Optional[Tuple[torch.FloatTensor]] = None
     ctr_speaker_loss: torch.FloatTensor = None
     ctr_topic_loss: torch.FloatTensor = None
+    ctr_num_examples: torch.LongTensor = None
 
 
 class BartModel(BartPretrainedModel):
@@ -121,10 +133,29 @@ class BartModel(BartPretrainedModel):
         padding_idx, vocab_size = config.pad_token_id, config.vocab_size
         self.shared = nn.Embedding(vocab_size, config.d_model, padding_idx)
 
-        self.encoder = BartEncoder(config, self.shared)
+        # config.turn_sparse_attention이 있으면 Speaker-turn block-sparse attention (없으면 BartEncoder와 동일)
+        self.encoder = TurnSparseBartEncoder(config, self.shared)
         self.decoder = BartDecoder(config, self.shared)
+        # decoder self-attention : StaticKVCache를 연결하면 preallocated buffer에 in-place로 key / value 저장
+        # decoder cross-attention : encoder output이 Dialogue 당 하나이면 beam끼리 공유 (parameter는 동일)
+        for layer in self.decoder.layers:
+            layer.self_attn = StaticCacheBartAttention(
+                embed_dim=config.d_model,
+                num_heads=config.decoder_attention_heads,
+                dropout=config.attention_dropout,
+                is_decoder=True,
+            )
+            layer.encoder_attn = BeamSharedCrossAttention(
+                embed_dim=config.d_model,
+                num_heads=config.decoder_attention_heads,
+                dropout=config.attention_dropout,
+                is_decoder=True,
+            )
 
         self.num_try = 0
+        self._dialogue_spec = None
+        # forward 구간 별 시간 측정 (기본 disabled)
+        self.profiler = PhaseProfiler()
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -143,151 +174,165 @@ class BartModel(BartPretrainedModel):
     def get_decoder(self):
         return self.decoder
 
+    # config.dialogue_spec (<sep> / ":" token id)을 한 번만 읽어서 cache
+    @property
+    def dialogue_spec(self) -> Optional[DialogueSpec]:
+        if self._dialogue_spec is None:
+            self._dialogue_spec = DialogueSpec.from_config(self.config)
+        return self._dialogue_spec
+
+    def set_dialogue_spec(self, dialogue_spec: DialogueSpec) -> None:
+        dialogue_spec.save_to_config(self.config)
+        self._dialogue_spec = dialogue_spec
+
+    # None이면 full attention으로 되돌림
+    def set_turn_sparse_attention(self, spec: Optional[TurnSparseSpec]) -> None:
+        if spec is None:
+            self.config.turn_sparse_attention = None
+        else:
+            spec.save_to_config(self.config)
+        self.encoder.turn_sparse = spec
+
     # enc_speaker : Speaker tokens' Encoder Representations from Huggingface BartModel Encoder
     # ctr_margin : Sigma of Contrastive Learning fomula
     # speaker_input_dis : for discirminating what token is a speaker token
     def speaker_aware(self, enc_speaker, ctr_margin, speaker_input_ids, bench_speaker):
-        enc_negative, enc_positive = [], []
-
-        num_turn = enc_speaker.shape[0]
-        num_speaker_unique = len(list(set([int(i[0]) for i in speaker_input_ids])))
-
-        ctr_speaker_loss_means = []
-        for speaker in range(1, num_speaker_unique):
-            bench_speaker = speaker
-            turns = range(1, num_turn)
-            for i in turns:
-                if torch.eq(speaker_input_ids[i][0], speaker_input_ids[bench_speaker][0]):
-                    # same
-                    enc_positive.append(enc_speaker[i])
-                else:
-                    # diff
-                    enc_negative.append(enc_speaker[i])
-
-            if len(enc_positive) > 0 and len(enc_negative) > 0:
-                relu = nn.ReLU()
-
-                positive_sample_l2 = torch.stack(
-                    [
-                        torch.dist(positive, enc_speaker[bench_speaker], p=2.0)
-                        for positive in enc_positive
-                    ]
-                )
-                negative_sample_l2 = torch.stack(
-                    [
-                        torch.dist(negative, enc_speaker[bench_speaker], p=2.0)
-                        for negative in enc_negative
-                    ]
-                )
+        # 모든 anchor의 거리를 cdist 한 번으로 계산하고 P x N grid의 margin loss를 행렬 연산으로 계산
+        speaker_ids = torch.stack([ids[0] for ids in speaker_input_ids])
+        with self.profiler.phase("speaker_aware"):
+            anchor_loss, anchor_mask = speaker_aware_loss(
+                enc_speaker.unsqueeze(0), speaker_ids.unsqueeze(0), ctr_margin
+            )
+        if not anchor_mask.any():
+            return torch.zeros(1, device=enc_speaker.device)
+        return anchor_loss[anchor_mask]
 
-                ctr_speaker_loss_lists = []
-                for negative_sample in negative_sample_l2:
-                    for positive_sample in positive_sample_l2:
-                        softmax_sim_out = nn.functional.softmax(
-                            torch.stack([1 - positive_sample, 1 - negative_sample]), dim=0
-                        )
-                        positive_softmax = softmax_sim_out[0]
-                        negative_softmax = softmax_sim_out[1]
-                        ctr_speaker_loss_lists.append(
-                            relu(ctr_margin - (positive_softmax - negative_softmax))
-                        )
-                ctr_speaker_loss_list = torch.stack(ctr_speaker_loss_lists)
-                ctr_speaker_loss = torch.mean(ctr_speaker_loss_list)
-                ctr_speaker_loss_means.append(ctr_speaker_loss)
-            else:
-                ctr_speaker_loss = torch.zeros(1, device=device)
-                return ctr_speaker_loss
+    def topic_aware(
+        self, enc_utterance, ctr_margin, cluster_mode, example_index=None, cluster_cache=None
+    ):
+        # k-means(cluster_mode=0) / Sequential(cluster_mode=1) clustering과 margin loss를 모두 torch로 계산
+        with self.profiler.phase("topic_aware"):
+            bench_loss, bench_mask = topic_aware_loss(
+                enc_utterance.unsqueeze(0),
+                torch.ones(1, len(enc_utterance), dtype=torch.bool, device=enc_utterance.device),
+                ctr_margin,
+                cluster_mode=cluster_mode,
+                example_index=example_index,
+                cluster_cache=cluster_cache,
+            )
+        if not bench_mask.any():
+            return torch.zeros(1, device=enc_utterance.device)
+        return bench_loss[bench_mask]
 
-        if len(ctr_speaker_loss_means) == 0:
-            ctr_speaker_loss = torch.zeros(1, device=device)
-            return ctr_speaker_loss
-        else:
-            ctr_speaker_loss_result = torch.stack(ctr_speaker_loss_means)
-            return ctr_speaker_loss_result
+    # Batch 안 모든 Dialogue의 Speaker / Utterance representation을 한 번에 Mean Pooling한 뒤
+    # Dialogue 별 speaker_aware / topic_aware loss의 평균을 Dialogue 단위 vector로 반환
+    def batch_contrastive(
+        self,
+        enc_hidden,
+        input_ids,
+        speaker_spans,
+        utterance_spans,
+        ctr_mode,
+        cluster_mode,
+        example_index=None,
+        cluster_cache=None,
+    ):
+        zeros = torch.zeros(1, device=enc_hidden.device)
+
+        # Speaker span이 2개 이상인 Dialogue만 Contrastive Learning
+        with self.profiler.phase("span_pool"):
+            enc_speaker, speaker_mask = segment_mean_pool_padded(enc_hidden, speaker_spans)
+            example_mask = speaker_mask.sum(-1) > 1
+        if not example_mask.any():
+            return zeros, zeros
+
+        ctr_speaker_loss = zeros
+        if ctr_mode in (1, 3):
+            with self.profiler.phase("speaker_aware"):
+                anchor_loss, anchor_mask = speaker_aware_loss(
+                    enc_speaker=enc_speaker,
+                    speaker_ids=span_first_token_ids(input_ids, speaker_spans),
+                    ctr_margin=1,
+                )
+                anchor_count = anchor_mask.sum(-1).clamp(min=1)
+                example_loss = (anchor_loss * anchor_mask).sum(-1) / anchor_count
+                ctr_speaker_loss = example_loss[example_mask]
+
+        ctr_topic_loss = zeros
+        if ctr_mode in (2, 3):
+            with self.profiler.phase("span_pool"):
+                enc_utterance, utterance_mask = segment_mean_pool_padded(
+                    enc_hidden, utterance_spans
+                )
+            with self.profiler.phase("topic_aware"):
+                bench_loss, bench_mask = topic_aware_loss(
+                    enc_utterance=enc_utterance,
+                    turn_mask=utterance_mask,
+                    ctr_margin=1,
+                    cluster_mode=cluster_mode,  # 0=Kmeans, 1=Sequential
+                    example_index=example_index,
+                    cluster_cache=cluster_cache,
+                )
+                bench_count = bench_mask.sum(-1).clamp(min=1)
+                example_loss = (bench_loss * bench_mask).sum(-1) / bench_count
+                ctr_topic_loss = example_loss[example_mask]
 
-    def topic_aware(self, enc_utterance, ctr_margin, cluster_mode):
-        df = pd.DataFrame()
-        num_turn = len(enc_utterance)
-        enc_rep = [rep.cpu().detach().numpy() for rep in enc_utterance]
+        return ctr_speaker_loss, ctr_topic_loss
 
-        if num_turn < 3:
-            return torch.zeros(1, device=device)
+    # batch_contrastive의 static shape 버전 (torch.compile에서 graph break 없이 capture)
+    # - 조기 return / boolean indexing 대신 고정 shape mask로 가중 평균
+    # - k-means는 수렴 확인 없이 kmeans_iters번 반복, topic cluster cache는 사용하지 않음
+    # return : [1] 크기의 Dialogue 평균 loss (batch_contrastive 결과의 평균과 같은 값, 없으면 0)
+    def static_contrastive(
+        self,
+        enc_hidden,
+        input_ids,
+        speaker_spans,
+        utterance_spans,
+        ctr_mode,
+        cluster_mode,
+        kmeans_iters=20,
+    ):
+        # Contrastive loss는 autocast 중에도 float32 (contrastive.float32_math)
+        zeros = enc_hidden.new_zeros(1, dtype=torch.float32)
+
+        with self.profiler.phase("span_pool"):
+            enc_speaker, speaker_mask = segment_mean_pool_padded(enc_hidden, speaker_spans)
+            example_weight = (speaker_mask.sum(-1) > 1).float()
+            num_example = example_weight.sum().clamp(min=1)
+
+        ctr_speaker_loss = zeros
+        if ctr_mode in (1, 3):
+            with self.profiler.phase("speaker_aware"):
+                anchor_loss, anchor_mask = speaker_aware_loss(
+                    enc_speaker=enc_speaker,
+                    speaker_ids=span_first_token_ids(input_ids, speaker_spans),
+                    ctr_margin=1,
+                )
+                anchor_count = anchor_mask.sum(-1).clamp(min=1)
+                example_loss = (anchor_loss * anchor_mask).sum(-1) / anchor_count
+                ctr_speaker_loss = ((example_loss * example_weight).sum() / num_example).view(1)
+
+        ctr_topic_loss = zeros
+        if ctr_mode in (2, 3):
+            with self.profiler.phase("span_pool"):
+                enc_utterance, utterance_mask = segment_mean_pool_padded(
+                    enc_hidden, utterance_spans
+                )
+            with self.profiler.phase("topic_aware"):
+                bench_loss, bench_mask = topic_aware_loss(
+                    enc_utterance=enc_utterance,
+                    turn_mask=utterance_mask,
+                    ctr_margin=1,
+                    cluster_mode=cluster_mode,  # 0=Kmeans, 1=Sequential
+                    kmeans_max_iter=kmeans_iters,
+                    kmeans_early_stop=False,
+                )
+                bench_count = bench_mask.sum(-1).clamp(min=1)
+                example_loss = (bench_loss * bench_mask).sum(-1) / bench_count
+                ctr_topic_loss = ((example_loss * example_weight).sum() / num_example).view(1)
 
-        if cluster_mode == 0:
-            num_cluster = 2
-            kmeans = KMeans(n_clusters=num_cluster, init="k-means++").fit(
-                enc_utterance.cpu().detach().numpy()
-            )
-            df = pd.DataFrame({"enc_rep": enc_rep, "cluster": kmeans.labels_})
-            centroid = torch.Tensor(kmeans.cluster_centers_).to(device)
-            relu = nn.ReLU()
-            ctr_topic_loss_means = []
-            for bench in range(num_cluster):
-                positive_idx = df[df["cluster"] == bench][1:].index.to_numpy()
-                negative_idx = df[df["cluster"] != bench].index.to_numpy()
-
-                if len(positive_idx) < 1 or len(negative_idx) < 1:
-                    return torch.zeros(1, device=device)
-
-                positive = enc_utterance[positive_idx]
-                negative = enc_utterance[negative_idx]
-
-                negative_sample_l2 = [torch.dist(n, centroid[bench], p=2.0) for n in negative]
-                positive_sample_l2 = [torch.dist(p, centroid[bench], p=2.0) for p in positive]
-
-                ctr_topic_loss_lists = []
-                for negative_sample in negative_sample_l2:
-                    for positive_sample in positive_sample_l2:
-                        softmax_sim_out = nn.functional.softmax(
-                            torch.stack([1 - positive_sample, 1 - negative_sample]), dim=0
-                        )
-                        positive_softmax = softmax_sim_out[0]
-                        negative_softmax = softmax_sim_out[1]
-                        ctr_topic_loss_lists.append(
-                            relu(ctr_margin - (positive_softmax - negative_softmax))
-                        )
-                ctr_topic_loss_list = torch.stack(ctr_topic_loss_lists)
-                ctr_topic_loss = torch.mean(ctr_topic_loss_list)
-                ctr_topic_loss_means.append(ctr_topic_loss)
-
-            ctr_topic_loss_result = torch.stack(ctr_topic_loss_means)
-            return ctr_topic_loss_result
-
-        elif cluster_mode == 1:
-            turn_topics = [0 if i < num_turn // 2 else 1 for i in range(num_turn)]
-            centroid = torch.stack(
-                [enc_utterance[num_turn // 4], enc_utterance[num_turn // 2 + num_turn // 4]]
-            )
-            df = pd.DataFrame({"enc_rep": enc_rep, "cluster": turn_topics})
-
-            relu = nn.ReLU()
-            ctr_topic_loss_means = []
-            for bench in range(num_turn):
-                positive_idx = df[df["cluster"] == bench][1:].index.to_numpy()
-                negative_idx = df[df["cluster"] != bench].index.to_numpy()
-                if len(positive_idx) >= 1 and len(negative_idx) >= 1:
-                    positive = enc_utterance[positive_idx]
-                    negative = enc_utterance[negative_idx]
-
-                    negative_sample_l2 = [torch.dist(n, centroid[bench], p=2.0) for n in negative]
-                    positive_sample_l2 = [torch.dist(p, centroid[bench], p=2.0) for p in positive]
-
-                    ctr_topic_loss_lists = []
-                    for negative_sample in negative_sample_l2:
-                        for positive_sample in positive_sample_l2:
-                            softmax_sim_out = nn.functional.softmax(
-                                torch.stack([1 - positive_sample, 1 - negative_sample]), dim=0
-                            )
-                            positive_softmax = softmax_sim_out[0]
-                            negative_softmax = softmax_sim_out[1]
-                            ctr_topic_loss_lists.append(
-                                relu(ctr_margin - (positive_softmax - negative_softmax))
-                            )
-                    ctr_topic_loss_list = torch.stack(ctr_topic_loss_lists)
-                    ctr_topic_loss = torch.mean(ctr_topic_loss_list)
-                    ctr_topic_loss_means.append(ctr_topic_loss)
-            ctr_topic_loss_result = torch.stack(ctr_topic_loss_means)
-            return ctr_topic_loss_result
+        return ctr_speaker_loss, ctr_topic_loss
 
     @add_start_docstrings_to_model_forward(BART_INPUTS_DOCSTRING)
     @add_code_sample_docstrings(
@@ -314,9 +359,16 @@ class BartModel(BartPretrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         all_special_ids: Optional[List] = None,
-        raw_data: Optional[datasets.dataset_dict.DatasetDict] = None,
+        raw_data: Optional["datasets.DatasetDict"] = None,
         ctr_mode: int = 0,
         cluster_mode: int = 0,
+        speaker_spans: Optional[torch.LongTensor] = None,
+        utterance_spans: Optional[torch.LongTensor] = None,
+        ctr_batch: bool = False,
+        example_index: Optional[torch.LongTensor] = None,
+        topic_cache: Optional[TopicClusterCache] = None,
+        ctr_static: bool = False,
+        decoder_kv_cache: Optional[StaticKVCache] = None,
     ) -> Union[Tuple, Seq2SeqModelOutput]:
         # different to other models, Bart automatically creates decoder_input_ids from
         # input_ids if no decoder_input_ids are provided
@@ -344,15 +396,17 @@ class BartModel(BartPretrainedModel):
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
         if encoder_outputs is None:
-            encoder_outputs = self.encoder(
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                head_mask=head_mask,
-                inputs_embeds=inputs_embeds,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-                return_dict=return_dict,
-            )
+            with self.profiler.phase("encoder"):
+                encoder_outputs = self.encoder(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    head_mask=head_mask,
+                    inputs_embeds=inputs_embeds,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    return_dict=return_dict,
+                    speaker_spans=speaker_spans,
+                )
 
         # If the user passed a tuple for encoder_outputs, we wrap it in a BaseModelOutput when return_dict=True
         elif return_dict and not isinstance(encoder_outputs, BaseModelOutput):
@@ -362,35 +416,54 @@ class BartModel(BartPretrainedModel):
                 attentions=encoder_outputs[2] if len(encoder_outputs) > 2 else None,
             )
 
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        tokenizer.add_special_tokens({"additional_special_tokens": ["<sep>", ":"]})
-
-        if all_special_ids is not None:
-            lang_sep = 5  # English
-            sep_idx = [
-                idx
-                for ids, idx in zip(input_ids[0], range(input_ids.shape[1]))
-                if ids == all_special_ids[lang_sep]
-            ]
-            speaker_idx = []
-            for idx in sep_idx:
-                ids = idx
-                while (
-                    ids < len(input_ids[0]) and input_ids[0][ids] != all_special_ids[lang_sep + 1]
-                ):
-                    ids += 1
-                speaker_idx.append([idx + 1, ids])
-
-            utterance_idx = [
-                [start + 3, end]
-                for start, end in zip(sep_idx[:-1], sep_idx[1:])
-                if (start + 3) < end
-            ]
+        if ctr_mode != 0 and speaker_spans is None:
+            # span table이 없으면 config.dialogue_spec (없으면 all_special_ids)로 token ids에서 계산
+            # (Python 연산이므로 torch.compile에서는 collator가 만든 span table을 넘겨야 함)
+            if self.dialogue_spec is None and all_special_ids is not None:
+                self._dialogue_spec = DialogueSpec.from_special_ids(all_special_ids)
+            if self.dialogue_spec is not None:
+                spec = self.dialogue_spec
+                with self.profiler.phase("span_scan"):
+                    spans = [
+                        extract_dialogue_spans(ids, spec.sep_token_id, spec.speaker_end_token_id)
+                        for ids in input_ids.tolist()
+                    ]
+                    speaker_spans = pad_spans([span[0] for span in spans]).to(input_ids.device)
+                    utterance_spans = pad_spans([span[1] for span in spans]).to(input_ids.device)
+
+        # topic_cache는 train dataset의 example index 기준이므로 training 중에만 사용
+        if not self.training:
+            topic_cache = None
+
+        if ctr_mode != 0 and speaker_spans is not None and not (ctr_batch or ctr_static):
+            # 첫 번째 Dialogue의 span만 사용
+            speaker_idx = [span for span in speaker_spans[0].tolist() if span[0] != SPAN_PAD]
+            utterance_idx = [span for span in utterance_spans[0].tolist() if span[0] != SPAN_PAD]
             speaker_input_ids = [input_ids[0][i[0]:i[1]] for i in speaker_idx]
 
-        if ctr_mode == 0:  # 기존 BART만 Training
-            ctr_speaker_loss = torch.zeros(1, device=device)
-            ctr_topic_loss = torch.zeros(1, device=device)
+        if ctr_mode == 0 or speaker_spans is None:  # 기존 BART만 Training
+            ctr_speaker_loss = torch.zeros(1, device=encoder_outputs[0].device)
+            ctr_topic_loss = torch.zeros(1, device=encoder_outputs[0].device)
+        elif ctr_static:  # ctr_batch와 같은 loss를 고정 shape 연산으로 (torch.compile용)
+            ctr_speaker_loss, ctr_topic_loss = self.static_contrastive(
+                enc_hidden=encoder_outputs[0],
+                input_ids=input_ids,
+                speaker_spans=speaker_spans,
+                utterance_spans=utterance_spans,
+                ctr_mode=ctr_mode,
+                cluster_mode=cluster_mode,
+            )
+        elif ctr_batch:  # Batch 안 모든 Dialogue에 Speaker-Aware / Topic-Aware
+            ctr_speaker_loss, ctr_topic_loss = self.batch_contrastive(
+                enc_hidden=encoder_outputs[0],
+                input_ids=input_ids,
+                speaker_spans=speaker_spans,
+                utterance_spans=utterance_spans,
+                ctr_mode=ctr_mode,
+                cluster_mode=cluster_mode,
+                example_index=example_index,
+                cluster_cache=topic_cache,
+            )
         elif ctr_mode == 1:  # BART + Spaeker-Aware
             if len(speaker_idx) > 1:
                 enc_speaker = [encoder_outputs[0][0][i[0]:i[1]] for i in speaker_idx]
@@ -403,10 +476,10 @@ class BartModel(BartPretrainedModel):
                     speaker_input_ids=speaker_input_ids,  # Dialogue 안 Speaker Token들의 input_ids list
                     bench_speaker=0,  # P01을 기준점 = 0번째 Speaker
                 )
-                ctr_topic_loss = torch.zeros(1, device=device)
+                ctr_topic_loss = torch.zeros(1, device=encoder_outputs[0].device)
             else:
-                ctr_speaker_loss = torch.zeros(1, device=device)
-                ctr_topic_loss = torch.zeros(1, device=device)
+                ctr_speaker_loss = torch.zeros(1, device=encoder_outputs[0].device)
+                ctr_topic_loss = torch.zeros(1, device=encoder_outputs[0].device)
 
         elif ctr_mode == 2:  # koBART + Topic-view
             if len(speaker_idx) > 1:
@@ -419,11 +492,13 @@ class BartModel(BartPretrainedModel):
                     enc_utterance=mean_utterance,  # Mean Pooling한 utterance의 representation list
                     ctr_margin=1,  # ctrastive learning 시, margin 값
                     cluster_mode=cluster_mode,  # 0=Kmeans, 1=Sequential
+                    example_index=example_index[:1] if example_index is not None else None,
+                    cluster_cache=topic_cache,
                 )
-                ctr_speaker_loss = torch.zeros(1, device=device)
+                ctr_speaker_loss = torch.zeros(1, device=encoder_outputs[0].device)
             else:
-                ctr_speaker_loss = torch.zeros(1, device=device)
-                ctr_topic_loss = torch.zeros(1, device=device)
+                ctr_speaker_loss = torch.zeros(1, device=encoder_outputs[0].device)
+                ctr_topic_loss = torch.zeros(1, device=encoder_outputs[0].device)
 
         elif ctr_mode == 3:  # koBART + Spaeker-Aware + Topic-Aware
             if len(speaker_idx) > 1:
@@ -448,12 +523,21 @@ class BartModel(BartPretrainedModel):
                     enc_utterance=mean_utterance,  # Mean Pooling한 utterance의 representation list
                     ctr_margin=1,  # ctrastive learning 시, margin 값
                     cluster_mode=cluster_mode,  # 0=Kmeans, 1=Sequential
+                    example_index=example_index[:1] if example_index is not None else None,
+                    cluster_cache=topic_cache,
                 )
             else:
-                ctr_speaker_loss = torch.zeros(1, device=device)
-                ctr_topic_loss = torch.zeros(1, device=device)
+                ctr_speaker_loss = torch.zeros(1, device=encoder_outputs[0].device)
+                ctr_topic_loss = torch.zeros(1, device=encoder_outputs[0].device)
 
-        decoder_outputs = self.decoder(
+        # Contrastive loss를 계산한 Dialogue 수 (Speaker span 2개 이상, 분산 학습에서 전체 평균에 사용)
+        if ctr_mode == 0 or speaker_spans is None:
+            ctr_num_examples = torch.zeros((), dtype=torch.long, device=encoder_outputs[0].device)
+        else:
+            gated_spans = speaker_spans if (ctr_batch or ctr_static) else speaker_spans[:1]
+            ctr_num_examples = ((gated_spans[..., 0] != SPAN_PAD).sum(-1) > 1).sum()
+
+        decoder_kwargs = dict(
             input_ids=decoder_input_ids,
             attention_mask=decoder_attention_mask,
             encoder_hidden_states=encoder_outputs[0],
@@ -467,6 +551,14 @@ class BartModel(BartPretrainedModel):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
         )
+        # KV cache가 없으면 with를 하나만 사용 (torch 2.4 dynamo는 with 두 개 안의 graph break에서
+        # resume 함수를 만들지 못함 : transformers 4.27의 layerdrop 검사가 train mode에서 graph break)
+        with self.profiler.phase("decoder"):
+            if decoder_kv_cache is None:
+                decoder_outputs = self.decoder(**decoder_kwargs)
+            else:
+                with decoder_kv_cache.attached(self.decoder):
+                    decoder_outputs = self.decoder(**decoder_kwargs)
 
         if not return_dict:
             return decoder_outputs + encoder_outputs
@@ -482,6 +574,7 @@ class BartModel(BartPretrainedModel):
             encoder_attentions=encoder_outputs.attentions,
             ctr_speaker_loss=ctr_speaker_loss,
             ctr_topic_loss=ctr_topic_loss,
+            ctr_num_examples=ctr_num_examples,
         )
 
 
@@ -501,6 +594,8 @@ class BartForConditionalGeneration(BartPretrainedModel):
             "final_logits_bias", torch.zeros((1, self.model.shared.num_embeddings))
         )
         self.lm_head = nn.Linear(config.d_model, self.model.shared.num_embeddings, bias=False)
+        # generate 중 prepare_inputs_for_generation이 받은 StaticKVCache (_reorder_cache에서 사용)
+        self._generation_kv_cache = None
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -508,6 +603,27 @@ class BartForConditionalGeneration(BartPretrainedModel):
     def get_encoder(self):
         return self.model.get_encoder()
 
+    def set_dialogue_spec(self, dialogue_spec: DialogueSpec) -> None:
+        self.model.set_dialogue_spec(dialogue_spec)
+
+    # encoder self-attention을 Speaker-turn block-sparse attention으로 (None이면 full attention)
+    # max_positions : 설정하면 position embedding을 max_positions까지 늘림 (긴 Dialogue 입력)
+    def set_turn_sparse_attention(
+        self, spec: Optional[TurnSparseSpec], max_positions: Optional[int] = None
+    ) -> None:
+        self.model.set_turn_sparse_attention(spec)
+        if max_positions is not None:
+            extend_position_embeddings(self, self.config, max_positions)
+
+    # encoder / span_scan / span_pool / speaker_aware / topic_aware / decoder / lm_head 구간 측정
+    @property
+    def profiler(self) -> PhaseProfiler:
+        return self.model.profiler
+
+    def enable_profiling(self, enabled: bool = True) -> PhaseProfiler:
+        self.model.profiler.enabled = enabled
+        return self.model.profiler
+
     def get_decoder(self):
         return self.model.get_decoder()
 
@@ -555,15 +671,33 @@ class BartForConditionalGeneration(BartPretrainedModel):
         output_hidden_states: Optional[bool] = None,
         all_special_ids: Optional[List] = None,
         return_dict: Optional[bool] = None,
-        raw_data: Optional[datasets.dataset_dict.DatasetDict] = None,
+        raw_data: Optional["datasets.DatasetDict"] = None,
         ctr_mode: int = 0,
         cluster_mode: int = 0,
+        speaker_spans: Optional[torch.LongTensor] = None,
+        utterance_spans: Optional[torch.LongTensor] = None,
+        ctr_batch: bool = False,
+        example_index: Optional[torch.LongTensor] = None,
+        topic_cache: Optional[TopicClusterCache] = None,
+        ctr_static: bool = False,
+        decoder_kv_cache: Optional[StaticKVCache] = None,
+        loss_chunk_size: Optional[int] = None,
+        label_smoothing: float = 0.0,
     ) -> Union[Tuple, Seq2SeqLMOutput]:
         r"""
         labels (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
             Labels for computing the masked language modeling loss. Indices should either be in `[0, ...,
             config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
             (masked), the loss is only computed for the tokens with labels in `[0, ..., config.vocab_size]`.
+        loss_chunk_size (`int`, *optional*):
+            If set during training with `labels`, compute the `label_smoothing` cross-entropy over chunks of
+            `loss_chunk_size` decoder positions without materializing the full logits (`logits` is `None`).
+        ctr_static (`bool`, *optional*, defaults to `False`):
+            Compute the batched contrastive losses with fixed-shape masked tensor ops (no data-dependent control
+            flow), so the forward can be captured by `torch.compile` without graph breaks.
+        decoder_kv_cache (`StaticKVCache`, *optional*):
+            Preallocated decoder self-attention cache written in place instead of growing `past_key_values` with
+            `torch.cat`. Pass it to `generate` as `decoder_kv_cache=StaticKVCache(max_length)`.
 
         Returns:
         """
@@ -600,15 +734,39 @@ class BartForConditionalGeneration(BartPretrainedModel):
             raw_data=raw_data,
             ctr_mode=ctr_mode,
             cluster_mode=cluster_mode,
+            speaker_spans=speaker_spans,
+            utterance_spans=utterance_spans,
+            ctr_batch=ctr_batch,
+            example_index=example_index,
+            topic_cache=topic_cache,
+            ctr_static=ctr_static,
+            decoder_kv_cache=decoder_kv_cache,
         )
 
-        lm_logits = self.lm_head(outputs[0])
-        lm_logits = lm_logits + self.final_logits_bias.to(lm_logits.device)
-
         masked_lm_loss = None
-        if labels is not None:
-            loss_fct = CrossEntropyLoss()
-            masked_lm_loss = loss_fct(lm_logits.view(-1, self.config.vocab_size), labels.view(-1))
+        if loss_chunk_size is not None and labels is not None and self.training:
+            # label-smoothed loss만 계산 (full logits를 만들지 않음)
+            with self.profiler.phase("lm_head"):
+                masked_lm_loss = chunked_label_smoothed_loss(
+                    outputs[0],
+                    self.lm_head.weight,
+                    self.final_logits_bias[0].to(outputs[0].device),
+                    labels,
+                    epsilon=label_smoothing,
+                    chunk_size=loss_chunk_size,
+                )
+            lm_logits = None
+        else:
+            with self.profiler.phase("lm_head"):
+                lm_logits = self.lm_head(outputs[0])
+                lm_logits = lm_logits + self.final_logits_bias.to(lm_logits.device)
+
+            if labels is not None:
+                loss_fct = CrossEntropyLoss()
+                # bf16 autocast에서도 log-softmax / 평균은 float32
+                masked_lm_loss = loss_fct(
+                    lm_logits.view(-1, self.config.vocab_size).float(), labels.view(-1)
+                )
 
         if not return_dict:
             output = (lm_logits,) + outputs[1:]
@@ -617,6 +775,7 @@ class BartForConditionalGeneration(BartPretrainedModel):
         return CustomSeq2SeqLMOutput(
             loss=masked_lm_loss,
             ctr_loss=torch.mean(outputs.ctr_speaker_loss) + torch.mean(outputs.ctr_topic_loss),
+            ctr_num_examples=outputs.ctr_num_examples,
             logits=lm_logits,
             past_key_values=outputs.past_key_values,
             decoder_hidden_states=outputs.decoder_hidden_states,
@@ -638,11 +797,14 @@ class BartForConditionalGeneration(BartPretrainedModel):
         cross_attn_head_mask=None,
         use_cache=None,
         encoder_outputs=None,
+        decoder_kv_cache=None,
+        decoder_share_encoder_outputs=False,
         **kwargs,
     ):
         # cut decoder_input_ids if past_key_values is used
         if past_key_values is not None:
             decoder_input_ids = decoder_input_ids[:, -1:]
+        self._generation_kv_cache = decoder_kv_cache
 
         return {
             "input_ids": None,  # encoder_outputs is defined. input_ids not needed
@@ -655,15 +817,43 @@ class BartForConditionalGeneration(BartPretrainedModel):
             "decoder_head_mask": decoder_head_mask,
             "cross_attn_head_mask": cross_attn_head_mask,
             "use_cache": use_cache,  # change this to avoid caching (presumably for debugging)
+            "decoder_kv_cache": decoder_kv_cache,
         }
 
+    # generate(..., decoder_share_encoder_outputs=True) : encoder output / attention_mask를 beam 수만큼
+    # 복사하지 않고 Dialogue 당 하나만 유지 (BeamSharedCrossAttention이 beam에 broadcast)
+    def _expand_inputs_for_generation(
+        self, expand_size=1, is_encoder_decoder=False, input_ids=None, **model_kwargs
+    ):
+        if not (is_encoder_decoder and model_kwargs.get("decoder_share_encoder_outputs")):
+            return super()._expand_inputs_for_generation(
+                expand_size=expand_size,
+                is_encoder_decoder=is_encoder_decoder,
+                input_ids=input_ids,
+                **model_kwargs,
+            )
+
+        shared = {
+            key: model_kwargs.pop(key)
+            for key in ("encoder_outputs", "attention_mask")
+            if key in model_kwargs
+        }
+        input_ids, model_kwargs = super()._expand_inputs_for_generation(
+            expand_size=expand_size, is_encoder_decoder=False, input_ids=input_ids, **model_kwargs
+        )
+        model_kwargs.update(shared)
+        return input_ids, model_kwargs
+
     def prepare_decoder_input_ids_from_labels(self, labels: torch.Tensor):
         return shift_tokens_right(
             labels, self.config.pad_token_id, self.config.decoder_start_token_id
         )
 
-    @staticmethod
-    def _reorder_cache(past_key_values, beam_idx):
+    def _reorder_cache(self, past_key_values, beam_idx):
+        # StaticKVCache : preallocated buffer 안에서 double buffer로 gather
+        if self._generation_kv_cache is not None:
+            return self._generation_kv_cache.reorder(past_key_values, beam_idx)
+
         reordered_past = ()
         for layer_past in past_key_values:
             # cached cross_attention states don't have to be reordered -> they are always the same
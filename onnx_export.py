@@ -0,0 +1,434 @@
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+from transformers import (
+    AutoTokenizer,
+    BartConfig,
+    BeamSearchScorer,
+    GenerationConfig,
+    GenerationMixin,
+    HfArgumentParser,
+    LogitsProcessorList,
+)
+
+from dialogue_data import format_dialogue, iter_dialogue_records
+from modeling_bart import BartForConditionalGeneration
+
+ENCODER_FILE = "encoder.onnx"
+DECODER_INIT_FILE = "decoder_init.onnx"
+DECODER_WITH_PAST_FILE = "decoder_with_past.onnx"
+
+
+@dataclass
+class ExportArguments:
+    model_path: str = field(metadata={"help": "fine-tuning된 checkpoint (model + tokenizer) 경로"})
+    output_dir: str = field(metadata={"help": "ONNX graph / config / tokenizer 저장 경로"})
+    opset_version: int = field(default=14)
+    skip_export: bool = field(default=False, metadata={"help": "이미 export한 output_dir만 검증"})
+    # 설정하면 PyTorch generate와 ONNX Runtime beam search 결과를 token 단위로 비교
+    verify_file: Optional[str] = field(default=None, metadata={"help": "Dialogue JSONL / Parquet"})
+    dialogue_field: str = field(default="dialogue")
+    num_verify: int = field(default=16)
+    max_source_length: int = field(default=1024)
+    max_length: int = field(default=80)
+    num_beams: int = field(default=6)
+    length_penalty: float = field(default=1.0)
+    no_repeat_ngram_size: int = field(default=3)
+
+
+# encoder : input_ids, attention_mask -> encoder_hidden_states
+class EncoderForExport(nn.Module):
+    def __init__(self, model: BartForConditionalGeneration):
+        super().__init__()
+        self.encoder = model.get_encoder()
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(
+            input_ids=input_ids, attention_mask=attention_mask, return_dict=True
+        ).last_hidden_state
+
+
+# decoder 한 step + lm_head (마지막 위치의 logits만 반환)
+# with_past=False (첫 step) : encoder_hidden_states 입력 -> logits, layer 별 self / cross key, value
+# with_past=True : layer 별 self / cross key, value 입력 -> logits, layer 별 self key, value
+#   cross-attention key, value는 첫 step 결과를 그대로 사용 (_reorder_cache와 같이 beam 순서 변경 없음)
+class DecoderForExport(nn.Module):
+    def __init__(self, model: BartForConditionalGeneration, with_past: bool):
+        super().__init__()
+        self.decoder = model.get_decoder()
+        self.lm_head = model.lm_head
+        self.register_buffer("final_logits_bias", model.final_logits_bias.clone())
+        self.num_layers = model.config.decoder_layers
+        self.with_past = with_past
+
+    def forward(self, decoder_input_ids, encoder_attention_mask, *inputs):
+        if self.with_past:
+            past_key_values = tuple(
+                tuple(inputs[4 * layer : 4 * layer + 4]) for layer in range(self.num_layers)
+            )
+            # cross-attention은 past의 key, value를 사용하고 encoder_hidden_states는 길이 확인에만 쓰임
+            encoder_hidden_states = encoder_attention_mask.unsqueeze(-1).to(inputs[0].dtype)
+        else:
+            past_key_values = None
+            encoder_hidden_states = inputs[0]
+
+        outputs = self.decoder(
+            input_ids=decoder_input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        logits = self.lm_head(outputs.last_hidden_state[:, -1]) + self.final_logits_bias
+        num_states = 2 if self.with_past else 4
+        return (logits,) + tuple(
+            state for layer_past in outputs.past_key_values for state in layer_past[:num_states]
+        )
+
+
+def past_names(prefix: str, num_layers: int, with_cross: bool = True) -> List[str]:
+    kinds = ["decoder.key", "decoder.value"]
+    if with_cross:
+        kinds += ["encoder.key", "encoder.value"]
+    return [f"{prefix}.{layer}.{kind}" for layer in range(num_layers) for kind in kinds]
+
+
+# 세 graph를 output_dir에 export (contrastive 전용 입력 all_special_ids / raw_data / ctr_mode 등은 없음)
+# wrapper도 eval mode로 만듦 (torch.onnx.export가 끝나면 wrapper의 원래 mode를 하위 module 전체에 다시 적용)
+@torch.no_grad()
+def export_onnx(model: BartForConditionalGeneration, output_dir: str, opset_version: int = 14):
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.eval().float()
+    config = model.config
+    num_layers, num_heads = config.decoder_layers, config.decoder_attention_heads
+    head_dim = config.d_model // num_heads
+
+    batch_size, src_len, past_len = 2, 16, 3
+    input_ids = torch.full((batch_size, src_len), config.bos_token_id + 10, dtype=torch.long)
+    attention_mask = torch.ones_like(input_ids)
+    decoder_input_ids = torch.full(
+        (batch_size, 1), config.decoder_start_token_id, dtype=torch.long
+    )
+    encoder_hidden_states = torch.rand(batch_size, src_len, config.d_model)
+
+    torch.onnx.export(
+        EncoderForExport(model).eval(),
+        (input_ids, attention_mask),
+        os.path.join(output_dir, ENCODER_FILE),
+        input_names=["input_ids", "attention_mask"],
+        output_names=["encoder_hidden_states"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "src_len"},
+            "attention_mask": {0: "batch", 1: "src_len"},
+            "encoder_hidden_states": {0: "batch", 1: "src_len"},
+        },
+        opset_version=opset_version,
+    )
+
+    # 첫 step graph는 decoder_input_ids 길이 1(decoder_start_token_id)로 고정 (causal mask 없음)
+    present = past_names("present", num_layers)
+    dynamic_axes = {
+        "decoder_input_ids": {0: "batch"},
+        "encoder_attention_mask": {0: "batch", 1: "src_len"},
+        "encoder_hidden_states": {0: "batch", 1: "src_len"},
+        "logits": {0: "batch"},
+    }
+    for name in present:
+        length = "src_len" if ".encoder." in name else "tgt_len"
+        dynamic_axes[name] = {0: "batch", 2: length}
+    torch.onnx.export(
+        DecoderForExport(model, with_past=False).eval(),
+        (decoder_input_ids, attention_mask, encoder_hidden_states),
+        os.path.join(output_dir, DECODER_INIT_FILE),
+        input_names=["decoder_input_ids", "encoder_attention_mask", "encoder_hidden_states"],
+        output_names=["logits"] + present,
+        dynamic_axes=dynamic_axes,
+        opset_version=opset_version,
+    )
+
+    past = past_names("past_key_values", num_layers)
+    present = past_names("present", num_layers, with_cross=False)
+    past_states = []
+    for name in past:
+        length = src_len if ".encoder." in name else past_len
+        past_states.append(torch.rand(batch_size, num_heads, length, head_dim))
+    dynamic_axes = {
+        "decoder_input_ids": {0: "batch"},
+        "encoder_attention_mask": {0: "batch", 1: "src_len"},
+        "logits": {0: "batch"},
+    }
+    for name in past:
+        dynamic_axes[name] = {0: "batch", 2: "src_len" if ".encoder." in name else "past_len"}
+    for name in present:
+        dynamic_axes[name] = {0: "batch", 2: "tgt_len"}
+    torch.onnx.export(
+        DecoderForExport(model, with_past=True).eval(),
+        (decoder_input_ids, attention_mask, *past_states),
+        os.path.join(output_dir, DECODER_WITH_PAST_FILE),
+        input_names=["decoder_input_ids", "encoder_attention_mask"] + past,
+        output_names=["logits"] + present,
+        dynamic_axes=dynamic_axes,
+        opset_version=opset_version,
+    )
+    config.save_pretrained(output_dir)
+
+
+# ONNX Runtime session 3개로 transformers greedy / beam search와 같은 순서 / 같은 logits processor로 generate
+# (BeamSearchScorer와 generation config 전체로 만드는 logits processor는 transformers 구현을 그대로 사용,
+#  GenerationMixin은 _get_logits_processor에만 사용하고 generate는 아래 ONNX Runtime 구현)
+class OnnxBeamSearch(GenerationMixin):
+    def __init__(self, onnx_dir: str, num_threads: Optional[int] = None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+
+        def session(file_name):
+            return ort.InferenceSession(
+                os.path.join(onnx_dir, file_name), options, providers=["CPUExecutionProvider"]
+            )
+
+        self.encoder = session(ENCODER_FILE)
+        self.decoder_init = session(DECODER_INIT_FILE)
+        self.decoder_with_past = session(DECODER_WITH_PAST_FILE)
+        self.config = BartConfig.from_pretrained(onnx_dir)
+        self.generation_config = GenerationConfig.from_model_config(self.config)
+        self.num_layers = self.config.decoder_layers
+
+    # model.generate와 같은 logits processor (repetition_penalty, bad_words_ids 등 generation config 전체)
+    # encoder-decoder generate의 input_ids_seq_length는 decoder 시작 길이(1)
+    def logits_processor(
+        self, generation_config: GenerationConfig, input_ids: torch.LongTensor
+    ) -> LogitsProcessorList:
+        return self._get_logits_processor(
+            generation_config=generation_config,
+            input_ids_seq_length=1,
+            encoder_input_ids=input_ids,
+            prefix_allowed_tokens_fn=None,
+            logits_processor=LogitsProcessorList(),
+        )
+
+    def _decode_step(
+        self, decoder_input_ids: np.ndarray, attention_mask: np.ndarray, states: Tuple
+    ) -> Tuple[np.ndarray, List[np.ndarray]]:
+        inputs = {"decoder_input_ids": decoder_input_ids, "encoder_attention_mask": attention_mask}
+        if len(states) == 1:
+            inputs["encoder_hidden_states"] = states[0]
+            logits, *present = self.decoder_init.run(None, inputs)
+            return logits, present
+        inputs.update(zip(past_names("past_key_values", self.num_layers), states))
+        logits, *present = self.decoder_with_past.run(None, inputs)
+        return logits, present
+
+    # _reorder_cache : self-attention key, value만 beam 순서대로 gather, cross-attention은 그대로
+    # 첫 step의 present는 layer 별 (self key, self value, cross key, cross value)
+    # beam_idx=None : 순서 변경 없음 (greedy)
+    def _next_states(
+        self, present: List[np.ndarray], states: Tuple, beam_idx: Optional[np.ndarray] = None
+    ) -> Tuple:
+        first_step = len(states) == 1
+        new_states = []
+        for layer in range(self.num_layers):
+            if first_step:
+                self_key, self_value, *cross = present[4 * layer : 4 * layer + 4]
+            else:
+                self_key, self_value = present[2 * layer : 2 * layer + 2]
+                cross = states[4 * layer + 2 : 4 * layer + 4]
+            if beam_idx is not None:
+                self_key, self_value = self_key[beam_idx], self_value[beam_idx]
+            new_states += [self_key, self_value, *cross]
+        return tuple(new_states)
+
+    # num_beams=1 : transformers greedy_search와 같이 log_softmax 전 logits에 processor 적용 후 argmax
+    def _greedy_search(
+        self,
+        encoder_hidden_states: np.ndarray,
+        attention_mask: np.ndarray,
+        logits_processor: LogitsProcessorList,
+        generation_config: GenerationConfig,
+    ) -> torch.LongTensor:
+        batch_size = attention_mask.shape[0]
+        pad_token_id = generation_config.pad_token_id
+        eos_token_id = generation_config.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        eos_token_id = torch.tensor(eos_token_id if eos_token_id is not None else [])
+
+        sequences = torch.full(
+            (batch_size, 1), generation_config.decoder_start_token_id, dtype=torch.long
+        )
+        unfinished = torch.ones(batch_size, dtype=torch.long)
+        states = (encoder_hidden_states,)
+        while True:
+            logits, present = self._decode_step(sequences[:, -1:].numpy(), attention_mask, states)
+            next_tokens = logits_processor(sequences, torch.from_numpy(logits)).argmax(-1)
+            if len(eos_token_id) > 0:
+                next_tokens = next_tokens * unfinished + pad_token_id * (1 - unfinished)
+                unfinished = unfinished * (~torch.isin(next_tokens, eos_token_id)).long()
+            sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+            states = self._next_states(present, states)
+
+            if unfinished.max() == 0 or sequences.shape[-1] >= generation_config.max_length:
+                return sequences
+
+    def generate(
+        self, input_ids: torch.LongTensor, attention_mask: torch.LongTensor, **kwargs
+    ) -> torch.LongTensor:
+        generation_config = GenerationConfig.from_dict(
+            {**self.generation_config.to_dict(), **kwargs}
+        )
+        batch_size, num_beams = input_ids.shape[0], generation_config.num_beams
+        max_length = generation_config.max_length
+        logits_processor = self.logits_processor(generation_config, input_ids)
+
+        (encoder_hidden_states,) = self.encoder.run(
+            None,
+            {"input_ids": input_ids.numpy(), "attention_mask": attention_mask.numpy()},
+        )
+        if num_beams == 1:
+            return self._greedy_search(
+                encoder_hidden_states, attention_mask.numpy(), logits_processor, generation_config
+            )
+
+        beam_scorer = BeamSearchScorer(
+            batch_size=batch_size,
+            num_beams=num_beams,
+            device=torch.device("cpu"),
+            length_penalty=generation_config.length_penalty,
+            do_early_stopping=generation_config.early_stopping,
+            num_beam_hyps_to_keep=1,
+            max_length=max_length,
+        )
+
+        # transformers의 _expand_inputs_for_generation과 같이 Dialogue 별로 beam 수만큼 복사
+        encoder_attention_mask = np.repeat(attention_mask.numpy(), num_beams, axis=0)
+        states = (np.repeat(encoder_hidden_states, num_beams, axis=0),)
+
+        sequences = torch.full(
+            (batch_size * num_beams, 1), generation_config.decoder_start_token_id, dtype=torch.long
+        )
+        beam_scores = torch.zeros(batch_size, num_beams)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.view(-1)
+
+        while True:
+            logits, present = self._decode_step(
+                sequences[:, -1:].numpy(), encoder_attention_mask, states
+            )
+            next_token_scores = nn.functional.log_softmax(torch.from_numpy(logits), dim=-1)
+            next_token_scores = logits_processor(sequences, next_token_scores)
+            next_token_scores = next_token_scores + beam_scores[:, None]
+
+            vocab_size = next_token_scores.shape[-1]
+            next_token_scores = next_token_scores.view(batch_size, num_beams * vocab_size)
+            next_token_scores, next_tokens = torch.topk(
+                next_token_scores, 2 * num_beams, dim=1, largest=True, sorted=True
+            )
+            next_indices = torch.div(next_tokens, vocab_size, rounding_mode="floor")
+            next_tokens = next_tokens % vocab_size
+
+            beam_outputs = beam_scorer.process(
+                sequences,
+                next_token_scores,
+                next_tokens,
+                next_indices,
+                pad_token_id=generation_config.pad_token_id,
+                eos_token_id=generation_config.eos_token_id,
+            )
+            beam_scores = beam_outputs["next_beam_scores"]
+            beam_idx = beam_outputs["next_beam_indices"]
+            sequences = torch.cat(
+                [sequences[beam_idx, :], beam_outputs["next_beam_tokens"].unsqueeze(-1)], dim=-1
+            )
+
+            states = self._next_states(present, states, beam_idx.numpy())
+
+            if beam_scorer.is_done or sequences.shape[-1] >= max_length:
+                break
+
+        return beam_scorer.finalize(
+            sequences,
+            beam_scores,
+            next_tokens,
+            next_indices,
+            pad_token_id=generation_config.pad_token_id,
+            eos_token_id=generation_config.eos_token_id,
+            max_length=max_length,
+        )["sequences"]
+
+
+# PyTorch generate와 ONNX Runtime beam search 결과를 Dialogue 단위로 비교
+def verify(args: ExportArguments) -> Dict[str, float]:
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    model = BartForConditionalGeneration.from_pretrained(args.model_path).eval()
+    onnx_model = OnnxBeamSearch(args.output_dir)
+    gen_kwargs = {
+        "max_length": args.max_length,
+        "num_beams": args.num_beams,
+        "length_penalty": args.length_penalty,
+        "no_repeat_ngram_size": args.no_repeat_ngram_size,
+    }
+
+    records = next(
+        iter_dialogue_records(args.verify_file, args.num_verify, columns=[args.dialogue_field])
+    )
+    num_match, torch_time, onnx_time = 0, 0.0, 0.0
+    for record in records:
+        inputs = tokenizer(
+            format_dialogue(record[args.dialogue_field]),
+            max_length=args.max_source_length,
+            truncation=True,
+            return_tensors="pt",
+        )
+        start = time.perf_counter()
+        with torch.no_grad():
+            expected = model.generate(**inputs, **gen_kwargs)[0]
+        torch_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        generated = onnx_model.generate(inputs["input_ids"], inputs["attention_mask"], **gen_kwargs)
+        onnx_time += time.perf_counter() - start
+
+        expected = expected[expected != model.config.pad_token_id].tolist()
+        generated = generated[0][generated[0] != model.config.pad_token_id].tolist()
+        if expected == generated:
+            num_match += 1
+        else:
+            print(f"mismatch\n  torch : {tokenizer.decode(expected)}")
+            print(f"  onnx  : {tokenizer.decode(generated)}")
+
+    return {
+        "num_dialogues": len(records),
+        "num_match": num_match,
+        "torch_sec_per_dialogue": torch_time / len(records),
+        "onnx_sec_per_dialogue": onnx_time / len(records),
+    }
+
+
+def main():
+    parser = HfArgumentParser(ExportArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+
+    if not args.skip_export:
+        model = BartForConditionalGeneration.from_pretrained(args.model_path)
+        export_onnx(model, args.output_dir, args.opset_version)
+        AutoTokenizer.from_pretrained(args.model_path).save_pretrained(args.output_dir)
+        print(f"exported : {args.output_dir}")
+
+    if args.verify_file is not None:
+        result = verify(args)
+        print(result)
+        if result["num_match"] != result["num_dialogues"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
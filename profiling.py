@@ -0,0 +1,57 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict
+
+import torch
+
+# BartModel.forward / BartForConditionalGeneration.forward에서 측정하는 구간
+PHASES = ("encoder", "span_scan", "span_pool", "speaker_aware", "topic_aware", "decoder", "lm_head")
+
+_DISABLED = nullcontext()
+
+
+# forward 구간 별 wall time / CUDA memory 할당량 누적 (side-channel, model output은 그대로)
+# - enabled일 때 각 구간을 torch.profiler.record_function으로 감싸서 torch.profiler trace에도 표시
+# - disabled일 때 phase()는 미리 만든 nullcontext를 반환 (측정 / 동기화 없음)
+# - CUDA에서는 정확한 구간 시간을 위해 구간 시작 / 끝에서 synchronize
+class PhaseProfiler:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self) -> None:
+        self.time_ms = defaultdict(float)
+        self.alloc_bytes = defaultdict(int)
+        self.calls = defaultdict(int)
+
+    def phase(self, name: str):
+        if not self.enabled:
+            return _DISABLED
+        return self._measure(name)
+
+    @contextmanager
+    def _measure(self, name: str):
+        use_cuda = torch.cuda.is_available() and torch.cuda.is_initialized()
+        if use_cuda:
+            torch.cuda.synchronize()
+            start_alloc = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(f"bart/{name}"):
+                yield
+        finally:
+            if use_cuda:
+                torch.cuda.synchronize()
+                self.alloc_bytes[name] += torch.cuda.memory_allocated() - start_alloc
+            self.time_ms[name] += (time.perf_counter() - start) * 1000
+            self.calls[name] += 1
+
+    # Trainer.log에 추가할 누적 값 (profile/{phase}_ms, profile/{phase}_alloc_mb)
+    def stats(self) -> Dict[str, float]:
+        logs = {}
+        for name in self.calls:
+            logs[f"profile/{name}_ms"] = round(self.time_ms[name], 3)
+            if name in self.alloc_bytes:
+                logs[f"profile/{name}_alloc_mb"] = round(self.alloc_bytes[name] / 2**20, 3)
+        return logs
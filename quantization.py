@@ -0,0 +1,141 @@
+import json
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+from datasets import load_dataset
+from torch import nn
+from transformers import AutoTokenizer, HfArgumentParser
+
+from dialogue_data import format_dialogue
+from metrics import ROUGE_TYPES, RougeMetric
+from modeling_bart import BartForConditionalGeneration
+
+
+@dataclass
+class QuantizeEvalArguments:
+    model_path: str = field(metadata={"help": "fine-tuning된 checkpoint (model + tokenizer) 경로"})
+    data_name: str = field(default="samsum")
+    split: str = field(default="test")
+    num_dialogues: Optional[int] = field(default=None, metadata={"help": "앞에서부터 평가할 개수"})
+    output_file: Optional[str] = field(default=None, metadata={"help": "결과 JSON 저장 경로"})
+    max_source_length: int = field(default=1024)
+    max_length: int = field(default=80)
+    num_beams: int = field(default=6)
+    length_penalty: float = field(default=1.0)
+    no_repeat_ngram_size: int = field(default=3)
+    num_threads: Optional[int] = field(default=None)
+
+
+# encoder / decoder의 nn.Linear와 lm_head를 dynamic int8 quantization (CPU 전용)
+# nn.Embedding, LayerNorm은 float 그대로 (lm_head는 shared embedding과의 weight tying이 풀림)
+def quantize_dynamic_int8(model: BartForConditionalGeneration) -> BartForConditionalGeneration:
+    model = model.to("cpu").eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def load_model(model_path: str, quantize: bool = False) -> BartForConditionalGeneration:
+    model = BartForConditionalGeneration.from_pretrained(model_path).eval()
+    return quantize_dynamic_int8(model) if quantize else model
+
+
+# 현재 resident memory (Linux : /proc/self/status의 VmRSS, 그 외 : peak RSS)
+def resident_memory_mb() -> float:
+    try:
+        with open("/proc/self/status") as reader:
+            for line in reader:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# fp32 / int8 하나를 별도 process에서 실행 (model 별 memory를 따로 측정)
+# Dialogue 하나씩 generate해서 Dialogue 별 latency를 측정
+def run_variant(args: QuantizeEvalArguments, dialogues: List[str], quantize: bool) -> Dict:
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    base_memory = resident_memory_mb()
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    model = load_model(args.model_path, quantize=quantize)
+    model_memory = resident_memory_mb() - base_memory
+
+    predictions, latencies = [], []
+    with torch.inference_mode():
+        for dialogue in dialogues:
+            inputs = tokenizer(
+                format_dialogue(dialogue),
+                max_length=args.max_source_length,
+                truncation=True,
+                return_tensors="pt",
+            )
+            start = time.perf_counter()
+            generated = model.generate(
+                **inputs,
+                max_length=args.max_length,
+                num_beams=args.num_beams,
+                length_penalty=args.length_penalty,
+                no_repeat_ngram_size=args.no_repeat_ngram_size,
+            )
+            latencies.append((time.perf_counter() - start) * 1000)
+            predictions.append(tokenizer.decode(generated[0], skip_special_tokens=True))
+
+    return {
+        "predictions": predictions,
+        "latency_mean_ms": float(np.mean(latencies)),
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p90_ms": float(np.percentile(latencies, 90)),
+        "model_memory_mb": model_memory,
+        "resident_memory_mb": resident_memory_mb(),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = HfArgumentParser(QuantizeEvalArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+
+    dataset = load_dataset(args.data_name, split=args.split)
+    if args.num_dialogues is not None:
+        dataset = dataset.select(range(min(args.num_dialogues, len(dataset))))
+    dialogues, references = dataset["dialogue"], dataset["summary"]
+
+    # model마다 새 process (spawn)에서 실행해서 memory 측정이 서로 섞이지 않도록 함
+    results = {}
+    for name, quantize in [("fp32", False), ("int8", True)]:
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            results[name] = executor.submit(run_variant, args, dialogues, quantize).result()
+
+    metric = RougeMetric(AutoTokenizer.from_pretrained(args.model_path))
+    for result in results.values():
+        scores = metric.score(result["predictions"], references)
+        for key in ROUGE_TYPES:
+            result[key] = round(float(np.mean([score[key] for score in scores])), 4)
+
+    report = {"config": asdict(args), "num_dialogues": len(dialogues)}
+    for name, result in results.items():
+        report[name] = {key: value for key, value in result.items() if key != "predictions"}
+    report["rouge_delta"] = {
+        key: round(results["int8"][key] - results["fp32"][key], 4) for key in ROUGE_TYPES
+    }
+    report["speedup"] = results["fp32"]["latency_mean_ms"] / results["int8"]["latency_mean_ms"]
+    report["num_identical_summaries"] = sum(
+        fp32 == int8
+        for fp32, int8 in zip(results["fp32"]["predictions"], results["int8"]["predictions"])
+    )
+    print(json.dumps(report, indent=2))
+    if args.output_file:
+        with open(args.output_file, "w") as writer:
+            json.dump(report, writer, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+import asyncio
+import json
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer, HfArgumentParser
+
+from dialogue_data import format_dialogue
+from quantization import load_model
+
+
+@dataclass
+class ServeArguments:
+    model_path: str = field(metadata={"help": "fine-tuning된 checkpoint (model + tokenizer) 경로"})
+    host: str = field(default="127.0.0.1")
+    port: int = field(default=8000)
+    # batch 하나의 최대 Dialogue 수 (1이면 요청마다 generate)
+    max_batch_size: int = field(default=16)
+    # batch 하나의 token 수 상한 (최대 길이 x batch 크기)
+    max_tokens: int = field(default=8192)
+    # 가장 오래 기다린 요청 기준으로 batch를 채우기 위해 기다리는 최대 시간(ms)
+    max_wait_ms: float = field(default=20.0)
+    # 길이가 같은 bucket(length_bucket token 단위)의 요청끼리만 batch로 묶음 (padding 낭비 제한)
+    length_bucket: int = field(default=64)
+    # generate를 실행하는 thread 수 (동시에 실행되는 batch 수)
+    num_workers: int = field(default=1)
+    # 설정하면 /metrics에 latency가 이 값(ms) 이하인 요청 비율을 추가
+    latency_target_ms: Optional[float] = field(default=None)
+    max_source_length: int = field(default=1024)
+    max_length: int = field(default=80)
+    num_beams: int = field(default=6)
+    length_penalty: float = field(default=1.0)
+    no_repeat_ngram_size: int = field(default=3)
+    device: str = field(default="cpu")
+    num_threads: Optional[int] = field(default=None)
+    quantize: bool = field(default=False)
+    share_encoder_outputs: bool = field(default=False)
+    bf16_autocast: bool = field(default=False)
+
+
+# 처리 중인 요청 하나 (Dialogue 하나)
+@dataclass
+class _PendingRequest:
+    input_ids: List[int]
+    arrival: float
+    future: asyncio.Future
+
+
+# 요청 수 / batch 크기 histogram / 최근 latency (p50 / p99)
+class ServiceStats:
+    def __init__(self, window: int = 10000, latency_target_ms: Optional[float] = None):
+        self.latency_target_ms = latency_target_ms
+        self.latencies_ms: Deque[float] = deque(maxlen=window)
+        self.batch_sizes: Counter = Counter()
+        self.num_requests = 0
+        self.num_errors = 0
+
+    def record_batch(self, latencies_ms: List[float]) -> None:
+        self.batch_sizes[len(latencies_ms)] += 1
+        self.num_requests += len(latencies_ms)
+        self.latencies_ms.extend(latencies_ms)
+
+    def snapshot(self) -> Dict:
+        stats = {
+            "num_requests": self.num_requests,
+            "num_errors": self.num_errors,
+            "num_batches": sum(self.batch_sizes.values()),
+            "batch_size_histogram": {
+                str(size): count for size, count in sorted(self.batch_sizes.items())
+            },
+        }
+        if self.latencies_ms:
+            latencies = np.asarray(self.latencies_ms)
+            stats["latency_ms"] = {
+                "p50": round(float(np.percentile(latencies, 50)), 3),
+                "p99": round(float(np.percentile(latencies, 99)), 3),
+                "mean": round(float(latencies.mean()), 3),
+            }
+            if self.latency_target_ms is not None:
+                hit_rate = float((latencies <= self.latency_target_ms).mean())
+                stats["latency_target_hit_rate"] = round(hit_rate, 4)
+        return stats
+
+
+# 동시에 들어온 요청을 길이 bucket 별 queue에 모으고, batch가 차거나 가장 오래된 요청이
+# max_wait_ms를 기다리면 batch 하나로 묶어서 thread pool의 generate_fn에 넘김
+# - 꽉 찬 bucket을 먼저, 없으면 가장 오래 기다린 요청의 bucket을 보냄
+# - 동시에 실행하는 batch는 num_workers개 (나머지 요청은 queue에서 더 모임)
+class MicroBatcher:
+    def __init__(
+        self,
+        generate_fn: Callable[[List[List[int]]], List[str]],
+        max_batch_size: int = 16,
+        max_tokens: int = 8192,
+        max_wait_ms: float = 20.0,
+        length_bucket: int = 64,
+        num_workers: int = 1,
+        stats: Optional[ServiceStats] = None,
+    ):
+        self.generate_fn = generate_fn
+        self.max_batch_size = max_batch_size
+        self.max_tokens = max_tokens
+        self.max_wait = max_wait_ms / 1000
+        self.length_bucket = length_bucket
+        self.num_workers = num_workers
+        self.stats = stats if stats is not None else ServiceStats()
+        self.queues: Dict[int, Deque[_PendingRequest]] = {}
+        self.in_flight = 0
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: Optional[asyncio.Semaphore] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._workers = asyncio.Semaphore(self.num_workers)
+        self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def close(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, input_ids: List[int]) -> str:
+        loop = asyncio.get_running_loop()
+        request = _PendingRequest(input_ids, loop.time(), loop.create_future())
+        bucket = (len(input_ids) - 1) // self.length_bucket
+        self.queues.setdefault(bucket, deque()).append(request)
+        self._wakeup.set()
+        return await request.future
+
+    # queue 앞에서부터 token budget (최대 길이 x 개수 <= max_tokens) 안의 요청 수
+    def _batch_size(self, queue: Deque[_PendingRequest]) -> int:
+        size, max_len = 0, 0
+        for request in queue:
+            max_len = max(max_len, len(request.input_ids))
+            if size == self.max_batch_size or (size > 0 and max_len * (size + 1) > self.max_tokens):
+                break
+            size += 1
+        return size
+
+    def _is_full(self, queue: Deque[_PendingRequest]) -> bool:
+        return self._batch_size(queue) < len(queue) or len(queue) >= self.max_batch_size
+
+    async def _next_batch(self) -> List[_PendingRequest]:
+        loop = asyncio.get_running_loop()
+        while True:
+            queues = [queue for queue in self.queues.values() if queue]
+            if not queues:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            full = [queue for queue in queues if self._is_full(queue)]
+            queue = min(full or queues, key=lambda queue: queue[0].arrival)
+            timeout = queue[0].arrival + self.max_wait - loop.time()
+            if full or timeout <= 0:
+                return [queue.popleft() for _ in range(self._batch_size(queue))]
+
+            # 새 요청이 들어오거나 가장 오래된 요청의 대기 시간이 끝날 때까지 기다림
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._workers.acquire()
+            batch = await self._next_batch()
+            loop.create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[_PendingRequest]) -> None:
+        loop = asyncio.get_running_loop()
+        self.in_flight += len(batch)
+        try:
+            summaries = await loop.run_in_executor(
+                self._executor, self.generate_fn, [request.input_ids for request in batch]
+            )
+        except Exception as error:
+            self.stats.num_errors += len(batch)
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(error)
+        else:
+            now = loop.time()
+            self.stats.record_batch([(now - request.arrival) * 1000 for request in batch])
+            for request, summary in zip(batch, summaries):
+                if not request.future.done():
+                    request.future.set_result(summary)
+        finally:
+            self.in_flight -= len(batch)
+            self._workers.release()
+
+
+# input_ids list batch -> 요약문 (summarize.summarize_dialogues와 같은 generate 설정, thread에서 실행)
+def build_generate_fn(
+    model, tokenizer, args: ServeArguments
+) -> Callable[[List[List[int]]], List[str]]:
+    @torch.inference_mode()
+    def generate(input_id_lists: List[List[int]]) -> List[str]:
+        inputs = tokenizer.pad({"input_ids": input_id_lists}, return_tensors="pt").to(model.device)
+        with torch.autocast(model.device.type, dtype=torch.bfloat16, enabled=args.bf16_autocast):
+            generated = model.generate(
+                **inputs,
+                max_length=args.max_length,
+                num_beams=args.num_beams,
+                length_penalty=args.length_penalty,
+                no_repeat_ngram_size=args.no_repeat_ngram_size,
+                decoder_share_encoder_outputs=args.share_encoder_outputs,
+            )
+        return tokenizer.batch_decode(generated, skip_special_tokens=True)
+
+    return generate
+
+
+# 최소한의 HTTP/1.1 (keep-alive, Content-Length body만 지원)
+# POST /summarize : {"dialogue": str} -> {"summary": str}
+#                   {"dialogues": [str]} -> {"summaries": [str]}
+# GET /metrics : queue 깊이, 처리 중인 요청 수, batch 크기 histogram, latency p50 / p99
+class SummarizationServer:
+    def __init__(self, batcher: MicroBatcher, tokenizer, max_source_length: int = 1024):
+        self.batcher = batcher
+        self.tokenizer = tokenizer
+        self.max_source_length = max_source_length
+
+    def metrics(self) -> Dict:
+        return {
+            "queue_depth": self.batcher.queue_depth,
+            "in_flight": self.batcher.in_flight,
+            **self.batcher.stats.snapshot(),
+        }
+
+    # bart_trainer.preprocess_function과 같은 입력 형식 (<sep> + tokenize)
+    async def summarize(self, dialogues: List[str]) -> List[str]:
+        features = self.tokenizer(
+            [format_dialogue(dialogue) for dialogue in dialogues],
+            max_length=self.max_source_length,
+            truncation=True,
+        )
+        return list(
+            await asyncio.gather(
+                *(self.batcher.submit(input_ids) for input_ids in features["input_ids"])
+            )
+        )
+
+    async def route(self, method: str, path: str, body: bytes):
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics()
+        if method != "POST" or path != "/summarize":
+            return 404, {"error": f"{method} {path} not found"}
+        try:
+            request = json.loads(body or b"{}")
+        except json.JSONDecodeError as error:
+            return 400, {"error": f"invalid JSON : {error}"}
+        if isinstance(request.get("dialogue"), str):
+            (summary,) = await self.summarize([request["dialogue"]])
+            return 200, {"summary": summary}
+        if isinstance(request.get("dialogues"), list):
+            return 200, {"summaries": await self.summarize(request["dialogues"])}
+        return 400, {"error": 'expected {"dialogue": str} or {"dialogues": [str]}'}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip().lower()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                try:
+                    status, payload = await self.route(method, path, body)
+                except Exception as error:
+                    status, payload = 500, {"error": repr(error)}
+                keep_alive = version == "HTTP/1.1" and headers.get("connection") != "close"
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                        "Content-Type: application/json; charset=utf-8\r\n"
+                        f"Content-Length: {len(data)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    ).encode("latin-1")
+                    + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args: ServeArguments) -> None:
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    model = load_model(args.model_path, quantize=args.quantize).to(args.device)
+    # block-sparse encoder는 forward 동안 layer에 layout을 저장하므로 여러 thread가 같이 쓰지 않음
+    if getattr(model.config, "turn_sparse_attention", None) and args.num_workers > 1:
+        raise ValueError("--num_workers > 1 is not supported with turn-sparse attention models")
+
+    batcher = MicroBatcher(
+        build_generate_fn(model, tokenizer, args),
+        max_batch_size=args.max_batch_size,
+        max_tokens=args.max_tokens,
+        max_wait_ms=args.max_wait_ms,
+        length_bucket=args.length_bucket,
+        num_workers=args.num_workers,
+        stats=ServiceStats(latency_target_ms=args.latency_target_ms),
+    )
+    batcher.start()
+    server = SummarizationServer(batcher, tokenizer, max_source_length=args.max_source_length)
+    http_server = await asyncio.start_server(server.handle, args.host, args.port)
+    print(f"serving on http://{args.host}:{args.port} (POST /summarize, GET /metrics)")
+    try:
+        async with http_server:
+            await http_server.serve_forever()
+    finally:
+        await batcher.close()
+
+
+def main():
+    parser = HfArgumentParser(ServeArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    if args.quantize and args.device != "cpu":
+        raise ValueError("--quantize is only supported with --device cpu")
+    if args.quantize and args.bf16_autocast:
+        raise ValueError("--quantize and --bf16_autocast cannot be used together")
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Tuple
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+from transformers.models.bart.modeling_bart import (
+    BartAttention,
+    BartConfig,
+    BartEncoder,
+    BartLearnedPositionalEmbedding,
+)
+
+from dialogue_data import SPAN_PAD, DialogueSpec, extract_dialogue_spans
+
+# torch.compile(dynamo)에서 trace하지 않고 eager로 실행 (torch<2.1은 그대로)
+_compiler_disable = getattr(getattr(torch, "compiler", None), "disable", lambda fn: fn)
+
+
+# Speaker-turn block-sparse encoder attention 설정
+# BartConfig.turn_sparse_attention에 저장되어 checkpoint와 함께 저장 / 복원됨
+# window_turns : 각 turn이 attention하는 앞 / 뒤 이웃 turn(block) 수
+# max_block_size : 긴 turn은 이 길이 이하의 block으로 나눔 (block 안 attention 비용의 상한)
+# max_global_tokens : global token(turn 당 1개) 수의 상한, turn이 더 많으면 고르게 골라 사용
+@dataclass
+class TurnSparseSpec:
+    window_turns: int = 1
+    max_block_size: int = 128
+    max_global_tokens: int = 64
+
+    @classmethod
+    def from_config(cls, config) -> Optional["TurnSparseSpec"]:
+        spec = getattr(config, "turn_sparse_attention", None)
+        return cls(**spec) if spec is not None else None
+
+    def save_to_config(self, config) -> None:
+        config.turn_sparse_attention = asdict(self)
+
+
+# batch 하나의 sparse attention 구조 (모든 layer / head가 공유)
+# 빈 자리의 위치 값은 seq_len (q / k / v 끝에 붙인 dummy 위치)
+@dataclass
+class TurnLayout:
+    block_index: torch.LongTensor  # [batch, blocks, block_len] block에 속한 token 위치
+    window_index: torch.LongTensor  # [batch, blocks, (2 x window + 1) x block_len] key 위치
+    window_mask: torch.BoolTensor  # window key 중 유효한 자리 (global token 제외)
+    global_index: torch.LongTensor  # [batch, num_global] turn 별 첫 Speaker token 위치
+    global_mask: torch.BoolTensor
+    key_mask: torch.BoolTensor  # [batch, seq_len] padding이 아닌 위치
+
+
+# Dialogue 하나의 block 경계 : <sep> 위치(= speaker span 시작 - 1)마다 turn을 나누고
+# max_block_size보다 긴 turn은 다시 나눔, <s> 등 첫 turn 앞 token은 첫 block, </s>는 마지막 turn에 포함
+def turn_blocks(
+    speaker_starts: List[int], length: int, max_block_size: int
+) -> List[Tuple[int, int]]:
+    turn_starts = {start - 1 for start in speaker_starts if 0 < start - 1 < length}
+    boundaries = sorted({0, length} | turn_starts)
+    blocks = []
+    for begin, end in zip(boundaries[:-1], boundaries[1:]):
+        for block_begin in range(begin, end, max_block_size):
+            blocks.append((block_begin, min(block_begin + max_block_size, end)))
+    return blocks
+
+
+# turn 별 global token 위치 : speaker span의 첫 token ("P01"의 첫 token 등)
+# max_block_size보다 긴 span(":" 없이 잘린 turn)은 제외, max_global_tokens개보다 많으면 고르게 골라 사용
+def turn_global_positions(spans: List[List[int]], length: int, spec: TurnSparseSpec) -> List[int]:
+    positions = [
+        start for start, end in spans if end <= length and end - start <= spec.max_block_size
+    ]
+    if len(positions) <= spec.max_global_tokens:
+        return positions
+    return [
+        positions[idx * len(positions) // spec.max_global_tokens]
+        for idx in range(spec.max_global_tokens)
+    ]
+
+
+# speaker span 목록 / Dialogue 길이 -> TurnLayout
+def build_turn_layout(
+    speaker_spans: List[List[List[int]]],
+    lengths: List[int],
+    seq_len: int,
+    spec: TurnSparseSpec,
+    device: Optional[torch.device] = None,
+) -> TurnLayout:
+    blocks = [
+        turn_blocks([start for start, _ in spans], length, spec.max_block_size)
+        for spans, length in zip(speaker_spans, lengths)
+    ]
+    global_positions = [
+        turn_global_positions(spans, length, spec)
+        for spans, length in zip(speaker_spans, lengths)
+    ]
+
+    bsz = len(lengths)
+    num_blocks = max([len(example_blocks) for example_blocks in blocks] + [1])
+    block_len = max(
+        [end - begin for example_blocks in blocks for begin, end in example_blocks] + [1]
+    )
+    num_global = max([len(positions) for positions in global_positions] + [0])
+
+    block_index = torch.full((bsz, num_blocks, block_len), seq_len, dtype=torch.long)
+    global_index = torch.full((bsz, num_global), seq_len, dtype=torch.long)
+    key_mask = torch.zeros(bsz, seq_len + 1, dtype=torch.bool)
+    for i, example_blocks in enumerate(blocks):
+        for k, (begin, end) in enumerate(example_blocks):
+            block_index[i, k, : end - begin] = torch.arange(begin, end)
+        if global_positions[i]:
+            global_index[i, : len(global_positions[i])] = torch.tensor(global_positions[i])
+        key_mask[i, : lengths[i]] = True
+
+    # block k의 key : block k - window ~ k + window의 token (window 밖 / padding block은 seq_len)
+    window = 2 * spec.window_turns + 1
+    padded = F.pad(block_index, (0, 0, spec.window_turns, spec.window_turns), value=seq_len)
+    window_index = padded.unfold(1, window, 1).permute(0, 1, 3, 2).reshape(bsz, num_blocks, -1)
+
+    # global token은 global key로 한 번만 attention (window 안 중복 제외)
+    is_global = torch.zeros(bsz, seq_len + 1, dtype=torch.bool)
+    is_global.scatter_(1, global_index, True)
+    is_global[:, seq_len] = False
+    window_mask = key_mask & ~is_global
+    # window_index는 unfold / permute의 non-contiguous tensor -> view 대신 reshape
+    window_mask = window_mask.gather(1, window_index.reshape(bsz, -1)).view_as(window_index)
+
+    return TurnLayout(
+        block_index=block_index.to(device),
+        window_index=window_index.to(device),
+        window_mask=window_mask.to(device),
+        global_index=global_index.to(device),
+        global_mask=(global_index < seq_len).to(device),
+        key_mask=key_mask[:, :seq_len].to(device),
+    )
+
+
+# layout이 연결되어 있으면 Speaker-turn block-sparse attention, 없으면 BartAttention과 동일
+# - 일반 token : 자기 turn과 앞 / 뒤 window_turns개 turn의 token + 모든 global token에 attention
+# - global token(turn 별 첫 Speaker token, 최대 max_global_tokens개) : 전체 token에 attention
+# 비용 : O(seq_len x (window x block_len + max_global_tokens)), seq_len에 선형
+#   (full attention은 O(seq_len^2), global token 수를 제한하지 않으면 turn 수만큼 다시 늘어남)
+class TurnSparseBartAttention(BartAttention):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.layout: Optional[TurnLayout] = None
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        key_value_states: Optional[torch.Tensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        layer_head_mask: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+    ):
+        if self.layout is None or key_value_states is not None:
+            return super().forward(
+                hidden_states,
+                key_value_states=key_value_states,
+                past_key_value=past_key_value,
+                attention_mask=attention_mask,
+                layer_head_mask=layer_head_mask,
+                output_attentions=output_attentions,
+            )
+
+        layout = self.layout
+        bsz, seq_len, _ = hidden_states.size()
+        num_heads, head_dim = self.num_heads, self.head_dim
+
+        # [batch, heads, seq_len + 1 (dummy), head_dim]
+        def project(proj, scale=1.0):
+            states = self._shape(proj(hidden_states) * scale, seq_len, bsz)
+            return F.pad(states, (0, 0, 0, 1))
+
+        query_states = project(self.q_proj, self.scaling)
+        key_states = project(self.k_proj)
+        value_states = project(self.v_proj)
+
+        def gather(states, index):
+            flat = index.reshape(bsz, 1, -1, 1).expand(-1, num_heads, -1, head_dim)
+            return states.gather(2, flat).view(bsz, num_heads, *index.shape[1:], head_dim)
+
+        min_value = torch.finfo(query_states.dtype).min
+        num_window = layout.window_index.shape[-1]
+
+        # 1. block 단위 local + global key attention
+        block_query = gather(query_states, layout.block_index)
+        window_key = gather(key_states, layout.window_index)
+        global_key = gather(key_states, layout.global_index)
+        attn_weights = torch.cat(
+            [
+                torch.einsum("bhksd,bhkwd->bhksw", block_query, window_key),
+                torch.einsum("bhksd,bhgd->bhksg", block_query, global_key),
+            ],
+            dim=-1,
+        )
+        key_mask = torch.cat(
+            [
+                layout.window_mask[:, None, :, None, :],
+                layout.global_mask[:, None, None, None, :].expand(
+                    -1, -1, layout.window_mask.shape[1], -1, -1
+                ),
+            ],
+            dim=-1,
+        )
+        attn_weights = attn_weights.masked_fill(~key_mask, min_value)
+        attn_probs = nn.functional.softmax(attn_weights, dim=-1)
+        if layer_head_mask is not None:
+            attn_probs = layer_head_mask.view(1, -1, 1, 1, 1) * attn_probs
+        attn_probs = nn.functional.dropout(attn_probs, p=self.dropout, training=self.training)
+        window_value = gather(value_states, layout.window_index)
+        global_value = gather(value_states, layout.global_index)
+        block_output = torch.einsum(
+            "bhksw,bhkwd->bhksd", attn_probs[..., :num_window], window_value
+        ) + torch.einsum("bhksg,bhgd->bhksd", attn_probs[..., num_window:], global_value)
+
+        # 2. global token은 전체 token에 attention (block 결과를 덮어씀)
+        global_query = gather(query_states, layout.global_index)
+        global_weights = torch.matmul(global_query, key_states[:, :, :seq_len].transpose(-1, -2))
+        global_weights = global_weights.masked_fill(~layout.key_mask[:, None, None, :], min_value)
+        global_probs = nn.functional.softmax(global_weights, dim=-1)
+        if layer_head_mask is not None:
+            global_probs = layer_head_mask.view(1, -1, 1, 1) * global_probs
+        global_probs = nn.functional.dropout(global_probs, p=self.dropout, training=self.training)
+        global_output = torch.matmul(global_probs, value_states[:, :, :seq_len])
+
+        # 빈 자리(seq_len)는 dummy 위치에 쓰고 버림
+        attn_output = query_states.new_zeros(bsz, num_heads, seq_len + 1, head_dim)
+        block_index = layout.block_index.reshape(bsz, 1, -1, 1).expand(-1, num_heads, -1, head_dim)
+        attn_output = attn_output.scatter(
+            2, block_index, block_output.reshape(bsz, num_heads, -1, head_dim)
+        )
+        global_index = layout.global_index.view(bsz, 1, -1, 1).expand(-1, num_heads, -1, head_dim)
+        attn_output = attn_output.scatter(2, global_index, global_output)
+
+        attn_output = attn_output[:, :, :seq_len].transpose(1, 2)
+        attn_output = attn_output.reshape(bsz, seq_len, self.embed_dim)
+        return self.out_proj(attn_output), None, None
+
+
+# config.turn_sparse_attention이 있으면 Speaker-turn block-sparse attention을 쓰는 BartEncoder
+# - speaker_spans(collator의 span table)가 없으면 config.dialogue_spec으로 input_ids에서 계산
+# - attention_mask는 right padding 기준, dense [batch, 1, seq_len, seq_len] mask는 만들지 않음
+# - layout은 다음 forward까지 layer에 남겨둠 (gradient checkpointing이 backward에서 layer를 다시 계산)
+class TurnSparseBartEncoder(BartEncoder):
+    def __init__(self, config: BartConfig, embed_tokens: Optional[nn.Embedding] = None):
+        super().__init__(config, embed_tokens)
+        for layer in self.layers:
+            layer.self_attn = TurnSparseBartAttention(
+                embed_dim=config.d_model,
+                num_heads=config.encoder_attention_heads,
+                dropout=config.attention_dropout,
+            )
+        self.turn_sparse = TurnSparseSpec.from_config(config)
+
+    # layout은 .tolist() / Python list 연산 -> compile 영역 밖에서 한 번 계산
+    # (attention 계산은 그대로 compile, layout 경계에서만 graph가 나뉨)
+    @_compiler_disable
+    def turn_layout(
+        self,
+        input_ids: torch.LongTensor,
+        attention_mask: Optional[torch.Tensor],
+        speaker_spans: Optional[torch.LongTensor],
+    ) -> TurnLayout:
+        seq_len = input_ids.shape[1]
+        if attention_mask is not None:
+            lengths = attention_mask.sum(-1).tolist()
+        else:
+            lengths = [seq_len] * input_ids.shape[0]
+
+        if speaker_spans is not None:
+            spans = [
+                [span for span in example if span[0] != SPAN_PAD]
+                for example in speaker_spans.tolist()
+            ]
+        else:
+            dialogue_spec = DialogueSpec.from_config(self.config)
+            spans = [[] for _ in lengths]
+            if dialogue_spec is not None:
+                spans = [
+                    extract_dialogue_spans(
+                        ids[:length],
+                        dialogue_spec.sep_token_id,
+                        dialogue_spec.speaker_end_token_id,
+                    )[0]
+                    for ids, length in zip(input_ids.tolist(), lengths)
+                ]
+        return build_turn_layout(spans, lengths, seq_len, self.turn_sparse, input_ids.device)
+
+    def forward(
+        self,
+        input_ids: torch.LongTensor = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        head_mask: Optional[torch.Tensor] = None,
+        inputs_embeds: Optional[torch.FloatTensor] = None,
+        output_attentions: Optional[bool] = None,
+        output_hidden_states: Optional[bool] = None,
+        return_dict: Optional[bool] = None,
+        speaker_spans: Optional[torch.LongTensor] = None,
+    ):
+        layout = None
+        if self.turn_sparse is not None and input_ids is not None:
+            layout = self.turn_layout(input_ids, attention_mask, speaker_spans)
+        for layer in self.layers:
+            layer.self_attn.layout = layout
+        if layout is not None:
+            # key padding은 layout.key_mask로 처리
+            attention_mask = None
+
+        return super().forward(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            head_mask=head_mask,
+            inputs_embeds=inputs_embeds,
+            output_attentions=output_attentions,
+            output_hidden_states=output_hidden_states,
+            return_dict=return_dict,
+        )
+
+
+# learned position embedding을 max_positions까지 늘림 (기존 위치 embedding을 반복해서 초기화)
+# encoder / decoder 모두 늘리고 config.max_position_embeddings를 갱신 (checkpoint 복원 시 같은 크기)
+def extend_position_embeddings(model: nn.Module, config: BartConfig, max_positions: int) -> None:
+    if max_positions <= config.max_position_embeddings:
+        return
+    for module in (model.get_encoder(), model.get_decoder()):
+        old = module.embed_positions
+        new = BartLearnedPositionalEmbedding(max_positions, old.embedding_dim)
+        new.to(device=old.weight.device, dtype=old.weight.dtype)
+        with torch.no_grad():
+            offset = old.offset
+            new.weight[:offset] = old.weight[:offset]
+            old_positions = old.weight[offset:]
+            repeats = -(-max_positions // len(old_positions))
+            new.weight[offset:] = old_positions.repeat(repeats, 1)[:max_positions]
+        module.embed_positions = new
+    model.get_encoder().max_source_positions = max_positions
+    model.get_decoder().max_target_positions = max_positions
+    config.max_position_embeddings = max_positions
@@ -0,0 +1,131 @@
+import json
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import torch
+from transformers import AutoTokenizer, HfArgumentParser
+
+from dialogue_data import (
+    TokenBudgetBatchSampler,
+    format_dialogue,
+    iter_dialogue_records,
+)
+from kv_cache import StaticKVCache
+from quantization import load_model
+
+
+@dataclass
+class SummarizeArguments:
+    model_path: str = field(metadata={"help": "fine-tuning된 checkpoint (model + tokenizer) 경로"})
+    input_file: str = field(metadata={"help": "Dialogue JSONL 또는 Parquet 파일"})
+    output_file: str = field(metadata={"help": "요약 결과 JSONL 파일 (입력 순서와 동일)"})
+    dialogue_field: str = field(default="dialogue")
+    id_field: Optional[str] = field(default="id")
+    # 한 번에 읽어서 길이 순으로 정렬하는 Dialogue 수 (메모리 사용량의 상한)
+    chunk_size: int = field(default=1024)
+    # generate 한 번에 넣는 token 수의 상한 (최대 길이 x batch 크기)
+    max_tokens: int = field(default=8192)
+    max_source_length: int = field(default=1024)
+    max_length: int = field(default=80)
+    num_beams: int = field(default=6)
+    length_penalty: float = field(default=1.0)
+    no_repeat_ngram_size: int = field(default=3)
+    device: str = field(default="cpu")
+    num_threads: Optional[int] = field(default=None)
+    # encoder / decoder nn.Linear와 lm_head를 dynamic int8 quantization (device="cpu"만 지원)
+    quantize: bool = field(default=False)
+    # decoder self-attention key / value를 max_length 크기로 미리 할당한 buffer에 in-place로 저장
+    static_kv_cache: bool = field(default=False)
+    # encoder output / cross-attention key, value를 Dialogue 당 하나만 유지하고 beam끼리 공유
+    share_encoder_outputs: bool = field(default=False)
+    # generate를 bfloat16 autocast 안에서 실행 (quantize와 같이 사용 불가)
+    bf16_autocast: bool = field(default=False)
+
+
+# chunk 하나를 길이 bucket 단위로 generate하고 입력 순서대로 요약문 반환
+@torch.inference_mode()
+def summarize_dialogues(
+    model, tokenizer, dialogues: List[str], args: SummarizeArguments
+) -> List[str]:
+    features = tokenizer(
+        [format_dialogue(dialogue) for dialogue in dialogues],
+        max_length=args.max_source_length,
+        truncation=True,
+    )
+    lengths = [len(input_ids) for input_ids in features["input_ids"]]
+    batch_sampler = TokenBudgetBatchSampler(
+        lengths=lengths,
+        max_tokens=max(args.max_tokens, max(lengths)),
+        bucket_size=len(lengths),
+        shuffle=False,
+    )
+
+    kv_cache = StaticKVCache(args.max_length) if args.static_kv_cache else None
+    summaries = [None] * len(dialogues)
+    for batch in batch_sampler:
+        inputs = tokenizer.pad(
+            {
+                "input_ids": [features["input_ids"][idx] for idx in batch],
+                "attention_mask": [features["attention_mask"][idx] for idx in batch],
+            },
+            return_tensors="pt",
+        ).to(model.device)
+        with torch.autocast(
+            model.device.type, dtype=torch.bfloat16, enabled=args.bf16_autocast
+        ):
+            generated = model.generate(
+                **inputs,
+                max_length=args.max_length,
+                num_beams=args.num_beams,
+                length_penalty=args.length_penalty,
+                no_repeat_ngram_size=args.no_repeat_ngram_size,
+                decoder_kv_cache=kv_cache,
+                decoder_share_encoder_outputs=args.share_encoder_outputs,
+            )
+        for idx, summary in zip(batch, tokenizer.batch_decode(generated, skip_special_tokens=True)):
+            summaries[idx] = summary
+    return summaries
+
+
+def main():
+    parser = HfArgumentParser(SummarizeArguments)
+    (args,) = parser.parse_args_into_dataclasses()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    if args.quantize and args.device != "cpu":
+        raise ValueError("--quantize is only supported with --device cpu")
+    if args.quantize and args.bf16_autocast:
+        raise ValueError("--quantize and --bf16_autocast cannot be used together")
+    model = load_model(args.model_path, quantize=args.quantize).to(args.device)
+
+    columns = [args.dialogue_field] + ([args.id_field] if args.id_field else [])
+    num_done, start_time = 0, time.perf_counter()
+    with open(args.output_file, "w", encoding="utf-8") as writer:
+        for records in iter_dialogue_records(args.input_file, args.chunk_size, columns=columns):
+            summaries = summarize_dialogues(
+                model, tokenizer, [record[args.dialogue_field] for record in records], args
+            )
+            for record, summary in zip(records, summaries):
+                output = {"index": num_done, "summary": summary}
+                if args.id_field and record.get(args.id_field) is not None:
+                    output[args.id_field] = record[args.id_field]
+                writer.write(json.dumps(output, ensure_ascii=False) + "\n")
+                num_done += 1
+            writer.flush()
+
+            elapsed = time.perf_counter() - start_time
+            print(f"summarized : {num_done}, dialogues/sec : {num_done / elapsed:.2f}")
+
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    print(
+        f"total : {num_done} dialogues, {elapsed:.1f} sec, "
+        f"dialogues/sec : {num_done / elapsed:.2f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 저장소 최상위의 flat module (contrastive.py, async_eval.py 등)을 import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
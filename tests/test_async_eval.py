@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from async_eval import AsyncEvalTrainerMixin  # noqa: E402
+
+
+class _FakeEvaluator:
+    def __init__(self):
+        self.pending = {}
+        self.results = []
+
+    def poll(self):
+        results, self.results = self.results, []
+        return results
+
+
+class _Trainer(AsyncEvalTrainerMixin, transformers.Trainer):
+    pass
+
+
+def _make_checkpoints(output_dir, steps):
+    for step in steps:
+        os.makedirs(os.path.join(output_dir, f"checkpoint-{step}"))
+
+
+# Trainer는 상대 경로 output_dir을 glob하므로 worker가 돌려준 절대 경로와 형식이 다름
+def test_rotate_after_async_result(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    output_dir = "test_save"
+    _make_checkpoints(output_dir, [1000, 2000, 3000, 4000])
+
+    trainer = _Trainer(
+        model=torch.nn.Linear(1, 1),
+        args=transformers.TrainingArguments(
+            output_dir=output_dir, save_total_limit=2, no_cuda=True, report_to=[]
+        ),
+    )
+    trainer.async_eval = _FakeEvaluator()
+    # checkpoint-4000은 아직 평가 중
+    trainer.async_eval.pending[os.path.abspath(os.path.join(output_dir, "checkpoint-4000"))] = 4000
+
+    trainer._record_async_eval(
+        [
+            {
+                "checkpoint": os.path.abspath(os.path.join(output_dir, "checkpoint-2000")),
+                "step": 2000,
+                "metrics": {"eval_rougeL": 0.4},
+            },
+            {
+                "checkpoint": os.path.abspath(os.path.join(output_dir, "checkpoint-3000")),
+                "step": 3000,
+                "metrics": {"eval_rougeL": 0.3},
+            },
+        ]
+    )
+    assert trainer.state.best_metric == 0.4
+    assert trainer.state.log_history[-1]["eval_checkpoint_step"] == 3000
+
+    trainer._rotate_checkpoints(output_dir=output_dir)
+
+    remaining = sorted(os.listdir(output_dir))
+    # best(2000) / 평가 중(4000)은 남기고, 평가가 끝난 checkpoint 중 오래된 것부터 지움
+    assert remaining == ["checkpoint-2000", "checkpoint-3000", "checkpoint-4000"]
+    assert os.path.basename(trainer.state.best_model_checkpoint) == "checkpoint-2000"
+
+    # 평가가 끝나면 rotation 대상
+    trainer.async_eval.pending.clear()
+    _make_checkpoints(output_dir, [5000])
+    trainer._rotate_checkpoints(output_dir=output_dir)
+    assert sorted(os.listdir(output_dir)) == ["checkpoint-2000", "checkpoint-5000"]
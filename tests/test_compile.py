@@ -0,0 +1,19 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from benchmark import (  # noqa: E402
+    BenchmarkArguments,
+    explain_graph_breaks,
+    supports_dynamo_explain,
+)
+
+
+# ctr_static forward(tiny_config, ctr_mode=3)가 graph break 없이 하나의 graph로 compile되는지 확인
+@pytest.mark.skipif(
+    not supports_dynamo_explain(), reason="torch._dynamo.explain requires torch>=2.1"
+)
+def test_ctr_static_forward_has_no_graph_breaks():
+    graph_breaks = explain_graph_breaks(BenchmarkArguments())
+    assert graph_breaks["graph_break_count"] == 0, graph_breaks["break_reasons"]
@@ -0,0 +1,140 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+nn = torch.nn
+
+from contrastive import speaker_aware_loss  # noqa: E402
+from dialogue_data import SPAN_PAD  # noqa: E402
+
+
+# 기존 BartModel.speaker_aware (anchor마다 positive / negative list를 누적하는 nested loop)
+def reference_speaker_aware(enc_speaker, ctr_margin, speaker_input_ids):
+    enc_negative, enc_positive = [], []
+
+    num_turn = enc_speaker.shape[0]
+    num_speaker_unique = len(list(set([int(i[0]) for i in speaker_input_ids])))
+
+    ctr_speaker_loss_means = []
+    for speaker in range(1, num_speaker_unique):
+        bench_speaker = speaker
+        for i in range(1, num_turn):
+            if torch.eq(speaker_input_ids[i][0], speaker_input_ids[bench_speaker][0]):
+                enc_positive.append(enc_speaker[i])
+            else:
+                enc_negative.append(enc_speaker[i])
+
+        if len(enc_positive) > 0 and len(enc_negative) > 0:
+            relu = nn.ReLU()
+            positive_sample_l2 = torch.stack(
+                [
+                    torch.dist(positive, enc_speaker[bench_speaker], p=2.0)
+                    for positive in enc_positive
+                ]
+            )
+            negative_sample_l2 = torch.stack(
+                [
+                    torch.dist(negative, enc_speaker[bench_speaker], p=2.0)
+                    for negative in enc_negative
+                ]
+            )
+
+            ctr_speaker_loss_lists = []
+            for negative_sample in negative_sample_l2:
+                for positive_sample in positive_sample_l2:
+                    softmax_sim_out = nn.functional.softmax(
+                        torch.stack([1 - positive_sample, 1 - negative_sample]), dim=0
+                    )
+                    ctr_speaker_loss_lists.append(
+                        relu(ctr_margin - (softmax_sim_out[0] - softmax_sim_out[1]))
+                    )
+            ctr_speaker_loss_means.append(torch.mean(torch.stack(ctr_speaker_loss_lists)))
+        else:
+            return torch.zeros(1, dtype=enc_speaker.dtype)
+
+    if len(ctr_speaker_loss_means) == 0:
+        return torch.zeros(1, dtype=enc_speaker.dtype)
+    return torch.stack(ctr_speaker_loss_means)
+
+
+# Dialogue 별 Speaker id list -> 같은 turn 수로 padding한 batch 입력
+def _batch(dialogue_speakers, d_model=8, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    num_turn = max(len(speakers) for speakers in dialogue_speakers)
+    enc_speaker = torch.randn(
+        len(dialogue_speakers), num_turn, d_model, dtype=torch.float64, generator=generator
+    )
+    speaker_ids = torch.full((len(dialogue_speakers), num_turn), SPAN_PAD, dtype=torch.long)
+    for idx, speakers in enumerate(dialogue_speakers):
+        speaker_ids[idx, : len(speakers)] = torch.tensor(speakers)
+    return enc_speaker, speaker_ids
+
+
+CASES = {
+    "multi_speaker": [[5, 6, 7, 5, 6, 7, 6, 5]],
+    "single_turn": [[5]],
+    "no_turn_pair": [[5], [6]],
+    "all_same_speaker": [[5, 5, 5, 5]],
+    # 첫 anchor에 negative가 없음 (turn 0만 다른 Speaker)
+    "first_anchor_no_negative": [[5, 6, 6, 6]],
+    "padded_turns": [[5, 6, 5, 7, 6], [5, 6], [8, 9, 9, 8, 10, 8, 9, 10], [5, 5, 5], [7]],
+}
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_speaker_aware_loss_matches_reference(name):
+    enc_speaker, speaker_ids = _batch(CASES[name])
+    batched_input = enc_speaker.clone().requires_grad_(True)
+    anchor_loss, anchor_mask = speaker_aware_loss(batched_input, speaker_ids, 1.0)
+
+    reference_input = enc_speaker.clone().requires_grad_(True)
+    batched_total, reference_total = 0.0, 0.0
+    for idx, speakers in enumerate(CASES[name]):
+        num_turn = len(speakers)
+        expected = reference_speaker_aware(
+            reference_input[idx, :num_turn], 1.0, speaker_ids[idx, :num_turn].view(-1, 1)
+        )
+        actual = anchor_loss[idx][anchor_mask[idx]]
+        if not anchor_mask[idx].any():
+            actual = torch.zeros(1, dtype=enc_speaker.dtype)
+        torch.testing.assert_close(actual, expected, rtol=1e-10, atol=1e-10)
+        batched_total = batched_total + actual.sum()
+        reference_total = reference_total + expected.sum()
+
+    if not torch.is_tensor(reference_total) or not reference_total.requires_grad:
+        return
+    batched_total.backward()
+    reference_total.backward()
+    torch.testing.assert_close(batched_input.grad, reference_input.grad, rtol=1e-8, atol=1e-10)
+    # padding turn에는 gradient가 없음
+    padding = speaker_ids == SPAN_PAD
+    assert torch.count_nonzero(batched_input.grad[padding]) == 0
+
+
+def test_speaker_aware_loss_float32_under_autocast():
+    enc_speaker, speaker_ids = _batch(CASES["padded_turns"])
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        anchor_loss, _ = speaker_aware_loss(enc_speaker.bfloat16(), speaker_ids, 1.0)
+    assert anchor_loss.dtype == torch.float32
+
+
+# warm-start하는 Dialogue는 k-means++ 초기화를 다시 하지 않음 (처음 보는 Dialogue만)
+def test_topic_cluster_cache_initializes_only_cold_rows(monkeypatch):
+    import contrastive
+
+    init_batch_sizes = []
+    kmeans_plusplus_init = contrastive.kmeans_plusplus_init
+
+    def counting_init(points, mask, num_cluster):
+        init_batch_sizes.append(points.shape[0])
+        return kmeans_plusplus_init(points, mask, num_cluster)
+
+    monkeypatch.setattr(contrastive, "kmeans_plusplus_init", counting_init)
+    torch.manual_seed(0)
+    points = torch.randn(3, 6, 8)
+    mask = torch.ones(3, 6, dtype=torch.bool)
+    cache = contrastive.TopicClusterCache()
+
+    cache.cluster([0, 1], points[:2], mask[:2])
+    cache.cluster([0, 1, 2], points, mask)
+    assert init_batch_sizes == [2, 1]
+    assert cache.stats()["topic_cache_hits"] == 2
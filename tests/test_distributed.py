@@ -0,0 +1,23 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+if not torch.distributed.is_available() or not torch.distributed.is_gloo_available():
+    pytest.skip("gloo backend is not available", allow_module_level=True)
+
+from distributed import DistributedCheckArguments, _gradients, _max_abs_diff  # noqa: E402
+
+
+# 요약문 길이 / Contrastive loss Dialogue 수가 rank마다 다른 batch에서
+# 1-process와 2-process(gloo, DDP) 학습의 gradient가 같은지 확인
+def test_two_rank_gradients_match_single_process():
+    args = DistributedCheckArguments(world_size=2, batch_size=4)
+    single = _gradients(args, 1)
+    double = _gradients(args, 2)
+
+    assert single.keys() == double.keys()
+    for name in single:
+        torch.testing.assert_close(double[name], single[name], rtol=1e-4, atol=args.atol)
+
+    # rank 별 평균을 그대로 쓰면 달라야 함 (batch가 rank 차이를 실제로 만드는지 확인)
+    assert _max_abs_diff(single, _gradients(args, 2, aggregate=False)) > args.atol
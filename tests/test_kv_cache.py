@@ -0,0 +1,40 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from benchmark import BenchmarkArguments, synthetic_batch, tiny_config  # noqa: E402
+from kv_cache import StaticKVCache  # noqa: E402
+from modeling_bart import BartForConditionalGeneration  # noqa: E402
+
+
+def _generate(model, batch, **gen_kwargs):
+    with torch.no_grad():
+        return model.generate(
+            input_ids=batch["input_ids"],
+            attention_mask=batch["attention_mask"],
+            max_length=24,
+            min_length=24,
+            num_beams=4,
+            num_return_sequences=4,
+            return_dict_in_generate=True,
+            output_scores=True,
+            **gen_kwargs,
+        )
+
+
+# float32 beam search : StaticKVCache(in-place buffer, [:cursor]만 reorder)와 torch.cat cache의 결과가 같음
+# (같은 cache를 두 번째 generate에 다시 써도 같음)
+def test_static_kv_cache_matches_generate():
+    args = BenchmarkArguments(batch_size=2)
+    config = tiny_config(args)
+    torch.manual_seed(0)
+    model = BartForConditionalGeneration(config).eval()
+    batch = synthetic_batch(args, config)
+
+    expected = _generate(model, batch)
+    kv_cache = StaticKVCache(max_length=32)
+    for _ in range(2):
+        actual = _generate(model, batch, decoder_kv_cache=kv_cache)
+        assert torch.equal(actual.sequences, expected.sequences)
+        torch.testing.assert_close(actual.sequences_scores, expected.sequences_scores)
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("rouge_score")
+tokenizers = pytest.importorskip("tokenizers")
+transformers = pytest.importorskip("transformers")
+
+from metrics import RougeMetric  # noqa: E402
+
+TEXTS = [
+    "#Person1# asks #Person2# about the weekend trip.",
+    "They agree to meet at the station.\nThe train leaves at nine.",
+    "#Person2# is late.",
+    "The doctor tells #Person1# to rest for a week and drink more water.",
+]
+
+
+# TEXTS로 학습한 작은 byte-level BPE fast tokenizer
+def _tokenizer():
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.BPE())
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = tokenizers.decoders.ByteLevel()
+    trainer = tokenizers.trainers.BpeTrainer(
+        vocab_size=300,
+        special_tokens=["<pad>", "</s>"],
+        initial_alphabet=tokenizers.pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(TEXTS, trainer)
+    return transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token="<pad>", eos_token="</s>"
+    )
+
+
+def _encode(tokenizer, texts):
+    return np.array(tokenizer(texts, padding=True)["input_ids"])
+
+
+def _written(output_dir):
+    with open(output_dir / "predictions-0.jsonl", encoding="utf-8") as reader:
+        return [json.loads(line) for line in reader]
+
+
+# 길이 순으로 정렬한 dataset의 결과도 predictions-0.jsonl에는 원래 dataset 순서로 저장
+def test_predictions_are_written_in_original_order(tmp_path):
+    tokenizer = _tokenizer()
+    order = np.argsort([len(text) for text in TEXTS])
+    sorted_texts = [TEXTS[idx] for idx in order]
+    predictions = _encode(tokenizer, [text.upper() for text in sorted_texts])
+
+    metric = RougeMetric(tokenizer, output_dir=str(tmp_path), num_workers=1)
+    with metric.original_order(np.argsort(order)):
+        result = metric((predictions, _encode(tokenizer, sorted_texts)))
+    assert metric.restore_order is None
+
+    records = _written(tmp_path)
+    assert [record["reference"] for record in records] == TEXTS
+    assert [record["prediction"] for record in records] == [text.upper() for text in TEXTS]
+    rouge_l = np.mean([record["rougeL"] for record in records])
+    assert result["rougeL"] == pytest.approx(rouge_l, abs=1e-4)
+
+
+# 기존 compute_metrics(evaluate의 rouge, tokenizer=tokenizer.tokenize)와 같은 Dialogue 별 점수
+# rouge1/2/L은 줄바꿈 token을 포함한 전체 문자열, rougeLsum은 줄 단위로 tokenize
+def test_scores_match_rouge_score_with_tokenizer_tokenize():
+    from rouge_score import rouge_scorer
+
+    from metrics import ROUGE_TYPES
+
+    tokenizer = _tokenizer()
+
+    class _Tokenize:
+        def tokenize(self, text):
+            return tokenizer.tokenize(text)
+
+    predictions = [
+        "#Person1# asks about the trip.\nThey meet at the station.",
+        "The train leaves at nine.\n\n#Person2# is late.",
+        "The doctor tells #Person1# to rest.",
+        "",
+    ]
+    references = TEXTS
+    scorer = rouge_scorer.RougeScorer(ROUGE_TYPES, tokenizer=_Tokenize())
+    expected = [
+        {key: score.fmeasure for key, score in scorer.score(reference, prediction).items()}
+        for prediction, reference in zip(predictions, references)
+    ]
+
+    actual = RougeMetric(tokenizer, num_workers=1).score(predictions, references)
+    assert actual == pytest.approx(expected)
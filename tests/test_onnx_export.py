@@ -0,0 +1,54 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from benchmark import BenchmarkArguments, synthetic_batch, tiny_config  # noqa: E402
+from modeling_bart import BartForConditionalGeneration  # noqa: E402
+from onnx_export import OnnxBeamSearch, export_onnx  # noqa: E402
+
+GEN_KWARGS = {
+    # random model은 바로 </s>를 생성하므로 min_length로 길이를 보장
+    "greedy": {"num_beams": 1, "min_length": 12},
+    "beam": {"num_beams": 4, "no_repeat_ngram_size": 3},
+    # export_onnx 기본 processor 외의 generation config (repetition_penalty, bad_words_ids 등)
+    "beam_penalties": {
+        "num_beams": 4,
+        "repetition_penalty": 1.3,
+        "encoder_no_repeat_ngram_size": 2,
+        "bad_words_ids": [[120], [130, 131]],
+    },
+    "greedy_penalties": {
+        "num_beams": 1,
+        "min_length": 12,
+        "repetition_penalty": 1.3,
+        "bad_words_ids": [[120]],
+    },
+}
+
+
+@pytest.fixture(scope="module")
+def exported(tmp_path_factory):
+    args = BenchmarkArguments(batch_size=2)
+    config = tiny_config(args)
+    torch.manual_seed(0)
+    model = BartForConditionalGeneration(config).eval()
+    onnx_dir = str(tmp_path_factory.mktemp("onnx"))
+    export_onnx(model, onnx_dir)
+    return model, OnnxBeamSearch(onnx_dir), synthetic_batch(args, config)
+
+
+# 작은 random model을 export해서 ONNX Runtime greedy / beam search 결과가 model.generate와 token 단위로 같은지 확인
+@pytest.mark.parametrize("name", sorted(GEN_KWARGS))
+def test_onnx_generate_matches_torch(exported, name):
+    model, onnx_model, batch = exported
+    gen_kwargs = {"max_length": 20, **GEN_KWARGS[name]}
+    with torch.no_grad():
+        expected = model.generate(
+            input_ids=batch["input_ids"], attention_mask=batch["attention_mask"], **gen_kwargs
+        )
+    generated = onnx_model.generate(batch["input_ids"], batch["attention_mask"], **gen_kwargs)
+    assert expected.shape[-1] > 2
+    assert generated.tolist() == expected.tolist()
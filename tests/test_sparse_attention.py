@@ -0,0 +1,69 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from transformers import BartConfig  # noqa: E402
+from transformers.models.bart.modeling_bart import BartEncoder  # noqa: E402
+
+from dialogue_data import SPAN_PAD  # noqa: E402
+from sparse_attention import (  # noqa: E402
+    TurnSparseBartEncoder,
+    TurnSparseSpec,
+    build_turn_layout,
+)
+
+
+# turn 20개 Dialogue : turn마다 "<sep> P01 : 발화" (speaker span 2 token, 발화 5 token)
+def _dialogue(num_turns=20):
+    spans = [[1 + 8 * turn + 1, 1 + 8 * turn + 3] for turn in range(num_turns)]
+    return spans, 1 + 8 * num_turns + 1
+
+
+def test_one_global_token_per_turn():
+    spans, length = _dialogue()
+    layout = build_turn_layout([spans], [length], length, TurnSparseSpec(max_block_size=16))
+    assert layout.global_index[0].tolist() == [start for start, _ in spans]
+
+
+def test_global_tokens_are_capped():
+    spans, length = _dialogue()
+    spec = TurnSparseSpec(max_block_size=16, max_global_tokens=4)
+    layout = build_turn_layout([spans], [length], length, spec)
+    assert layout.global_index[0].tolist() == [spans[idx][0] for idx in (0, 5, 10, 15)]
+
+
+# window가 모든 turn을 덮으면 모든 token이 전체 token에 한 번씩 attention -> dense attention과 같음
+def test_encoder_matches_dense_attention_when_window_covers_all_turns():
+    config = BartConfig(
+        vocab_size=64,
+        d_model=16,
+        encoder_layers=2,
+        encoder_attention_heads=2,
+        encoder_ffn_dim=32,
+        max_position_embeddings=64,
+        dropout=0.0,
+        attention_dropout=0.0,
+        activation_dropout=0.0,
+    )
+    TurnSparseSpec(window_turns=16, max_block_size=4).save_to_config(config)
+    torch.manual_seed(0)
+    sparse_encoder = TurnSparseBartEncoder(config).eval()
+    dense_encoder = BartEncoder(config).eval()
+    dense_encoder.load_state_dict(sparse_encoder.state_dict())
+
+    spans, length = _dialogue(num_turns=4)
+    input_ids = torch.randint(4, config.vocab_size, (2, length))
+    attention_mask = torch.ones(2, length, dtype=torch.long)
+    # 두 번째 Dialogue는 turn 3개 + right padding
+    attention_mask[1, spans[3][0] - 1 :] = 0
+    speaker_spans = torch.tensor([spans, spans[:3] + [[SPAN_PAD, SPAN_PAD]]])
+
+    with torch.no_grad():
+        sparse = sparse_encoder(
+            input_ids=input_ids, attention_mask=attention_mask, speaker_spans=speaker_spans
+        ).last_hidden_state
+        dense = dense_encoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+    valid = attention_mask.bool()
+    torch.testing.assert_close(sparse[valid], dense[valid], rtol=1e-5, atol=1e-5)